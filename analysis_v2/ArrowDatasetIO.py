@@ -0,0 +1,179 @@
+# Export datasets and photon streams to Arrow IPC or Parquet files, for exploration in other tools,
+#  and read them back with only the columns that are needed
+# Arrow IPC files (.arrow, .feather) are memory-mapped when read, so columns that aren't used are never read from disk
+# Parquet files (.parquet) are smaller, and are stored column by column, so unused columns are skipped when reading
+# This needs the pyarrow python module, which is only imported when one of these files is used
+#
+# Typical use:
+#   ExportPhotons( MergedPhotonStream( ... ), "photons.parquet" )
+#   columns = ImportColumns( "photons.parquet", [ "time", "energy" ] )
+
+import os
+import numpy as np
+from SimulationDataset import DATASET_HIT_FIELDS, DATASET_MODULE_FIELDS, DATASET_SOURCE, DATASET_X, DATASET_CRYSTAL_INDEX, DATASET_PHOTON_LENGTH
+
+ARROW_SUFFIXES = [ ".arrow", ".feather" ]
+PARQUET_SUFFIXES = [ ".parquet" ]
+
+# Column names and storage types, in the order of the photon layout (see SimulationDataset)
+PHOTON_COLUMNS = [ ( "event", "int64" ), ( "energy", "float64" ), ( "time", "float64" ), ( "r", "float64" ), ( "phi", "float64" ), ( "z", "float64" ),
+                   ( "ring", "int32" ), ( "block", "int32" ), ( "crystal", "int32" ),
+                   ( "source", "int64" ), ( "hitIndex", "int64" ),
+                   ( "x", "float64" ), ( "y", "float64" ), ( "crystalIndex", "int64" ) ]
+PHOTON_COLUMN_NAMES = [ name for name, _ in PHOTON_COLUMNS ]
+
+# Datasets have the same columns, apart from the photon origin (which only means something inside one process)
+HIT_COLUMN_NAMES = PHOTON_COLUMN_NAMES[ : DATASET_HIT_FIELDS + DATASET_MODULE_FIELDS ]
+DERIVED_COLUMN_NAMES = PHOTON_COLUMN_NAMES[ DATASET_X : DATASET_PHOTON_LENGTH ]
+
+# Dataset properties stored with the table
+# clusterLimitMM is there if the hits were clustered before export, so that they aren't clustered again when loaded
+DATASET_METADATA = [ "totalDecays", "energyMin", "energyMax", "clusterLimitMM" ]
+
+
+def ImportPyArrow():
+  try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+  except ImportError:
+    raise RuntimeError( "Arrow and Parquet files need the pyarrow python module" )
+  return pyarrow
+
+
+def IsArrowFile( Path ):
+  return os.path.splitext( Path )[1] in ARROW_SUFFIXES + PARQUET_SUFFIXES
+
+
+# Write a table, in blocks of BlockHits rows so that it can be read back in parts
+def WriteTable( Table, OutputPath, BlockHits ):
+  pa = ImportPyArrow()
+
+  # Write to a temporary name and then move into place, since other processes may be reading the same file
+  suffix = os.path.splitext( OutputPath )[1]
+  temporaryPath = OutputPath + ".tmp" + str( os.getpid() )
+  if suffix in PARQUET_SUFFIXES:
+    pa.parquet.write_table( Table, temporaryPath, row_group_size=BlockHits )
+  elif suffix in ARROW_SUFFIXES:
+    # No compression, so that the file can be mapped directly
+    with pa.OSFile( temporaryPath, "wb" ) as outputFile:
+      with pa.ipc.new_file( outputFile, Table.schema ) as writer:
+        writer.write_table( Table, max_chunksize=BlockHits )
+  else:
+    raise ValueError( "Unrecognised file type for " + OutputPath + ", use one of " + str( ARROW_SUFFIXES + PARQUET_SUFFIXES ) )
+  os.replace( temporaryPath, OutputPath )
+
+
+def ColumnTable( Columns, Metadata=None ):
+  pa = ImportPyArrow()
+  types = dict( PHOTON_COLUMNS )
+  arrays = [ pa.array( values.astype( types[ name ], copy=False ) ) for name, values in Columns ]
+  schemaMetadata = None
+  if Metadata:
+    schemaMetadata = { name: str( value ) for name, value in Metadata.items() }
+  return pa.Table.from_arrays( arrays, names=[ name for name, _ in Columns ], metadata=schemaMetadata )
+
+
+# Save the hits of a SimulationDataset or NumpyDatasetReader (i.e. after clustering and energy prefiltering)
+def ExportDataset( Dataset, OutputPath, BlockHits=1000000 ):
+  columns = []
+  for field in range( DATASET_HIT_FIELDS ):
+    columns.append( ( HIT_COLUMN_NAMES[ field ], Dataset.hitData[ :, field ] ) )
+  for field in range( DATASET_MODULE_FIELDS ):
+    columns.append( ( HIT_COLUMN_NAMES[ DATASET_HIT_FIELDS + field ], Dataset.moduleData[ :, field ] ) )
+  if Dataset.derivedData is not None:
+    for field, name in enumerate( DERIVED_COLUMN_NAMES ):
+      columns.append( ( name, Dataset.derivedData[ :, field ] ) )
+
+  # A reader keeps some of the properties in its input dataset
+  metadata = {}
+  for name in DATASET_METADATA:
+    value = getattr( Dataset, name, None )
+    if value is None and hasattr( Dataset, "inputDataset" ):
+      value = getattr( Dataset.inputDataset, name, None )
+    if value is not None:
+      metadata[ name ] = value
+  WriteTable( ColumnTable( columns, metadata ), OutputPath, BlockHits )
+
+
+# Save photons, e.g. the output of MergedPhotonStream (compact photons just give fewer columns)
+def ExportPhotons( Photons, OutputPath, BlockHits=1000000 ):
+  columns = [ ( name, Photons[ :, column ] ) for column, name in enumerate( PHOTON_COLUMN_NAMES[ : Photons.shape[1] ] ) ]
+  WriteTable( ColumnTable( columns ), OutputPath, BlockHits )
+
+
+# Open a table, reading only the columns given (or all of them)
+def ReadTable( InputPath, Columns=None ):
+  pa = ImportPyArrow()
+  if os.path.splitext( InputPath )[1] in PARQUET_SUFFIXES:
+    return pa.parquet.read_table( InputPath, columns=Columns, memory_map=True )
+
+  # Arrow IPC: the table refers to the mapped file, so selecting columns doesn't read anything
+  table = pa.ipc.open_file( pa.memory_map( InputPath, "r" ) ).read_all()
+  if Columns is not None:
+    table = table.select( Columns )
+  return table
+
+
+# Returns a dictionary of numpy arrays, one for each column name
+def ImportColumns( InputPath, Columns=None ):
+  table = ReadTable( InputPath, Columns )
+  return { name: table.column( name ).to_numpy() for name in table.column_names }
+
+
+# Returns photons in the usual layout, with any columns that weren't read set to NaN
+#  (or -1 for the module IDs, photon source and crystal index, as for photons from a dataset without those fields)
+def ImportPhotons( InputPath, Columns=None ):
+  table = ReadTable( InputPath, Columns )
+  photons = np.full( [ table.num_rows, DATASET_PHOTON_LENGTH ], np.nan )
+  photons[ :, DATASET_HIT_FIELDS : DATASET_HIT_FIELDS + DATASET_MODULE_FIELDS ] = -1
+  photons[ :, DATASET_SOURCE ] = -1
+  photons[ :, DATASET_CRYSTAL_INDEX ] = -1
+  for name in table.column_names:
+    photons[ :, PHOTON_COLUMN_NAMES.index( name ) ] = table.column( name ).to_numpy()
+  return photons
+
+
+# Dataset properties saved by ExportDataset (as strings), or an empty dictionary
+def ReadDatasetMetadata( InputPath ):
+  pa = ImportPyArrow()
+  if os.path.splitext( InputPath )[1] in PARQUET_SUFFIXES:
+    schema = pa.parquet.read_schema( InputPath, memory_map=True )
+  else:
+    schema = pa.ipc.open_file( pa.memory_map( InputPath, "r" ) ).schema
+  if schema.metadata is None:
+    return {}
+  return { name.decode(): value.decode() for name, value in schema.metadata.items() if name.decode() in DATASET_METADATA }
+
+
+# Clustering limit (in mm) of the hits in an exported dataset, or None if they weren't clustered or it isn't an exported dataset
+def ExportedClusterLimit( InputPath ):
+  if not IsArrowFile( InputPath ):
+    return None
+  value = ReadDatasetMetadata( InputPath ).get( "clusterLimitMM" )
+  if value is None:
+    return None
+  limit = float( value )
+  if limit.is_integer():
+    return int( limit )
+  return limit
+
+
+# Hit and module ID blocks from an exported dataset, as for ParseHitColumns, so it can be loaded by SimulationDataset
+# Blocks follow the stored record batches or row groups, so they may split events
+def ImportHitBlocks( InputPath, BlockHits ):
+  pa = ImportPyArrow()
+  if os.path.splitext( InputPath )[1] in PARQUET_SUFFIXES:
+    batches = pa.parquet.ParquetFile( InputPath, memory_map=True ).iter_batches( batch_size=BlockHits, columns=HIT_COLUMN_NAMES )
+  else:
+    reader = pa.ipc.open_file( pa.memory_map( InputPath, "r" ) )
+    batches = ( reader.get_batch( index ).select( HIT_COLUMN_NAMES ) for index in range( reader.num_record_batches ) )
+
+  for batch in batches:
+    hitData = np.empty( [ batch.num_rows, DATASET_HIT_FIELDS ] )
+    moduleData = np.empty( [ batch.num_rows, DATASET_MODULE_FIELDS ], dtype=np.int32 )
+    for field in range( DATASET_HIT_FIELDS ):
+      hitData[ :, field ] = batch.column( HIT_COLUMN_NAMES[ field ] ).to_numpy()
+    for field in range( DATASET_MODULE_FIELDS ):
+      moduleData[ :, field ] = batch.column( HIT_COLUMN_NAMES[ DATASET_HIT_FIELDS + field ] ).to_numpy()
+    yield hitData, moduleData
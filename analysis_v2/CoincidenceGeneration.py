@@ -1,82 +1,60 @@
 from SimulationDataset import *
+from NumpyDatasetReader import ScratchBuffer
 
+import itertools
 import numpy as np
 #import time
 
 
-# A method to create a set of time values corresponding to a given decay rate
-# The values will be sufficient to cover the TimePeriod argument
-# TimePeriod and DecayRate must have consistent units
-# RNG is passed as an argument, following numpy recommendations
-# There is effectively a "carry" operation in the form of StartTime:
-#  this method will return the first event after the end of TimePeriod,
-#  and this can then be passed as the first event in the next series
-def TimeSeriesSingleChannel( TimePeriod, DecayRate, RNG, StartTime=0.0 ):
-
-  # Multiply by reciprocal is still faster
-  decayReciprocal = 1 / DecayRate
-
-  # Guess how many events to generate
-  eventsGuess = int( TimePeriod * DecayRate )
-  if eventsGuess < 1:
-    eventsGuess = 1
-
-  # Entropy input
-  randomArray = RNG.random( size=eventsGuess )
-
-  # Convert to Poisson intervals
-  unscaledDeltaT = -np.log( 1.0 - randomArray )
-
-  # Scale by the expected decay rate
-  scaledDeltaT = unscaledDeltaT * decayReciprocal
-  
-  # For batching, use the last event generated in the previous series as the first of this
-  # The time will be presented as an "overflow" past the end of the last time period
-  if StartTime > 0.0:
-    scaledDeltaT = np.append( StartTime, scaledDeltaT )
-
-  # Convert from delta-T to time series
-  timeSeries = np.cumsum( scaledDeltaT )
-
-  # For profiling
-  #addonNumbers = []
-
-  # Here's the unpleasant bit - make sure there are enough events to cover the time period
-  while timeSeries[-1] < TimePeriod:
-    
-    # Guess how many to generate by progress so far
-    progress = timeSeries[-1] / TimePeriod
-    eventsGuess = int( len( timeSeries ) * ( 1.0 - progress ) / progress )
-
-    # Set a minimum of 8 events - something something vectorisation
-    # These cycles are more expensive than spare events
-    if eventsGuess < 8:
-      eventsGuess = 8
-    #addonNumbers.append( eventsGuess )
-
-    randomArrayExtra = RNG.random( size=eventsGuess )
-    unscaledDeltaTExtra = -np.log( 1.0 - randomArrayExtra )
-    scaledDeltaTExtra = unscaledDeltaTExtra * decayReciprocal
-    
-    # Offset from the end of existing series
-    scaledDeltaTExtra[0] += timeSeries[-1]
-    
-    timeSeriesExtra = np.cumsum( scaledDeltaTExtra )
-
-    # Append to existing series
-    timeSeries = np.append( timeSeries, timeSeriesExtra )
- 
-  # Profiling results
-  #print( "Addons: " + str( addonNumbers ) )
-  #print( "Truncation: " + str( sum( timeSeries >= TimePeriod ) ) )
-
-  # Work out where the first event in the next series should be
-  startNext = timeSeries[ timeSeries >= TimePeriod ][0] - TimePeriod
-  
-  # Truncate to the time window (should always lose at least one event)
-  timeSeries = timeSeries[ timeSeries < TimePeriod ]
+# Decay times for any number of channels at once, as a single Poisson process at the total decay rate
+# Each decay is then assigned to a channel at random (with probability rate/total), which splits the merged process
+#  into independent Poisson processes at each channel's rate, so the cost only depends on the total number of decays
+# Returns the times (sorted, and relative to the start of the period) and the channel of each decay
+# A channel's rate can also be a function giving the rate at an array of times, measured from the start of the acquisition:
+#  PeriodStart gives the start of this period in the same units
+# These channels are generated by thinning: the channel is given the highest rate in the period,
+#  and each of its decays is kept with probability rate(t)/highest
+# The highest rate is taken from the two ends of the period, so the rate must not peak in the middle of it
+#  (this is true for decay curves, and anything else that only rises or only falls over one batch)
+# There is no carry between periods here (see TimeSeriesMultiChannel for that)
+def MergedTimeSeries( TimePeriod, DecayRates, RNG, PeriodStart=0.0 ):
+
+  # Rate to generate for each channel
+  rateBounds = np.array( [ max( rate( PeriodStart ), rate( PeriodStart + TimePeriod ) ) if callable( rate ) else rate for rate in DecayRates ], dtype=float )
+  cumulativeRates = np.cumsum( rateBounds )
+  totalRate = cumulativeRates[-1]
+  if totalRate <= 0.0:
+    return np.zeros( 0 ), np.zeros( 0, dtype=np.int64 )
+
+  # Given the number of decays, their times are uniformly distributed over the period
+  # Normalising a cumulative sum of eventCount+1 exponential intervals gives these times already sorted
+  eventCount = RNG.poisson( totalRate * TimePeriod )
+  timeSeries = RNG.standard_exponential( size=eventCount + 1 )
+  np.cumsum( timeSeries, out=timeSeries )
+  timeSeries *= TimePeriod / timeSeries[-1]
+  timeSeries = timeSeries[ :-1 ]
+
+  # Choose the channel of each decay
+  channels = np.searchsorted( cumulativeRates, RNG.random( eventCount ) * totalRate, side="right" )
+  np.minimum( channels, len( rateBounds ) - 1, out=channels ) # in case of rounding at the top end
+
+  # Thin out the decays of any time-varying channels to follow their rate
+  keep = None
+  for channel, rate in enumerate( DecayRates ):
+    if not callable( rate ) or rateBounds[ channel ] <= 0.0:
+      continue
+    if keep is None:
+      keep = np.ones( eventCount, dtype=bool )
+    channelDecays = np.flatnonzero( channels == channel )
+    acceptance = rate( PeriodStart + timeSeries[ channelDecays ] ) / rateBounds[ channel ]
+    if np.any( acceptance > 1.0 ):
+      print( "Decay rate peaks inside a batch at time " + str( PeriodStart ) + ", so the generated rate is too low" )
+    keep[ channelDecays ] = RNG.random( len( channelDecays ) ) < acceptance
+  if keep is not None:
+    timeSeries = timeSeries[ keep ]
+    channels = channels[ keep ]
 
-  return timeSeries, startNext
+  return timeSeries, channels
 
 
 # To generate multiple channels of decay data at different rates
@@ -84,7 +62,14 @@ def TimeSeriesSingleChannel( TimePeriod, DecayRate, RNG, StartTime=0.0 ):
 # The code will then calculate the time period that all decays
 #  must populate, regardless of their decay rate
 # This allows consistent combination of decay channels later
-def TimeSeriesMultiChannel( BatchSize, DecayRates, RNG, StartTimes=None ):
+# All the channels are generated together as one merged process (see MergedTimeSeries)
+# There is effectively a "carry" operation in the form of StartTimes, which is updated in place:
+#  each channel's first event after the end of the period is stored,
+#  and this is then used as the first event of that channel in the next series
+# Rates can also be functions of time (see MergedTimeSeries),
+#  in which case PeriodStart gives the time of the start of this batch, in the same units
+#  (these channels have no carry, and their StartTimes entries are left at zero)
+def TimeSeriesMultiChannel( BatchSize, DecayRates, RNG, StartTimes=None, PeriodStart=0.0 ):
 
   # Check inputs
   if not isinstance( DecayRates, np.ndarray ):
@@ -100,15 +85,33 @@ def TimeSeriesMultiChannel( BatchSize, DecayRates, RNG, StartTimes=None ):
   # It's not possible to have equal numbers of events in different channels
   # Even if they all had the same decay rate, the random element means they don't cover the same time range
   # So, define an expected time range from the fastest decay, and ensure all channels cover it
-  fastestDecay = np.max( DecayRates )
+  # Time-varying rates are taken at the start of the batch
+  currentRates = np.array( [ rate( PeriodStart ) if callable( rate ) else rate for rate in DecayRates ], dtype=float )
+  fastestDecay = np.max( currentRates )
   timeGuess = BatchSize / fastestDecay
+  timeSeries, channels = MergedTimeSeries( timeGuess, DecayRates, RNG, PeriodStart )
+
+  # For batching, use the last event generated in the previous series as the first of this
+  # The time will be presented as an "overflow" past the end of the last time period
+  # The channel's decays before it are dropped: the process has no memory, so the rest are still Poisson after it
+  # It may be after the end of this period too, in which case it is just carried on again
+  keep = timeSeries >= StartTimes[ channels ]
+  carried = ( StartTimes > 0.0 ) & ( StartTimes < timeGuess )
+  timeSeries = np.concatenate( ( StartTimes[ carried ], timeSeries[ keep ] ) )
+  channels = np.concatenate( ( np.flatnonzero( carried ), channels[ keep ] ) )
 
-  # Ragged array, one channel at a time
+  # Work out where the first event in the next series should be
+  # This only depends on the decay rate: the interval from the end of the period is exponential
+  constantRate = np.array( [ not callable( rate ) for rate in DecayRates ] ) & ( currentRates > 0.0 )
+  startNext = np.zeros( len( DecayRates ) )
+  startNext[ constantRate ] = RNG.exponential( 1.0 / currentRates[ constantRate ] )
+  StartTimes[:] = np.where( StartTimes >= timeGuess, StartTimes - timeGuess, startNext )
+
+  # Ragged array, one channel at a time (the carried event first, then the rest in time order)
   # This is OK since the next operation is the per-channel photon gather anyway
-  result = [[]] * len( DecayRates )
-  for i in range( len( DecayRates ) ):
-    result[i], startNext = TimeSeriesSingleChannel( timeGuess, DecayRates[i], RNG, StartTimes[i] )
-    StartTimes[i] = startNext
+  channelOrder = np.argsort( channels, kind="stable" )
+  channelEnds = np.cumsum( np.bincount( channels, minlength=len( DecayRates ) ) )
+  result = np.split( timeSeries[ channelOrder ], channelEnds[ :-1 ] )
 
   #end = time.time_ns()
   #print( "Make time series: " + str( end-start ) + "ns" )
@@ -116,9 +119,68 @@ def TimeSeriesMultiChannel( BatchSize, DecayRates, RNG, StartTimes=None ):
   return result, timeGuess
 
 
+# Decay rate to generate for each channel, given the readers that will be sampled
+# A reader created with DetectedOnly only has the decays that left hits, so its rate is scaled down by detectedFraction:
+#  this just thins out decays that would have given no photons, so the photon stream is statistically the same
+# Rates given as functions of time are scaled in the same way
+def DetectedDecayRates( DecayRates, DecayData ):
+  fractions = [ data.detectedFraction for data in DecayData ]
+  if not any( callable( rate ) for rate in DecayRates ):
+    return np.asarray( DecayRates, dtype=float ) * np.array( fractions )
+
+  detectedRates = np.empty( len( DecayRates ), dtype=object )
+  for i, ( rate, fraction ) in enumerate( zip( DecayRates, fractions ) ):
+    if callable( rate ):
+      detectedRates[i] = lambda Time, rate=rate, fraction=fraction: rate( Time ) * fraction
+    else:
+      detectedRates[i] = rate * fraction
+  return detectedRates
+
+
+# A rate function for a series of short frames at FrameTimes during a long acquisition, e.g. a decay curve
+# The frames are generated one after another, each FrameLength long (in the same units as FrameTimes),
+#  so that only the frames themselves are simulated and not the time in between
+# Each frame is followed by a gap of FrameGap at the same rate, in which SplitFrames drops the windows
+# With a gap longer than the coincidence window (plus any delay) a frame's windows only see photons at that frame's
+#  activity, and can't run on into the next frame
+# Frame k covers the generated times from k*(FrameLength+FrameGap), which follow RateFunction from FrameTimes[k] onwards
+def FramedRateFunction( RateFunction, FrameTimes, FrameLength, FrameGap=0.0 ):
+  FrameTimes = np.asarray( FrameTimes, dtype=float )
+  framePeriod = FrameLength + FrameGap
+
+  def FrameRate( Time ):
+    frame = np.clip( np.floor_divide( Time, framePeriod ).astype( int ), 0, len( FrameTimes ) - 1 )
+    return RateFunction( FrameTimes[ frame ] + Time - ( frame * framePeriod ) )
+
+  return FrameRate
+
+
+# Split the coincidence windows from GenerateCoincidences into frames of FrameLength (ns, like the windows),
+#  giving ( frame index, windows in that frame ) for each frame in turn, without stopping the generation
+# Windows are assigned by the time of the photon that opens them, so ContinuousTimes must be used
+# FrameGap is the gap after each frame (see FramedRateFunction): windows opened in it are dropped
+# Without a gap, a window opened just before the end of a frame can include photons from the start of the next one
+# The windows of each frame must be used before moving to the next frame, and frames with no windows are skipped
+def SplitFrames( Coincidences, FrameLength, FrameGap=0.0 ):
+  framePeriod = FrameLength + FrameGap
+
+  def WindowTime( Window ):
+    if isinstance( Window, tuple ):
+      Window = Window[0] # prompt and delayed windows open with the same photon
+    return Window[ 0, DATASET_TIME ]
+
+  framedWindows = ( window for window in Coincidences if WindowTime( window ) % framePeriod < FrameLength )
+  return itertools.groupby( framedWindows, lambda Window: int( WindowTime( Window ) // framePeriod ) )
+
+
 # Take multiple decay channels and sample G4 photons for each channel
 # Then merge all photons into a single timeline for coincidence calulation
-def MergedPhotonStream( TimeSeries, DecayData, RNG, EnergyResolution=0.0, EnergyMin=0.0, EnergyMax=0.0, TimeResolution=0.0, Sort=True ):
+# Buffers may give a dictionary, kept by the caller between batches, to hold the photons of each reader and the merged
+#  photons (see ScratchBuffer in NumpyDatasetReader), so that a batch needs no new arrays once they are big enough
+# The photons returned are then overwritten by the next call with the same Buffers
+# Labels may give a value for each decay (one array per channel, like TimeSeries), and then the label of the decay
+#  that each photon came from is returned too, as photons, photonLabels
+def MergedPhotonStream( TimeSeries, DecayData, RNG, EnergyResolution=0.0, EnergyMin=0.0, EnergyMax=0.0, TimeResolution=0.0, Sort=True, Buffers=None, Labels=None ):
 
   # Check inputs
   if len( TimeSeries ) != len( DecayData ):
@@ -127,22 +189,44 @@ def MergedPhotonStream( TimeSeries, DecayData, RNG, EnergyResolution=0.0, Energy
   #start = time.time_ns()
 
   # Convert decays into photons using data samples
+  # Channels that use the same dataset reader are sampled together, so there is one call per reader
+  #  rather than per channel, and the photons are joined in a single copy
   # Internally SampleEventsAtTimes() will flatten across decay events
-  photons = DecayData[0].SampleEventsAtTimes( TimeSeries[0], RNG )
-
-  # Flatten all decay channels into a single set of photons by appending
-  for i in range( 1, len( TimeSeries ) ):
-
-    morePhotons = DecayData[i].SampleEventsAtTimes( TimeSeries[i], RNG )
-
-    if len( photons ) == 0:
-      photons = morePhotons
-    elif len( morePhotons ) > 0:
-      photons = np.append( photons, morePhotons, axis=0 )
+  readerTimes = {}
+  for channel, ( data, times ) in enumerate( zip( DecayData, TimeSeries ) ):
+    readerTimes.setdefault( id( data ), ( data, [], [] ) )
+    readerTimes[ id( data ) ][1].append( times )
+    if Labels is not None:
+      readerTimes[ id( data ) ][2].append( Labels[ channel ] )
+  photonSets = []
+  labelSets = []
+  for key, ( data, timeSets, decayLabelSets ) in readerTimes.items():
+    times = timeSets[0] if len( timeSets ) == 1 else np.concatenate( timeSets )
+    readerBuffers = None if Buffers is None else Buffers.setdefault( key, {} )
+    if Labels is None:
+      photonSets.append( data.SampleEventsAtTimes( times, RNG, readerBuffers ) )
+    else:
+      photonSet, sampleOfPhoton = data.SampleEventsAtTimes( times, RNG, readerBuffers, Samples=True )
+      photonSets.append( photonSet )
+      labelSets.append( np.concatenate( decayLabelSets )[ sampleOfPhoton ] )
+
+  # Compact readers give narrower photons (see NumpyDatasetReader): when they are mixed with others,
+  #  the extra columns are dropped, since they only hold cached values that can be calculated again
+  photons = photonSets[0]
+  if len( photonSets ) > 1:
+    photonLength = min( photonSet.shape[1] for photonSet in photonSets )
+    photonCount = sum( len( photonSet ) for photonSet in photonSets )
+    mergedPhotons = None
+    if Buffers is not None:
+      mergedPhotons = ScratchBuffer( Buffers, "merged", photonCount, np.float64, photonLength )
+    photons = np.concatenate( [ photonSet[ :, :photonLength ] for photonSet in photonSets ], out=mergedPhotons )
+  photonLabels = None
+  if Labels is not None:
+    photonLabels = labelSets[0] if len( labelSets ) == 1 else np.concatenate( labelSets )
 
   # If there are no photons then skip the rest
   if len( photons ) == 0:
-    return photons
+    return photons if Labels is None else ( photons, photonLabels )
 
   # Apply time resolution to photons
   if TimeResolution > 0.0:
@@ -155,21 +239,119 @@ def MergedPhotonStream( TimeSeries, DecayData, RNG, EnergyResolution=0.0, Energy
     photons[:,DATASET_ENERGY] *= photonEnergyMultipliers
 
   # Apply energy cut
+  passCut = None
   if EnergyMin > 0.0:
-    photons = photons[ photons[:,DATASET_ENERGY] > EnergyMin ]
+    passCut = photons[:,DATASET_ENERGY] > EnergyMin
   if EnergyMax > 0.0:
-    photons = photons[ photons[:,DATASET_ENERGY] < EnergyMax ]
+    belowMax = photons[:,DATASET_ENERGY] < EnergyMax
+    passCut = belowMax if passCut is None else np.logical_and( passCut, belowMax, out=passCut )
+  if passCut is not None:
+    keptPhotons = None
+    if Buffers is not None:
+      keptPhotons = ScratchBuffer( Buffers, "kept", np.count_nonzero( passCut ), photons.dtype, photons.shape[1] )
+    photons = np.compress( passCut, photons, axis=0, out=keptPhotons )
+    if photonLabels is not None:
+      photonLabels = photonLabels[ passCut ]
 
   #Sort the photons by time
   if len( photons ) > 0 and Sort:
-    photons = photons[ photons[:,DATASET_TIME].argsort() ]
+    timeOrder = photons[:,DATASET_TIME].argsort()
+    photons = photons[ timeOrder ]
+    if photonLabels is not None:
+      photonLabels = photonLabels[ timeOrder ]
 
   #end = time.time_ns()
   #print( "Create photon stream: " + str( end-start ) + "ns" )
 
+  if Labels is not None:
+    return photons, photonLabels
   return photons
 
 
+# Open coincidence windows along a time-sorted photon stream (see GenerateCoincidences)
+# Stops when a window would need photons from the next batch, returning the index of the first photon not yet used,
+#  or returns None when a window would end after EndTime (i.e. the simulation is finished)
+# Use "yield from" to pass on the windows and get the returned index
+def WindowPhotonStream( PhotonStream, CoincidenceWindow, MultiWindow, Delay, EndTime ):
+
+  # Find the last photon time, to make sure we don't overrun
+  finalPhotonTime = PhotonStream[ -1, DATASET_TIME ]
+
+  # Loop over the photons, opening coincidence windows
+  startWindowIndex = 0
+  while startWindowIndex < len( PhotonStream ):
+
+    # Start the window with this photon
+    thisPhoton = PhotonStream[startWindowIndex]
+    thisPhotonTime = thisPhoton[DATASET_TIME]
+    endWindowTime = thisPhotonTime + CoincidenceWindow
+
+    # Truncate when the simulation is finished
+    if endWindowTime > EndTime:
+      return None
+    # Need to add something for delayed window OR DO I!?!?
+
+    # Check for needing a new batch
+    # Original check was
+    #if endWindowTime > finalPhotonTime:
+    # However this fails if the new batch of photons includes entries that
+    # should have fallen into an older window (due to TOF effects)
+    # Adding at least a full window's distance prevents this
+    if endWindowTime + CoincidenceWindow + Delay > finalPhotonTime:
+      return startWindowIndex
+
+    # Create the window data by examining subsequent photons
+    endWindowIndex = -1
+    delayedStartIndex = len( PhotonStream )
+    delayedEndIndex = -1
+    finishedDelayWindow = ( Delay == 0.0 ) # if there's no delay we're already finished
+    finishedPromptWindow = False
+    for nextPhotonIndex in range( startWindowIndex + 1, len( PhotonStream ) ):
+
+      nextPhotonTime = PhotonStream[ nextPhotonIndex, DATASET_TIME ]
+
+      # Check the delayed window
+      if Delay > 0.0:
+
+        # Check if past the start of the delayed window
+        if nextPhotonTime >= thisPhotonTime + Delay:
+
+          # Only update the window start index for the earliest photon
+          if nextPhotonIndex < delayedStartIndex:
+            delayedStartIndex = nextPhotonIndex
+
+          # Check if past the end of the delayed window
+          # Since the photons are sorted it's not strictly necessary to
+          #  check finishedDelayWindow, but why not be thorough
+          if nextPhotonTime >= endWindowTime + Delay and not finishedDelayWindow:
+            delayedEndIndex = nextPhotonIndex
+            finishedDelayWindow = True
+
+      # Check if photon is within the window
+      if nextPhotonTime >= endWindowTime and not finishedPromptWindow:
+        endWindowIndex = nextPhotonIndex
+        finishedPromptWindow = True
+
+      if finishedPromptWindow and finishedDelayWindow:
+        break
+   
+    if Delay > 0.0:
+      yield (PhotonStream[ startWindowIndex : endWindowIndex ],
+            # For the delayed window, need to include the original photon too
+            np.concatenate(( PhotonStream[ startWindowIndex : startWindowIndex+1 ],
+                             PhotonStream[ delayedStartIndex : delayedEndIndex ] )))
+    else:
+      yield PhotonStream[ startWindowIndex : endWindowIndex ]
+
+    # Choose whether to allow multiple concurrent windows
+    if MultiWindow:
+      startWindowIndex += 1
+    else:
+      startWindowIndex = endWindowIndex
+
+  return startWindowIndex
+
+
 # Code that uses the above methods to generate a stream of coincidence windows
 # In each window, details of all compatible photons are returned
 # BatchSize allows control of the number of decays in memory at once,
@@ -179,6 +361,9 @@ def MergedPhotonStream( TimeSeries, DecayData, RNG, EnergyResolution=0.0, Energy
 # DecayRates and DecayData describe each channel under consideration,
 #  giving the rate of decays in that channel, and the dataset containing
 #  the Geant4 data for those decays
+# A decay rate can instead be a function giving the rate (Bq) at an array of experiment times (s),
+#  e.g. for a decaying tracer, so that one acquisition follows the changing activity
+#  (see FramedRateFunction and SplitFrames to make a count rate curve in a single run)
 # CoincidenceWindow is the time (ns) to collect photons for a coincidence,
 #  and MultiWindow is a boolean flag permitting each photon to open a new
 #  coincidence window (or not, if there is an existing window)
@@ -194,6 +379,12 @@ def GenerateCoincidences( BatchSize, DecayRates, DecayData, RNG, CoincidenceWind
   # Since each decay is calculated by delta-T, use the last in each channel as an offset
   timeOffsets = np.zeros( len( DecayRates ) )
 
+  # Photons are sampled into the same arrays each batch (the windows come from a sorted copy)
+  photonBuffers = {}
+
+  # Only generate decays that the readers can sample
+  detectedRates = DetectedDecayRates( DecayRates, DecayData )
+
   # profiling
   #yieldCounter = 0
   #batchCounter = 0
@@ -204,8 +395,9 @@ def GenerateCoincidences( BatchSize, DecayRates, DecayData, RNG, CoincidenceWind
   while totalTime < SimulationWindow:
 
     # Use the previous methods to create the photon timeline
-    timeSeries, batchTimePeriod = TimeSeriesMultiChannel( BatchSize, DecayRates, RNG, timeOffsets )
-    photonStream = MergedPhotonStream( timeSeries, DecayData, RNG, EnergyResolution, EnergyMin, EnergyMax, TimeResolution, Sort=False )
+    # (channels with time-varying rates are given the batch start time, in s)
+    timeSeries, batchTimePeriod = TimeSeriesMultiChannel( BatchSize, detectedRates, RNG, timeOffsets, totalTime * 1e-9 )
+    photonStream = MergedPhotonStream( timeSeries, DecayData, RNG, EnergyResolution, EnergyMin, EnergyMax, TimeResolution, Sort=False, Buffers=photonBuffers )
 
     # Can't calculate delays if the delay time is longer than the batch
     if Delay > batchTimePeriod * 1e9:
@@ -224,99 +416,127 @@ def GenerateCoincidences( BatchSize, DecayRates, DecayData, RNG, CoincidenceWind
 
     # Re-use previous batch photons that were leftover
     if leftoverPhotons is not None and len( leftoverPhotons ) > 0:
-      photonStream = np.append( leftoverPhotons, photonStream, axis=0 )
+      joinedPhotons = ScratchBuffer( photonBuffers, "joined", len( leftoverPhotons ) + len( photonStream ), np.float64, photonStream.shape[1] )
+      photonStream = np.concatenate( ( leftoverPhotons, photonStream ), out=joinedPhotons )
 
     # Sort photons after merging batches to avoid overlaps
     photonStream = photonStream[ photonStream[:,DATASET_TIME].argsort() ]
 
-    # Find the last photon time, to make sure we don't overrun
-    finalPhotonTime = photonStream[ -1, DATASET_TIME ]
-
-    # Loop over the photons, opening coincidence windows
-    startWindowIndex = 0
-    while startWindowIndex < len( photonStream ):
-
-      # Start the window with this photon
-      thisPhoton = photonStream[startWindowIndex]
-      thisPhotonTime = thisPhoton[DATASET_TIME]
-      endWindowTime = thisPhotonTime + CoincidenceWindow
-
-      # Truncate when the simulation is finished
-      if ContinuousTimes and endWindowTime > SimulationWindow:
-        #print( "Total batches: " + str( batchCounter ) )
-        #print( "Yielded " + str( yieldCounter/batchCounter ) + " windows/batch" )
-        return
-      elif not ContinuousTimes and endWindowTime + totalTime > SimulationWindow:
-        #print( "Total batches: " + str( batchCounter ) )
-        #print( "Yielded " + str( yieldCounter/batchCounter ) + " windows/batch" )
-        return
-      # Need to add something for delayed window OR DO I!?!?
-
-      # Check for needing a new batch
-      # Original check was
-      #if endWindowTime > finalPhotonTime:
-      # However this fails if the new batch of photons includes entries that
-      # should have fallen into an older window (due to TOF effects)
-      # Adding at least a full window's distance prevents this
-      if endWindowTime + CoincidenceWindow + Delay > finalPhotonTime:
-        totalTime += ( batchTimePeriod * 1e9 )
-        break
+    # Open the windows in this batch (without ContinuousTimes, photon times are from the start of the batch)
+    endTime = SimulationWindow
+    if not ContinuousTimes:
+      endTime = SimulationWindow - totalTime
+    startWindowIndex = yield from WindowPhotonStream( photonStream, CoincidenceWindow, MultiWindow, Delay, endTime )
+    if startWindowIndex is None:
+      #print( "Total batches: " + str( batchCounter ) )
+      #print( "Yielded " + str( yieldCounter/batchCounter ) + " windows/batch" )
+      return
+    totalTime += ( batchTimePeriod * 1e9 )
 
-      # Create the window data by examining subsequent photons
-      endWindowIndex = -1
-      delayedStartIndex = len( photonStream )
-      delayedEndIndex = -1
-      finishedDelayWindow = ( Delay == 0.0 ) # if there's no delay we're already finished
-      finishedPromptWindow = False
-      for nextPhotonIndex in range( startWindowIndex + 1, len( photonStream ) ):
+    # The windows have stopped at the end of the batch
+    # Recycle the leftover photons for the next batch
+    leftoverPhotons = photonStream[ startWindowIndex : ]
 
-        nextPhotonTime = photonStream[ nextPhotonIndex, DATASET_TIME ]
+    # Offset times for a new batch
+    if not ContinuousTimes:
+      leftoverPhotons[ :, DATASET_TIME ] -= ( batchTimePeriod * 1e9 )
 
-        # Check the delayed window
-        if Delay > 0.0:
 
-          # Check if past the start of the delayed window
-          if nextPhotonTime >= thisPhotonTime + Delay:
+# Coincidence windows for a series of tracer activities from one generated stream, e.g. for a count rate curve
+# Decays are generated and sampled once per batch at the highest of TracerActivities, and every tracer decay gets
+#  a uniform random depth label: an activity point keeps the decay if its label is below activity/highest
+# So each point is a thinned (Poisson) stream at the right rate, and the points are nested subsets of the one stream
+# The other channels in DecayRates (e.g. the intrinsic activity of the detector) are kept in full for every point
+# Photons are sampled, smeared, cut and sorted once per batch for all the points, which also share their randomness,
+#  so the shape of the curve is smoother than from separate runs
+# DecayRates[TracerChannel] is not used, and the other arguments are as for GenerateCoincidences
+# Yields ( activity index, window ) for the windows of every point, with the points interleaved batch by batch
+def GenerateActivitySweep( BatchSize, TracerActivities, DecayRates, DecayData, RNG, CoincidenceWindow, SimulationWindow, MultiWindow, \
+                           EnergyResolution=0.0, EnergyMin=0.0, EnergyMax=0.0, TimeResolution=0.0, ContinuousTimes=True,
+                           Delay=0.0, TracerChannel=0 ):
 
-            # Only update the window start index for the earliest photon
-            if nextPhotonIndex < delayedStartIndex:
-              delayedStartIndex = nextPhotonIndex
+  if Delay < 0.0:
+    print( "Delay must be positive, can't access photons before start of generation" )
+    return
 
-            # Check if past the end of the delayed window
-            # Since the photons are sorted it's not strictly necessary to
-            #  check finishedDelayWindow, but why not be thorough
-            if nextPhotonTime >= endWindowTime + Delay and not finishedDelayWindow:
-              delayedEndIndex = nextPhotonIndex
-              finishedDelayWindow = True
+  # Generate the tracer at the highest activity
+  TracerActivities = np.asarray( TracerActivities, dtype=float )
+  pointCount = len( TracerActivities )
+  highestActivity = np.max( TracerActivities )
+  decayRates = [ highestActivity if channel == TracerChannel else rate for channel, rate in enumerate( DecayRates ) ]
+  detectedRates = DetectedDecayRates( decayRates, DecayData )
+  timeOffsets = np.zeros( len( DecayRates ) )
+  photonBuffers = {}
 
-        # Check if photon is within the window
-        if nextPhotonTime >= endWindowTime and not finishedPromptWindow:
-          endWindowIndex = nextPhotonIndex
-          finishedPromptWindow = True
+  # Fraction of the tracer decays kept by each point
+  # Decays from the other channels are labelled -1, so that every point keeps them
+  keptFractions = np.ones( pointCount )
+  if highestActivity > 0.0:
+    keptFractions = TracerActivities / highestActivity
 
-        if finishedPromptWindow and finishedDelayWindow:
-          break
-     
-      #yieldCounter += 1
+  # Loop until end of the simulation
+  totalTime = 0.0
+  leftoverPhotons = [ None ] * pointCount
+  finished = np.zeros( pointCount, dtype=bool )
+  while totalTime < SimulationWindow:
 
-      if Delay > 0.0:
-        yield (photonStream[ startWindowIndex : endWindowIndex ],
-              # For the delayed window, need to include the original photon too
-              np.concatenate(( photonStream[ startWindowIndex : startWindowIndex+1 ],
-                               photonStream[ delayedStartIndex : delayedEndIndex ] )))
-      else:
-        yield photonStream[ startWindowIndex : endWindowIndex ]
-
-      # Choose whether to allow multiple concurrent windows
-      if MultiWindow:
-        startWindowIndex += 1
-      else:
-        startWindowIndex = endWindowIndex
-
-    # We've broken out of the loop because it's the end of a batch
-    # Recycle the leftover photons for the next batch
-    leftoverPhotons = photonStream[ startWindowIndex : ]
+    timeSeries, batchTimePeriod = TimeSeriesMultiChannel( BatchSize, detectedRates, RNG, timeOffsets, totalTime * 1e-9 )
 
-    # Offset times for a new batch
+    # Can't calculate delays if the delay time is longer than the batch
+    if Delay > batchTimePeriod * 1e9:
+      print( "Coincidence window delay (" + str(Delay) + ") is greater than expected batch length (" + str(batchTimePeriod) + ")" )
+      return
+
+    # Sample the whole batch once, labelling each photon with the depth of its decay
+    decayLabels = [ RNG.random( len( times ) ) if channel == TracerChannel else np.full( len( times ), -1.0 ) for channel, times in enumerate( timeSeries ) ]
+    photonStream, photonLabels = MergedPhotonStream( timeSeries, DecayData, RNG, EnergyResolution, EnergyMin, EnergyMax, TimeResolution, Sort=False, Buffers=photonBuffers, Labels=decayLabels )
+
+    # Potentially this could just be an empty batch
+    if len( photonStream ) == 0:
+      continue
+
+    # Photon times are generated from the start of the batch: convert to experiment time
+    if ContinuousTimes:
+      photonStream[:,DATASET_TIME] += totalTime
+
+    # Sort the batch once for all the points
+    timeOrder = photonStream[:,DATASET_TIME].argsort()
+    photonStream = photonStream[ timeOrder ]
+    photonLabels = photonLabels[ timeOrder ]
+
+    endTime = SimulationWindow
     if not ContinuousTimes:
-      leftoverPhotons[ :, DATASET_TIME ] -= ( batchTimePeriod * 1e9 )
+      endTime = SimulationWindow - totalTime
+    for point in range( pointCount ):
+      if finished[ point ]:
+        continue
+
+      # This point's photons, after the previous batch photons that were leftover
+      # Both parts are already sorted, so the (stable) sort only has to merge them
+      pointPhotons = photonStream[ photonLabels < keptFractions[ point ] ]
+      if leftoverPhotons[ point ] is not None and len( leftoverPhotons[ point ] ) > 0:
+        pointPhotons = np.append( leftoverPhotons[ point ], pointPhotons, axis=0 )
+        pointPhotons = pointPhotons[ pointPhotons[:,DATASET_TIME].argsort( kind="stable" ) ]
+      if len( pointPhotons ) == 0:
+        continue
+
+      # Open the windows for this point, labelled with the point
+      windows = WindowPhotonStream( pointPhotons, CoincidenceWindow, MultiWindow, Delay, endTime )
+      while True:
+        try:
+          window = next( windows )
+        except StopIteration as stop:
+          startWindowIndex = stop.value
+          break
+        yield point, window
+
+      if startWindowIndex is None:
+        finished[ point ] = True
+        continue
+      leftoverPhotons[ point ] = pointPhotons[ startWindowIndex : ]
+      if not ContinuousTimes:
+        leftoverPhotons[ point ][ :, DATASET_TIME ] -= ( batchTimePeriod * 1e9 )
+
+    if np.all( finished ):
+      return
+    totalTime += ( batchTimePeriod * 1e9 )
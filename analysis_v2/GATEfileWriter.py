@@ -1,10 +1,9 @@
 import SimulationDataset as sd
 import numpy as np
 import uproot
-import math
 
 # Data structure conversion
-def PhotonToUpROOT( Photon, Suffix, ModuleIDs, BatchCounter, UpROOTdict ):
+def PhotonToUpROOT( Photon, Suffix, BatchCounter, UpROOTdict ):
 
     UpROOTdict[ "time" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_TIME ] / 1e9 # Apparently GATE uses s but we use ns
     UpROOTdict[ "eventID" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_EVENT ]
@@ -12,32 +11,23 @@ def PhotonToUpROOT( Photon, Suffix, ModuleIDs, BatchCounter, UpROOTdict ):
     UpROOTdict[ "comptonPhantom" + Suffix ][ BatchCounter ] = 0 # TODO
     
     # These are helpful for debugging but not necessary
-    UpROOTdict[ "globalPosX" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_R ] * math.cos( Photon[ sd.DATASET_PHI ] )
-    UpROOTdict[ "globalPosY" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_R ] * math.sin( Photon[ sd.DATASET_PHI ] )
+    UpROOTdict[ "globalPosX" + Suffix ][ BatchCounter ], UpROOTdict[ "globalPosY" + Suffix ][ BatchCounter ] = sd.PhotonXY( Photon )
     UpROOTdict[ "globalPosZ" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_Z ]
 
-    # Retrieve the module IDs
-    # Note that it's fine to use a tuple () as a dict key, but not a list []
-    globalCoordinates = ( Photon[ sd.DATASET_R ], Photon[ sd.DATASET_PHI ], Photon[ sd.DATASET_Z ] )
-    if globalCoordinates not in ModuleIDs:
-      #print( "Could not find module IDs for " + str( globalCoordinates ) )
-      return
-
-    # Only crystal-mode data contains full info
-    photonModules = ModuleIDs[ globalCoordinates ]
-    if len( photonModules ) < 3:
-      #print( "Lacking full module ID info (" + str( len( photonModules ) ) + " fields found of 3 required)" )
+    # Only crystal-mode data contains full module ID info
+    if Photon[ sd.DATASET_CRYSTAL ] < 0:
+      #print( "Lacking full module ID info for photon " + str( Photon ) )
       return
 
     # Save module IDs
-    UpROOTdict[ "crystalID" + Suffix ][ BatchCounter ] = photonModules[ 2 ]   # "InBlock" in our terms
-    UpROOTdict[ "submoduleID" + Suffix ][ BatchCounter ] = photonModules[ 0 ] # "Ring" in our terms
+    UpROOTdict[ "crystalID" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_CRYSTAL ]  # "InBlock" in our terms
+    UpROOTdict[ "submoduleID" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_RING ]  # "Ring" in our terms
     UpROOTdict[ "moduleID" + Suffix ][ BatchCounter ] = 1 # Not needed?
-    UpROOTdict[ "rsectorID" + Suffix ][ BatchCounter ] = photonModules[ 1 ]   # "Block" in our terms
+    UpROOTdict[ "rsectorID" + Suffix ][ BatchCounter ] = Photon[ sd.DATASET_BLOCK ]   # "Block" in our terms
 
 
 # Run a coincidence generator and write results to a file
-def GATEfromGenerator( BatchSize, Generator, FileName, ModuleIDs, DetectorRadius, PairMode="Exclusive", ZMin=0.0, ZMax=0.0 ):
+def GATEfromGenerator( BatchSize, Generator, FileName, DetectorRadius, PairMode="Exclusive", ZMin=0.0, ZMax=0.0 ):
 
     # Check for nonsense batch size
     if ( BatchSize < 16 ):
@@ -103,8 +93,8 @@ def GATEfromGenerator( BatchSize, Generator, FileName, ModuleIDs, DetectorRadius
 
             # Check if there are exactly two photons giving an LoR in acceptance
             if sd.TwoHitEvent( event, DetectorRadius, ZMin, ZMax ):
-                PhotonToUpROOT( event[0], "1", ModuleIDs, batchCounter, outputDict )
-                PhotonToUpROOT( event[1], "2", ModuleIDs, batchCounter, outputDict )
+                PhotonToUpROOT( event[0], "1", batchCounter, outputDict )
+                PhotonToUpROOT( event[1], "2", batchCounter, outputDict )
                 batchCounter += 1
 
                # Check for end of batch
@@ -128,8 +118,8 @@ def GATEfromGenerator( BatchSize, Generator, FileName, ModuleIDs, DetectorRadius
                     
                     # Now just repeat the "Exclusive" calculation
                     if sd.TwoHitEvent( pair, DetectorRadius, ZMin, ZMax ):
-                        PhotonToUpROOT( pair[0], "1", ModuleIDs, batchCounter, outputDict )
-                        PhotonToUpROOT( pair[1], "2", ModuleIDs, batchCounter, outputDict )
+                        PhotonToUpROOT( pair[0], "1", batchCounter, outputDict )
+                        PhotonToUpROOT( pair[1], "2", batchCounter, outputDict )
                         batchCounter += 1
 
                         # Check for end of batch
@@ -0,0 +1,87 @@
+# A dataset reader that fetches events from the hit file on demand, rather than loading the whole file
+# Uses the event index (see ReadHitIndex in SimulationDataset) to find the sampled events, so a short run
+#  only reads a small part of a large file, at the cost of reading (and clustering) each batch as it is sampled
+# The input dataset should be created with LoadHits=False, and gives the clustering and energy prefilter settings
+# DetectedOnly leaves out the decays with no hits in the file, as for NumpyDatasetReader
+#  (decays whose hits all fail the energy prefilter are still sampled, since that isn't known until they are read)
+
+import numpy as np
+import SimulationDataset as sd
+from NumpyDatasetReader import EventRingSampler, ScratchBuffer
+from SimulationDataset import DATASET_EVENT, DATASET_TIME, DATASET_HIT_FIELDS, DATASET_MODULE_FIELDS, DATASET_SOURCE, DATASET_HIT_INDEX, DATASET_X, DATASET_CRYSTAL_INDEX, DATASET_PHOTON_LENGTH
+
+
+class IndexedDatasetReader( EventRingSampler ):
+
+  def __init__( self, InputDataset, DetectedOnly=False ):
+    self.inputDataset = InputDataset
+    self.energyMin = InputDataset.energyMin
+    self.energyMax = InputDataset.energyMax
+    self.totalDecays = InputDataset.totalDecays
+    self.sampleStartIndex = 0
+    self.buffers = {}
+
+    self.index = sd.ReadHitIndex( InputDataset.inputPath )
+    self.binaryFile = sd.IsBinaryHitFile( InputDataset.inputPath )
+    self.eventIDs = self.index[0]
+    self.eventHitsMax = int( np.max( self.index[2], initial=0 ) )
+
+    # Allow for decays that weren't detected, unless only sampling the detected ones
+    if DetectedOnly:
+      self.unusedEvents = self.eventIDs.astype( np.int64 )
+    else:
+      self.unusedEvents = np.arange( self.totalDecays )
+    if len( self.unusedEvents ) == 0:
+      raise ValueError( "No events to sample from " + InputDataset.inputPath + ( " (no decays were detected)" if DetectedOnly else "" ) )
+    self.detectedFraction = len( self.unusedEvents ) / self.totalDecays
+
+
+  # Buffers and Samples are as for NumpyDatasetReader
+  def SampleEventsAtTimes( self, Times, RNG=None, Buffers=None, Samples=False ):
+
+    # Choose the event indices that will be used for the batch (see EventRingSampler)
+    batchSize = len( Times )
+    sampleIndices = self.NextEvents( batchSize, RNG )
+
+    # Read just the sampled events that have hits, and process them as they would have been at load
+    indexRows = np.searchsorted( self.eventIDs, sampleIndices )
+    indexRows = np.minimum( indexRows, max( len( self.eventIDs ) - 1, 0 ) )
+    inFile = np.zeros( batchSize, dtype=bool )
+    if len( self.eventIDs ):
+      inFile = self.eventIDs[ indexRows ] == sampleIndices
+    hitData, moduleData = sd.ReadHitEvents( self.inputDataset.inputPath, self.index, indexRows[ inFile ], self.binaryFile )
+    if self.inputDataset.clusterLimitMM is not None:
+      hitData, moduleData = self.inputDataset.ClusterHits( hitData, moduleData, self.inputDataset.clusterLimitMM )
+    hitData, moduleData = self.inputDataset.PrefilterHits( hitData, moduleData )
+
+    # Find the range of hits belonging to each event (hits are in event order)
+    eventIndices = hitData[ :, DATASET_EVENT ].astype( np.int64 )
+    hitStarts = np.searchsorted( eventIndices, sampleIndices )
+    hitCounts = np.searchsorted( eventIndices, sampleIndices, side="right" ) - hitStarts
+    sampleOfHit, hitIndices = self.HitIndices( hitStarts, hitCounts )
+
+    # Clone the hit data and module IDs, flattened across events to just give photons
+    # There is no pair geometry cache, since the hits aren't kept
+    if Buffers is None:
+      events = np.empty( [ len( hitIndices ), DATASET_PHOTON_LENGTH ] )
+    else:
+      events = ScratchBuffer( Buffers, "photons", len( hitIndices ), np.float64, DATASET_PHOTON_LENGTH )
+    events[ :, :DATASET_HIT_FIELDS ] = hitData[ hitIndices ]
+    events[ :, DATASET_HIT_FIELDS : DATASET_HIT_FIELDS + DATASET_MODULE_FIELDS ] = moduleData[ hitIndices ]
+    events[ :, DATASET_SOURCE ] = -1
+    events[ :, DATASET_HIT_INDEX ] = -1
+    if self.inputDataset.derivedColumns:
+      events[ :, DATASET_X : DATASET_PHOTON_LENGTH ] = sd.DerivedHitColumns( hitData, moduleData, self.inputDataset.crystalGeometry )[ hitIndices ]
+    else:
+      events[ :, DATASET_X : DATASET_CRYSTAL_INDEX ] = np.nan
+      events[ :, DATASET_CRYSTAL_INDEX ] = -1
+
+    # Add the corresponding time offsets for each event
+    events[ :, DATASET_TIME ] += ( np.asarray( Times ) * 1e9 )[ sampleOfHit ] # convert to ns
+    if Samples:
+      return events, sampleOfHit
+    return( events )
+
+
+  def size( self ):
+    return self.totalDecays
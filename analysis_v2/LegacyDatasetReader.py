@@ -1,42 +1,87 @@
 # A class for using the data in more-or-less the same format as it is loaded
+# Every hit is stored as a complete photon row (with module IDs, origin and derived columns) in one flat array,
+#  ordered by event, so photons are gathered for a whole batch at once rather than copied one by one
+# Events are used in the same order as the original one-at-a-time version: popped from the end of the unused list,
+#  and when that runs out the used events (in the order they were used) are shuffled to make the new list
+# DetectedOnly leaves out the decays with no hits, as for NumpyDatasetReader
 
 import numpy as np
-from SimulationDataset import DATASET_EVENT, DATASET_ENERGY, DATASET_TIME, DATASET_R, DATASET_PHI, DATASET_Z, DATASET_PHOTON_LENGTH
+from NumpyDatasetReader import ScratchBuffer
+from SimulationDataset import DATASET_EVENT, DATASET_ENERGY, DATASET_TIME, DATASET_R, DATASET_PHI, DATASET_Z, DATASET_DERIVED_FIELDS, DATASET_PHOTON_LENGTH
 
 class LegacyDatasetReader:
 
-  def __init__( self, InputDataset ):
+  def __init__( self, InputDataset, DetectedOnly=False ):
     self.inputDataset = InputDataset
-    self.unusedEvents = []
-    self.usedEvents = []
     self.energyMin = InputDataset.energyMin
     self.energyMax = InputDataset.energyMax
     self.totalDecays = InputDataset.totalDecays
 
-    # Allow for decays that weren't detected
-    for i in range( self.totalDecays ):
-      self.unusedEvents.append( i )
+    # Photons are labelled with the pair geometry cache, if there is one
+    pairSource = -1
+    if InputDataset.pairGeometry is not None:
+      pairSource = InputDataset.pairGeometry.source
+
+    # Derived columns are optional
+    hitCount = len( InputDataset.hitData )
+    derivedData = InputDataset.derivedData
+    if derivedData is None:
+      derivedData = np.full( [ hitCount, DATASET_DERIVED_FIELDS ], np.nan )
+      derivedData[ :, -1 ] = -1
+
+    # Arrange the hits (with module IDs, origin and derived columns) as photons, with the range of rows for each event
+    self.photonData = np.hstack( [ InputDataset.hitData, InputDataset.moduleData, np.full( [ hitCount, 1 ], pairSource ), np.arange( hitCount ).reshape( -1, 1 ), derivedData ] )
+    eventIDs = InputDataset.hitData[ :, DATASET_EVENT ].astype( np.int64 )
+    self.eventOffsets = np.searchsorted( eventIDs, np.arange( self.totalDecays + 1 ) )
+
+    # Allow for decays that weren't detected, unless only sampling the detected ones
+    # The unused events are the first unusedCount entries of eventOrder, and the rest have been used
+    if DetectedOnly:
+      self.eventOrder = np.flatnonzero( np.diff( self.eventOffsets ) )
+    else:
+      self.eventOrder = np.arange( self.totalDecays )
+    self.unusedCount = len( self.eventOrder )
+    if len( self.eventOrder ) == 0:
+      raise ValueError( "No events to sample from " + InputDataset.inputPath + ( " (no decays were detected)" if DetectedOnly else "" ) )
+    self.detectedFraction = len( self.eventOrder ) / self.totalDecays
+
+    # Finished loading, so clear the input data
+    self.inputDataset.hitData = None
+    self.inputDataset.moduleData = None
+    self.inputDataset.derivedData = None
+
+
+  # Take the next EventCount events, in the order they are used
+  def NextEvents( self, EventCount, RNG=None ):
+
+    eventIDs = []
+    while EventCount > 0:
+
+      # Check if we have any events left
+      if self.unusedCount == 0:
+        self.eventOrder = self.eventOrder[ ::-1 ].copy() # order of use
+        if RNG == None:
+          self.inputDataset.RNG.shuffle( self.eventOrder )
+        else:
+          RNG.shuffle( self.eventOrder )
+        self.unusedCount = len( self.eventOrder )
+
+      # Unused events are popped from the end
+      takeCount = min( EventCount, self.unusedCount )
+      eventIDs.append( self.eventOrder[ self.unusedCount - takeCount : self.unusedCount ][ ::-1 ] )
+      self.unusedCount -= takeCount
+      EventCount -= takeCount
+
+    if len( eventIDs ) == 1:
+      return eventIDs[0]
+    return np.concatenate( eventIDs + [ np.zeros( 0, dtype=self.eventOrder.dtype ) ] )
 
 
   def ReferenceOneEvent( self, RNG=None ):
 
-    # NOTE: ideally this is an internal method that just returns event data by reference
-
-    # Check if we have any events left
-    if len( self.unusedEvents ) == 0:
-      self.unusedEvents = self.usedEvents
-      if RNG == None:
-        self.inputDataset.RNG.shuffle( self.unusedEvents )
-      else:
-        RNG.shuffle( self.unusedEvents )
-      self.usedEvents = []
-
-    eventID = self.unusedEvents.pop(-1)
-    self.usedEvents.append( eventID )
-    if eventID in self.inputDataset.inputData:
-      return self.inputDataset.inputData[ eventID ]
-    else:
-      return []
+    # NOTE: returns a copy of the event data as a list of photons (it is no longer stored that way)
+    eventID = self.NextEvents( 1, RNG )[0]
+    return self.photonData[ self.eventOffsets[ eventID ] : self.eventOffsets[ eventID + 1 ] ].tolist()
 
 
   def SampleOneEvent( self, EnergyResolution=0.0, TimeResolution=0.0 ):
@@ -63,26 +108,29 @@ class LegacyDatasetReader:
     return modifiedEvent
 
 
-  def SampleEventsAtTimes( self, Times, RNG=None ):
-
-    # NOTE: method for (hopefully faster) batch processing
-
-    result = []
+  # Buffers and Samples are as for NumpyDatasetReader
+  def SampleEventsAtTimes( self, Times, RNG=None, Buffers=None, Samples=False ):
 
-    for time in Times:
-      for photon in self.ReferenceOneEvent( RNG ):
+    # Choose an event for each time, and find the range of photons belonging to each event
+    sampleIndices = self.NextEvents( len( Times ), RNG )
+    hitStarts = self.eventOffsets[ sampleIndices ]
+    hitCounts = self.eventOffsets[ sampleIndices + 1 ] - hitStarts
 
-        newPhoton = [ value for value in photon ]
-        newPhoton[DATASET_TIME] += ( time * 1e9 ) # convert to ns
+    # Index of every photon to gather: the start of its event, plus its position within the event
+    sampleOfHit = np.repeat( np.arange( len( Times ) ), hitCounts )
+    photonIndices = np.arange( len( sampleOfHit ) ) - ( np.cumsum( hitCounts ) - hitCounts )[ sampleOfHit ]
 
-        # Flattened across events
-        result.append( newPhoton )
-
-    return np.array( result )
+    # Flattened across events, with the corresponding time offset for each event
+    photonRows = hitStarts[ sampleOfHit ] + photonIndices
+    if Buffers is None:
+      result = self.photonData[ photonRows ]
+    else:
+      result = np.take( self.photonData, photonRows, axis=0, out=ScratchBuffer( Buffers, "photons", len( photonRows ), self.photonData.dtype, DATASET_PHOTON_LENGTH ) )
+    result[ :, DATASET_TIME ] += ( np.asarray( Times ) * 1e9 )[ sampleOfHit ] # convert to ns
+    if Samples:
+      return result, sampleOfHit
+    return result
 
 
   def size( self ):
     return self.totalDecays
-
-  def GetModuleIDs( self ):
-    return self.inputDataset.moduleMap
@@ -1,11 +1,167 @@
-# A class for (faster) data manipulation with zero-padded numpy arrays
+# A class for (faster) data manipulation with numpy arrays
+# Hits are stored in one flat array, ordered by event, with an array of offsets giving the first hit of each event
+# (i.e. compressed sparse row format, with no padding for events with fewer hits)
+# Module IDs are kept in a matching integer array, and only joined to the hits when photons are sampled
+# The same goes for the derived columns (x, y, crystal index), if the dataset has them
+# In compact mode the stored hit quantities are float32: the time of a hit is relative to its decay, so it
+#  doesn't need double precision, and the absolute time (float64) is only formed when photons are sampled
+# The sampled photons then also leave out the origin and derived columns unless the dataset fills them
+#  (DATASET_COMPACT_PHOTON_LENGTH columns rather than DATASET_PHOTON_LENGTH), which cuts the data moved through
+#  sampling, sorting and windowing by more than a third
+# Events are sampled from a ring (a permutation of all decays, reshuffled in place each time it is used up),
+#  and the index arithmetic for each batch uses scratch arrays that are kept between batches
+# With DetectedOnly the ring holds just the decays that left hits, and detectedFraction says what fraction they are:
+#  the decay rate should then be scaled by that fraction (see DetectedDecayRates in CoincidenceGeneration)
 
+import os
 import numpy as np
-from SimulationDataset import DATASET_EVENT, DATASET_ENERGY, DATASET_TIME, DATASET_R, DATASET_PHI, DATASET_Z, DATASET_PHOTON_LENGTH
+from SimulationDataset import DATASET_EVENT, DATASET_ENERGY, DATASET_TIME, DATASET_R, DATASET_PHI, DATASET_Z, DATASET_HIT_FIELDS, DATASET_MODULE_FIELDS, DATASET_SOURCE, DATASET_HIT_INDEX, DATASET_X, DATASET_CRYSTAL_INDEX, DATASET_PHOTON_LENGTH, DATASET_COMPACT_PHOTON_LENGTH
 
-class NumpyDatasetReader:
 
-  def __init__( self, InputDataset ):
+# Save an array to disk and re-open it as a read-only memory map
+# All processes that map the same file share one copy of the data in the page cache
+def MemoryMapArray( Array, StorePath ):
+
+  # Write to a temporary name and then move into place, since other processes may be reading the same file
+  temporaryPath = StorePath + ".tmp" + str( os.getpid() )
+  with open( temporaryPath, "wb" ) as storeFile:
+    np.save( storeFile, Array )
+  os.replace( temporaryPath, StorePath )
+
+  return np.load( StorePath, mmap_mode="r" )
+
+
+# Open an existing memory-mapped array, as long as it was written after its source file
+def LoadMemoryMap( StorePath, SourcePath ):
+  if not os.path.exists( StorePath ) or os.path.getmtime( StorePath ) < os.path.getmtime( SourcePath ):
+    return None
+  return np.load( StorePath, mmap_mode="r" )
+
+
+# Paths of the memory-mapped copies of a dataset's arrays, by field name
+def MemoryMapPaths( InputDataset, Compact=False ):
+  storeTag = ""
+  if Compact:
+    storeTag = ".compact"
+
+  # The crystal index depends on the detector layout it was derived with
+  geometryTag = ""
+  if InputDataset.crystalGeometry is not None:
+    geometryTag = ".crystals" + "x".join( str( size ) for size in InputDataset.crystalGeometry )
+
+  return { "hitData": InputDataset.DerivedPath( storeTag + ".hits.npy" ),
+           "moduleData": InputDataset.DerivedPath( storeTag + ".modules.npy" ),
+           "eventOffsets": InputDataset.DerivedPath( storeTag + ".offsets.npy" ),
+           "derivedData": InputDataset.DerivedPath( storeTag + ".derived" + geometryTag + ".npy" ) }
+
+
+# Open the memory-mapped copies of a dataset's arrays, as long as they are all there and match each other
+# Returns the arrays by field name (derivedData only if the dataset has derived columns), or None
+def LoadMemoryMaps( InputDataset, Compact=False ):
+  storePaths = MemoryMapPaths( InputDataset, Compact )
+  fields = [ "hitData", "moduleData", "eventOffsets" ]
+  if InputDataset.derivedColumns:
+    fields.append( "derivedData" )
+
+  arrays = {}
+  for field in fields:
+    arrays[ field ] = LoadMemoryMap( storePaths[ field ], InputDataset.inputPath )
+    if arrays[ field ] is None:
+      return None
+
+  hitCount = len( arrays[ "hitData" ] )
+  if len( arrays[ "eventOffsets" ] ) != InputDataset.totalDecays + 1 or arrays[ "eventOffsets" ][-1] != hitCount or len( arrays[ "moduleData" ] ) != hitCount \
+     or ( InputDataset.derivedColumns and len( arrays[ "derivedData" ] ) != hitCount ):
+    return None
+  return arrays
+
+
+# Scratch array of Size entries kept in a dictionary of Buffers, re-using the one from the previous batch if it is big enough
+def ScratchBuffer( Buffers, Name, Size, DataType, Columns=None ):
+  buffer = Buffers.get( Name )
+  shape = [] if Columns is None else [ Columns ]
+  if buffer is None or len( buffer ) < Size or buffer.dtype != DataType or list( buffer.shape[1:] ) != shape:
+    rows = max( Size, int( 1.5 * len( buffer ) ) if buffer is not None else 0 )
+    buffer = np.empty( [ rows ] + shape, dtype=DataType )
+    Buffers[ Name ] = buffer
+  return buffer[ :Size ]
+
+
+# Event sampling shared by the numpy readers (this one and IndexedDatasetReader)
+# Events are taken from a ring of event numbers (unusedEvents, from sampleStartIndex onwards), which is reshuffled
+#  in place each time it is used up, and the index arithmetic for each batch uses scratch arrays kept between batches
+# Readers set up unusedEvents, sampleStartIndex, buffers (empty) and inputDataset (for the default RNG)
+class EventRingSampler:
+
+  # Scratch array of Size entries, kept by the reader (see ScratchBuffer)
+  def Buffer( self, Name, Size, DataType, Columns=None ):
+    return ScratchBuffer( self.buffers, Name, Size, DataType, Columns )
+
+
+  # The numbers 0 to Size-1 (not to be modified)
+  def RowNumbers( self, Size ):
+    rowNumbers = self.buffers.get( "rowNumbers" )
+    if rowNumbers is None or len( rowNumbers ) < Size:
+      rowNumbers = np.arange( max( Size, 2 * len( rowNumbers ) if rowNumbers is not None else 0 ) )
+      self.buffers[ "rowNumbers" ] = rowNumbers
+    return rowNumbers[ :Size ]
+
+
+  # Take the next EventCount events from the ring, reshuffling whenever it is used up
+  # Any number can be taken, including more than the whole dataset
+  # Returns a scratch array, which is overwritten by the next batch
+  def NextEvents( self, EventCount, RNG=None ):
+    if RNG is None:
+      RNG = self.inputDataset.RNG
+    if EventCount > 0 and len( self.unusedEvents ) == 0:
+      raise ValueError( "Can't sample events from an empty dataset" )
+
+    sampleIndices = self.Buffer( "sampleIndices", EventCount, self.unusedEvents.dtype )
+    filled = 0
+    while filled < EventCount:
+
+      # Reshuffle
+      # Note it is a lot faster to shuffle this set of indices
+      #  than to shuffle the actual data
+      if self.sampleStartIndex == len( self.unusedEvents ):
+        RNG.shuffle( self.unusedEvents )
+        self.sampleStartIndex = 0
+
+      takeCount = min( EventCount - filled, len( self.unusedEvents ) - self.sampleStartIndex )
+      sampleIndices[ filled : filled + takeCount ] = self.unusedEvents[ self.sampleStartIndex : self.sampleStartIndex + takeCount ]
+      self.sampleStartIndex += takeCount
+      filled += takeCount
+
+    return sampleIndices
+
+
+  # Which sample each photon comes from, and its row in the hit arrays, given the range of hits of each sampled event
+  # Returns scratch arrays, which are overwritten by the next batch (HitStarts is overwritten too)
+  def HitIndices( self, HitStarts, HitCounts ):
+    offsetType = HitStarts.dtype
+    hitEnds = np.cumsum( HitCounts, out=self.Buffer( "hitEnds", len( HitCounts ), offsetType ) )
+    photonCount = int( hitEnds[-1] ) if len( HitCounts ) else 0
+
+    # Event of every hit to gather: count the event ends up to each hit
+    sampleOfHit = self.Buffer( "sampleOfHit", photonCount + 1, np.int64 )
+    sampleOfHit[:] = 0
+    np.add.at( sampleOfHit, hitEnds[:-1], 1 )
+    sampleOfHit = np.cumsum( sampleOfHit[ :photonCount ], out=sampleOfHit[ :photonCount ] )
+
+    # Index of every hit to gather: the start of its event, plus its position within the event
+    hitShifts = np.subtract( HitStarts, hitEnds, out=HitStarts )
+    np.add( hitShifts, HitCounts, out=hitShifts )
+    hitIndices = np.take( hitShifts, sampleOfHit, out=self.Buffer( "hitIndices", photonCount, offsetType ), mode="clip" )
+    np.add( hitIndices, self.RowNumbers( photonCount ), out=hitIndices )
+    return sampleOfHit, hitIndices
+
+
+class NumpyDatasetReader( EventRingSampler ):
+
+  # With MemoryMap, the data arrays are kept in files next to the input, and mapped read-only
+  #  rather than held in (private) process memory
+  # Compact halves the memory used for the hit data, and narrows the sampled photons (see above)
+  def __init__( self, InputDataset, MemoryMap=False, Compact=False, DetectedOnly=False ):
     self.inputDataset = InputDataset
     self.unusedEvents = None
     self.energyMin = InputDataset.energyMin
@@ -13,70 +169,126 @@ class NumpyDatasetReader:
     self.totalDecays = InputDataset.totalDecays
     self.eventHitsMax = InputDataset.eventHitsMax
     self.sampleStartIndex = 0
+    self.buffers = {}
 
-    # Allow for decays that weren't detected
-    self.unusedEvents = np.arange( self.totalDecays )
+    eventIndexType = np.int64
+    if Compact and self.totalDecays < np.iinfo( np.int32 ).max:
+      eventIndexType = np.int32
 
-    # Make a numpy array to hold the data - alternative approach to sampling
-    # NOTE: this is going to have a *lot* of zero-padding
-    # Might not be worth the trade for the numpy speedup
-    # Alternatively might need to use awkward arrays instead
-    self.numpyData = np.zeros( [self.totalDecays, self.eventHitsMax, DATASET_PHOTON_LENGTH] )
-    for eventIndex in self.inputDataset.inputData:
-      for photonIndex in range( len( self.inputDataset.inputData[ eventIndex ] ) ):
-        self.numpyData[ eventIndex, photonIndex, : ] = self.inputDataset.inputData[ eventIndex ][ photonIndex ]
+    # Re-use a memory-mapped copy of the data if there is one
+    # In that case the dataset doesn't need to have loaded the hits at all (see CreateDataset)
+    mappedArrays = None
+    if MemoryMap:
+      mappedArrays = LoadMemoryMaps( self.inputDataset, Compact )
 
-    # Finished loading, so clear the input data
-    self.inputDataset.inputData = None
+    if mappedArrays is not None:
+      self.hitData = mappedArrays[ "hitData" ]
+      self.moduleData = mappedArrays[ "moduleData" ]
+      self.eventOffsets = mappedArrays[ "eventOffsets" ]
+      self.derivedData = mappedArrays.get( "derivedData" )
+      if self.inputDataset.hitData is None:
+        self.eventHitsMax = int( np.max( np.diff( self.eventOffsets ), initial=0 ) )
 
+    else:
+      if self.inputDataset.hitData is None:
+        raise ValueError( "The hits from " + self.inputDataset.inputPath + " weren't loaded, and there is no memory-mapped copy of them" )
 
-  def SampleEventsAtTimes( self, Times, RNG=None ):
+      # Hit columns are already ordered by event
+      # Events with no hits (decays that weren't detected) just have an empty range
+      self.hitData = self.inputDataset.hitData
+      self.moduleData = self.inputDataset.moduleData
+      self.eventOffsets = self.inputDataset.eventOffsets
+      if self.eventOffsets is None:
+        eventIndices = self.hitData[ :, DATASET_EVENT ].astype( np.int64 )
+        self.eventOffsets = np.searchsorted( eventIndices, np.arange( self.totalDecays + 1 ) )
 
-    # This first part of the code simply asks if the batch can be filled
-    # If the batch is larger than the remaining events in the file,
-    #  recursively calls this method twice and combines results
-    # Note - won't work if the batch is larger than the whole file
-    firstBatchMax = len( self.unusedEvents ) - self.sampleStartIndex
-    if firstBatchMax < len( Times ):
+      # Derived columns are optional
+      self.derivedData = self.inputDataset.derivedData
+      if Compact:
+        self.hitData = self.hitData.astype( np.float32 )
+        if self.derivedData is not None:
+          self.derivedData = self.derivedData.astype( np.float32 )
 
-      # Get as many events as you can from the current sequence
-      firstPart = self.SampleEventsAtTimes( Times[:firstBatchMax] )
+      if MemoryMap:
+        storePaths = MemoryMapPaths( self.inputDataset, Compact )
+        self.hitData = MemoryMapArray( self.hitData, storePaths[ "hitData" ] )
+        self.moduleData = MemoryMapArray( self.moduleData, storePaths[ "moduleData" ] )
+        self.eventOffsets = MemoryMapArray( self.eventOffsets, storePaths[ "eventOffsets" ] )
+        if self.derivedData is not None:
+          self.derivedData = MemoryMapArray( self.derivedData, storePaths[ "derivedData" ] )
 
-      # Reshuffle
-      # Note it is a lot faster to shuffle this set of indices
-      #  than to shuffle the actual data
-      if RNG == None:
-        self.inputDataset.RNG.shuffle( self.unusedEvents )
-      else:
-        RNG.shuffle( self.unusedEvents )
-      self.sampleStartIndex = 0
+    # Allow for decays that weren't detected, unless only sampling the detected ones
+    if DetectedOnly:
+      self.unusedEvents = np.flatnonzero( np.diff( self.eventOffsets ) ).astype( eventIndexType )
+    else:
+      self.unusedEvents = np.arange( self.totalDecays, dtype=eventIndexType )
+    if len( self.unusedEvents ) == 0:
+      raise ValueError( "No events to sample from " + InputDataset.inputPath + ( " (no decays were detected)" if DetectedOnly else "" ) )
+    self.detectedFraction = len( self.unusedEvents ) / self.totalDecays
 
-      # Get remaining events
-      secondPart = self.SampleEventsAtTimes( Times[firstBatchMax:] )
+    # Photons are labelled with the pair geometry cache, if there is one
+    self.pairSource = -1
+    if self.inputDataset.pairGeometry is not None:
+      self.pairSource = self.inputDataset.pairGeometry.source
 
-      # Combine the two sets of events
-      return np.append( firstPart, secondPart, axis=0 )
+    # Compact photons stop after the module IDs, unless there is a cache or derived data for the later columns
+    self.photonLength = DATASET_PHOTON_LENGTH
+    if Compact and self.pairSource < 0 and self.derivedData is None:
+      self.photonLength = DATASET_COMPACT_PHOTON_LENGTH
 
-    # Choose the event indices that will be used for the batch
-    sampleIndices = self.unusedEvents[ self.sampleStartIndex : self.sampleStartIndex + len( Times ) ]
-    self.sampleStartIndex = self.sampleStartIndex + len( Times )
+    # Finished loading, so clear the input data
+    self.inputDataset.hitData = None
+    self.inputDataset.moduleData = None
+    self.inputDataset.derivedData = None
 
-    # Clone the event data corresponding to those indices
-    events = self.numpyData[ sampleIndices ].copy()
 
-    # Add the corresponding time offsets for each event
-    events[ :, :, DATASET_TIME ] += ( Times * 1e9 )[ :, np.newaxis ] # convert to ns, then broadcast
+  # Photons for an event at each time, flattened across events
+  # Each photon has photonLength columns (see Compact)
+  # Buffers may give a dictionary, kept by the caller between batches, for the photons to be written into
+  #  (see ScratchBuffer), otherwise a new array is returned
+  # The photons are then overwritten by the next call with the same Buffers
+  # With Samples, the index (into Times) of each photon's decay is returned too, in a scratch array overwritten by the next batch
+  def SampleEventsAtTimes( self, Times, RNG=None, Buffers=None, Samples=False ):
 
-    # Flatten across events to just give photons
-    events = events.reshape( len( Times ) * self.eventHitsMax, DATASET_PHOTON_LENGTH )
+    # Choose the event indices that will be used for the batch
+    batchSize = len( Times )
+    sampleIndices = self.NextEvents( batchSize, RNG )
+
+    # Find the range of hits belonging to each event
+    # Indices are always in range here, and take() would copy its output in the default (checking) mode
+    offsetType = self.eventOffsets.dtype
+    hitStarts = np.take( self.eventOffsets, sampleIndices, out=self.Buffer( "hitStarts", batchSize, offsetType ), mode="clip" )
+    nextEvents = np.add( sampleIndices, 1, out=self.Buffer( "nextEvents", batchSize, sampleIndices.dtype ) )
+    hitCounts = np.take( self.eventOffsets, nextEvents, out=self.Buffer( "hitCounts", batchSize, offsetType ), mode="clip" )
+    np.subtract( hitCounts, hitStarts, out=hitCounts )
+    sampleOfHit, hitIndices = self.HitIndices( hitStarts, hitCounts )
+    photonCount = len( hitIndices )
+
+    # Clone the hit data and module IDs, flattened across events to just give photons
+    if Buffers is None:
+      events = np.empty( [ photonCount, self.photonLength ] )
+    else:
+      events = ScratchBuffer( Buffers, "photons", photonCount, np.float64, self.photonLength )
+    events[ :, :DATASET_HIT_FIELDS ] = np.take( self.hitData, hitIndices, axis=0, out=self.Buffer( "hitData", photonCount, self.hitData.dtype, DATASET_HIT_FIELDS ), mode="clip" )
+    events[ :, DATASET_EVENT ] = np.take( sampleIndices, sampleOfHit, out=self.Buffer( "eventOfHit", photonCount, sampleIndices.dtype ), mode="clip" ) # exact, even if the stored event column is compact
+    events[ :, DATASET_HIT_FIELDS : DATASET_HIT_FIELDS + DATASET_MODULE_FIELDS ] = np.take( self.moduleData, hitIndices, axis=0, out=self.Buffer( "moduleData", photonCount, self.moduleData.dtype, DATASET_MODULE_FIELDS ), mode="clip" )
+    if self.photonLength == DATASET_PHOTON_LENGTH:
+      events[ :, DATASET_SOURCE ] = self.pairSource
+      events[ :, DATASET_HIT_INDEX ] = hitIndices
+      if self.derivedData is None:
+        events[ :, DATASET_X : DATASET_CRYSTAL_INDEX ] = np.nan
+        events[ :, DATASET_CRYSTAL_INDEX ] = -1
+      else:
+        events[ :, DATASET_X : DATASET_PHOTON_LENGTH ] = np.take( self.derivedData, hitIndices, axis=0, out=self.Buffer( "derivedData", photonCount, self.derivedData.dtype, DATASET_PHOTON_LENGTH - DATASET_X ), mode="clip" )
 
-    # Remove zero-padding
-    events = events[ events[:,DATASET_ENERGY] > 0.0 ]
+    # Add the corresponding time offsets for each event
+    timeOffsets = np.take( Times, sampleOfHit, out=self.Buffer( "timeOffsets", photonCount, np.float64 ), mode="clip" )
+    timeOffsets *= 1e9 # convert to ns
+    events[ :, DATASET_TIME ] += timeOffsets
+    if Samples:
+      return events, sampleOfHit
     return( events )
 
 
   def size( self ):
     return self.totalDecays
-
-  def GetModuleIDs( self ):
-    return self.inputDataset.moduleMap
@@ -0,0 +1,196 @@
+# Share loaded datasets between processes, for multiprocessing sweeps
+# The parent process loads each dataset once and copies its arrays into named shared memory blocks
+# Pool workers (fork or spawn) then attach to the blocks by name, and get a NumpyDatasetReader
+#  whose arrays are views of the shared memory, so nothing is parsed or copied again
+#
+# Typical use:
+#   with SharedDatasetServer() as server:
+#     tracerHandle = server.Load( "tracer", 1024, "SiemensCrystal", 700, "LinearF18", nevents, Emin, Emax, "LSO" )
+#     with Pool( processes=processes ) as p:
+#       p.starmap( OneActivity, [ ( tracerHandle, activity ) for activity in activities ] )
+#
+#   def OneActivity( TracerHandle, Activity ):
+#     tracerData = AttachDataset( TracerHandle )
+#     ...
+#
+# Each worker keeps its own sampling state (event order), only the hit data is shared
+
+import os
+import sys
+import itertools
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+import SimulationDataset as sd
+import NumpyDatasetReader as ndr
+
+# Reader arrays that are shared, if present
+SHARED_FIELDS = [ "hitData", "moduleData", "eventOffsets", "derivedData" ]
+
+
+# Everything a worker needs to rebuild a reader: picklable, so it can be passed to Pool tasks
+class SharedDatasetHandle:
+
+  def __init__( self, Key, Reader ):
+    self.key = Key
+    self.totalDecays = Reader.totalDecays
+    self.energyMin = Reader.energyMin
+    self.energyMax = Reader.energyMax
+    self.eventHitsMax = Reader.eventHitsMax
+    self.photonLength = Reader.photonLength
+    self.inputPath = Reader.inputDataset.inputPath
+    self.arrays = {} # field name: ( block name, shape, dtype )
+
+
+# Stands in for the SimulationDataset when a worker creates its reader
+class SharedDatasetView:
+
+  def __init__( self, Handle, Arrays, RNG ):
+    self.inputPath = Handle.inputPath
+    self.energyMin = Handle.energyMin
+    self.energyMax = Handle.energyMax
+    self.totalDecays = Handle.totalDecays
+    self.eventHitsMax = Handle.eventHitsMax
+    self.hitData = Arrays[ "hitData" ]
+    self.moduleData = Arrays[ "moduleData" ]
+    self.eventOffsets = Arrays[ "eventOffsets" ]
+    self.derivedData = Arrays.get( "derivedData" )
+    self.pairGeometry = None # the cache is per-process, see PairGeometry
+    self.RNG = RNG
+    if self.RNG is None:
+      self.RNG = np.random.default_rng()
+
+
+# Owns the shared memory: create in the parent process, and keep it open while the workers run
+# Datasets are reference-counted by key: loading or sharing the same key again re-uses the existing blocks,
+#  and the blocks are removed when every reference has been released (or the server is closed)
+class SharedDatasetServer:
+
+  blockCounter = itertools.count()
+
+  def __init__( self ):
+    self.datasets = {} # key: [ handle, memory blocks, reference count ]
+
+  def __enter__( self ):
+    return self
+
+  def __exit__( self, *args ):
+    self.Close()
+
+  def __del__( self ):
+    self.Close()
+
+
+  # Load a dataset with CreateDataset (arguments as for that method), unless it is already shared
+  def Load( self, Key, *args, **kwargs ):
+    if Key in self.datasets:
+      self.datasets[ Key ][ 2 ] += 1
+      return self.datasets[ Key ][ 0 ]
+
+    kwargs[ "UseNumpy" ] = True
+    kwargs[ "MemoryMap" ] = False
+    reader = sd.CreateDataset( *args, **kwargs )
+    if reader is None:
+      return None
+    return self.Share( Key, reader )
+
+
+  # Copy the arrays of an existing NumpyDatasetReader into shared memory
+  def Share( self, Key, Reader ):
+    if Key in self.datasets:
+      self.datasets[ Key ][ 2 ] += 1
+      return self.datasets[ Key ][ 0 ]
+
+    handle = SharedDatasetHandle( Key, Reader )
+    blocks = []
+    try:
+      for field in SHARED_FIELDS:
+        array = getattr( Reader, field )
+        if array is None:
+          continue
+        blockName = "spet" + str( os.getpid() ) + "_" + str( next( SharedDatasetServer.blockCounter ) )
+        block = shared_memory.SharedMemory( name=blockName, create=True, size=max( array.nbytes, 1 ) )
+        blocks.append( block )
+        np.ndarray( array.shape, dtype=array.dtype, buffer=block.buf )[...] = array
+        handle.arrays[ field ] = ( blockName, array.shape, array.dtype.str )
+    except Exception:
+      for block in blocks:
+        block.close()
+        block.unlink()
+      raise
+
+    self.datasets[ Key ] = [ handle, blocks, 1 ]
+    return handle
+
+
+  def Release( self, Key ):
+    if Key not in self.datasets:
+      return
+    self.datasets[ Key ][ 2 ] -= 1
+    if self.datasets[ Key ][ 2 ] <= 0:
+      for block in self.datasets.pop( Key )[ 1 ]:
+        block.close()
+        block.unlink()
+
+
+  def Close( self ):
+    for key in list( self.datasets ):
+      self.datasets[ key ][ 2 ] = 0
+      self.Release( key )
+
+
+# Datasets attached in this process: key: [ reader, memory blocks, reference count ]
+attachedDatasets = {}
+
+
+# Open an existing block without registering it with the resource tracker
+# Before Python 3.13 attaching also registers the block, and the tracker would then remove it
+#  when this process exits, even though the server still owns it
+def AttachSharedMemory( BlockName ):
+  if sys.version_info >= ( 3, 13 ):
+    return shared_memory.SharedMemory( name=BlockName, track=False )
+
+  register = resource_tracker.register
+  resource_tracker.register = lambda *args: None
+  try:
+    return shared_memory.SharedMemory( name=BlockName )
+  finally:
+    resource_tracker.register = register
+
+
+# Get a reader for a shared dataset, attaching to its memory if this process hasn't already
+# Call DetachDataset with the same handle when finished
+# DetectedOnly is passed to the reader (see NumpyDatasetReader), when it is first attached
+def AttachDataset( Handle, RNG=None, DetectedOnly=False ):
+  if Handle.key in attachedDatasets:
+    attachedDatasets[ Handle.key ][ 2 ] += 1
+    return attachedDatasets[ Handle.key ][ 0 ]
+
+  blocks = []
+  arrays = {}
+  for field, ( blockName, shape, dtype ) in Handle.arrays.items():
+    block = AttachSharedMemory( blockName )
+    blocks.append( block )
+    array = np.ndarray( shape, dtype=np.dtype( dtype ), buffer=block.buf )
+    array.flags.writeable = False
+    arrays[ field ] = array
+
+  reader = ndr.NumpyDatasetReader( SharedDatasetView( Handle, arrays, RNG ), DetectedOnly=DetectedOnly )
+  reader.photonLength = Handle.photonLength # as for the shared reader, e.g. if it was compact
+  attachedDatasets[ Handle.key ] = [ reader, blocks, 1 ]
+  return reader
+
+
+def DetachDataset( Handle ):
+  if Handle.key not in attachedDatasets:
+    return
+  attachedDatasets[ Handle.key ][ 2 ] -= 1
+  if attachedDatasets[ Handle.key ][ 2 ] <= 0:
+    reader, blocks, _ = attachedDatasets.pop( Handle.key )
+
+    # The arrays must go before the memory underneath them
+    reader.hitData = None
+    reader.moduleData = None
+    reader.eventOffsets = None
+    reader.derivedData = None
+    for block in blocks:
+      block.close()
@@ -9,9 +9,8 @@ from SimulationDataset import *
 import PhysicsConstants as pc
 import math
 from array import array
-import sys
-sys.path.append('../analysis/')
-from SinogramTools import *
+import multiprocessing as mp
+import SharedDatasetServer as sds
 
 import matplotlib.pyplot as mpl
 params = {'legend.fontsize': 15,
@@ -130,30 +129,30 @@ def CalcCSR(projectionShifted):
     #return total S+R counts
     return totCSRoutsideStrip + totCSRinsideStrip
 
-def CountRatePerformanceData(detectorMaterial, nevents, Emin, Emax, detectorLength, phantomLength) :
+#the hits are memory-mapped from files next to the datasets, so later runs (and other processes) share one copy
+#without the pair geometry cache (which only helps in this process) a later run doesn't read the hit files at all
+def CountRatePerformanceData(detectorMaterial, nevents, Emin, Emax, detectorLength, phantomLength, energyResolution=None, pairGeometry=True) :
 
-    tracerData = CreateDataset( detectorLength, "SiemensCrystal", phantomLength, "LinearF18", nevents, Emin, Emax, detectorMaterial, SourceOffset=45, UseNumpy=True )
+    tracerData = CreateDataset( detectorLength, "SiemensCrystal", phantomLength, "LinearF18", nevents, Emin, Emax, detectorMaterial, SourceOffset=45, UseNumpy=True, MemoryMap=True, CachePairGeometry=pairGeometry, DerivedColumns=True, EnergyResolution=energyResolution, DetectedOnly=True )
     crystalData = None
     crystalActivity = None
     activityList = []
     dataList = []
-    moduleIDs = tracerData.GetModuleIDs()
 
     # calculate crystalActivity and add it to the activityList only if the crystal material is radioactive
     if detectorMaterial == "LSO" or detectorMaterial == "LYSO" :
         crystalActivity= sqp.Lu176decaysInMass( sqp.DetectorMassLength( detectorLength, detectorMaterial ) )
-        crystalData = CreateDataset( detectorLength, "SiemensCrystal", phantomLength, "Siemens", nevents, Emin, Emax, detectorMaterial, UseNumpy=True )
+        crystalData = CreateDataset( detectorLength, "SiemensCrystal", phantomLength, "Siemens", nevents, Emin, Emax, detectorMaterial, UseNumpy=True, MemoryMap=True, CachePairGeometry=pairGeometry, DerivedColumns=True, EnergyResolution=energyResolution, DetectedOnly=True )
         activityList = [0.0, crystalActivity]
         dataList = [tracerData, crystalData]
-        moduleIDs.update( crystalData.GetModuleIDs() )
     else :
         activityList = [0.0]
         dataList = [tracerData]
 
-    return activityList, dataList, moduleIDs
+    return activityList, dataList
 
 # apply the coincidence selection (central slices, minSectorDiff cut or deltaPhi) and fill in sinograms
-def SelectAndFill(pair, moduleIDs, Nsectors, sinogram, profile) :
+def SelectAndFill(pair, Nsectors, sinogram, profile) :
     #only slices within the central 650 mm are used 
     zmin = -325 #mm
     zmax = 325 #mm
@@ -163,17 +162,9 @@ def SelectAndFill(pair, moduleIDs, Nsectors, sinogram, profile) :
     if zmean > zmax or zmean < zmin :
         return
                         
-    photon1GP = (pair[0][DATASET_R], pair[0][DATASET_PHI], pair[0][DATASET_Z])
-    module1ID = moduleIDs[photon1GP]
-    photon2GP = (pair[1][DATASET_R], pair[1][DATASET_PHI], pair[1][DATASET_Z])
-    module2ID = moduleIDs[photon2GP]
-    sectorDiff1 = module1ID[1] - module2ID[1]
-    if sectorDiff1<0:
-        sectorDiff1 += Nsectors
-    sectorDiff2 = module2ID[1] - module1ID[1]
-    if sectorDiff2<0:
-        sectorDiff2 += Nsectors
-    sectorDiff = min(sectorDiff1,sectorDiff2)
+    #sector (block) IDs are carried in each photon
+    sectorDiff = np.absolute(pair[0][DATASET_BLOCK] - pair[1][DATASET_BLOCK])
+    sectorDiff = min(sectorDiff, Nsectors - sectorDiff)
     if sectorDiff < 4:
         return
 
@@ -182,13 +173,15 @@ def SelectAndFill(pair, moduleIDs, Nsectors, sinogram, profile) :
     # if deltaPhi < 0.66 :
     #     continue
 
-    sinogramS, sinogramTheta = CalcSinogramCoords(pair)
+    sinogramS, sinogramTheta = SinogramCoords(pair)
 
     #fill in sinogram
     sinogram.Fill(sinogramS, sinogramTheta)
     profile.Fill(sinogramS, sinogramS)
 
-def CountRatePerformance(generator, simulationWindow, PairMode, ModuleIDs, Nsectors, activity):
+#sinograms and profiles for one count rate measurement
+#the suffix keeps the histogram names unique when several measurements are filled at once
+def CountRateHistograms(suffix=""):
 
     nbinsx = 250
     nbinsy = 380
@@ -196,52 +189,83 @@ def CountRatePerformance(generator, simulationWindow, PairMode, ModuleIDs, Nsect
     xmax = 410.
 
     #original unshifted sinogram 
-    sinogram = TH2F("sinogram", "; Projection displacement [mm]; Projection angle [rad]; Events", nbinsx, xmin, xmax, nbinsy, 0, 3.14)
+    sinogram = TH2F("sinogram"+suffix, "; Projection displacement [mm]; Projection angle [rad]; Events", nbinsx, xmin, xmax, nbinsy, 0, 3.14)
     #shifted sinogram needed for NECR calculation
-    sinogramShifted = TH2F("sinogramShifted", "; Projection displacement [mm]; Projection angle [rad]; Events", nbinsx, xmin, xmax, nbinsy, 0, 3.14)
+    sinogramShifted = TH2F("sinogramShifted"+suffix, "; Projection displacement [mm]; Projection angle [rad]; Events", nbinsx, xmin, xmax, nbinsy, 0, 3.14)
     #profile needed to set all pixels further than 12cm from the centre to zero
-    profile = TProfile("profile", "profile", nbinsx, xmin, xmax)
+    profile = TProfile("profile"+suffix, "profile", nbinsx, xmin, xmax)
     #sinogram and profile for delayed coincidences
-    sinogramDelayed = TH2F("sinogramDelayed", "; Projection displacement [mm]; Projection angle [rad]; Events", nbinsx, xmin, xmax, nbinsy, 0, 3.14)
-    profileDelayed = TProfile("profileDelayed", "profileDelayed", nbinsx, xmin, xmax)
+    sinogramDelayed = TH2F("sinogramDelayed"+suffix, "; Projection displacement [mm]; Projection angle [rad]; Events", nbinsx, xmin, xmax, nbinsy, 0, 3.14)
+    profileDelayed = TProfile("profileDelayed"+suffix, "profileDelayed", nbinsx, xmin, xmax)
+
+    return sinogram, sinogramShifted, profile, sinogramDelayed, profileDelayed
+
+#fill the histograms from one prompt and delayed coincidence window
+def FillCountRateHistograms(histograms, promptCoincidences, delayedCoincidences, PairMode, Nsectors):
+
+    sinogram, sinogramShifted, profile, sinogramDelayed, profileDelayed = histograms
 
     if PairMode == "Exclusive":
-        for promptCoincidences, delayedCoincidences in generator :
-            #First, deal with prompts
-            if IsTwoHitEvent(promptCoincidences) == True:
-                SelectAndFill(promptCoincidences, ModuleIDs, Nsectors, sinogram, profile)
-            #Now the same for delayed
-            if IsTwoHitEvent(delayedCoincidences) == True:
-                SelectAndFill(delayedCoincidences, ModuleIDs, Nsectors, sinogramDelayed, profileDelayed)
+        #First, deal with prompts
+        if IsTwoHitEvent(promptCoincidences) == True:
+            SelectAndFill(promptCoincidences, Nsectors, sinogram, profile)
+        #Now the same for delayed
+        if IsTwoHitEvent(delayedCoincidences) == True:
+            SelectAndFill(delayedCoincidences, Nsectors, sinogramDelayed, profileDelayed)
 
     elif PairMode == "TakeAllGoods":
 
-        for promptCoincidences, delayedCoincidences in generator :
+        #First, deal with prompts
+        if len(promptCoincidences > 1):
+            firstPhoton = promptCoincidences[0]
+            for secondPhotonIndex in range( 1, len( promptCoincidences ) ):
+                pair = [ firstPhoton, promptCoincidences[secondPhotonIndex] ]
 
-            #First, deal with prompts
-            if len(promptCoincidences > 1):
-                firstPhoton = promptCoincidences[0]
-                for secondPhotonIndex in range( 1, len( promptCoincidences ) ):
-                    pair = [ firstPhoton, promptCoincidences[secondPhotonIndex] ]
+                # Now just repeat the "Exclusive" calculation
+                if IsTwoHitEvent(pair) == True:
+                    SelectAndFill(pair, Nsectors, sinogram, profile)
 
-                    # Now just repeat the "Exclusive" calculation
-                    if IsTwoHitEvent(pair) == True:
-                        SelectAndFill(pair, ModuleIDs, Nsectors, sinogram, profile)
+        #Now do the same for delayed
+        if len(delayedCoincidences > 1):
+            firstPhoton = delayedCoincidences[0]
+            for secondPhotonIndex in range( 1, len( delayedCoincidences ) ):
+                pair = [ firstPhoton, delayedCoincidences[secondPhotonIndex] ]
 
-            #Now do the same for delayed
-            if len(delayedCoincidences > 1):
-                firstPhoton = delayedCoincidences[0]
-                for secondPhotonIndex in range( 1, len( delayedCoincidences ) ):
-                    pair = [ firstPhoton, delayedCoincidences[secondPhotonIndex] ]
+                # Now just repeat the "Exclusive" calculation
+                if IsTwoHitEvent(pair) == True:
+                    SelectAndFill(pair, Nsectors, sinogramDelayed, profileDelayed)
 
-                    # Now just repeat the "Exclusive" calculation
-                    if IsTwoHitEvent(pair) == True:
-                        SelectAndFill(pair, ModuleIDs, Nsectors, sinogramDelayed, profileDelayed)
+def CountRatePerformance(generator, simulationWindow, PairMode, Nsectors, activity):
 
-    else :
+    if PairMode != "Exclusive" and PairMode != "TakeAllGoods" :
         print("Unrecognised coincidence pairing mode: ", PairMode)
         return
 
+    histograms = CountRateHistograms()
+    for promptCoincidences, delayedCoincidences in generator :
+        FillCountRateHistograms(histograms, promptCoincidences, delayedCoincidences, PairMode, Nsectors)
+
+    return CountRateResults(histograms, simulationWindow, activity)
+
+#one independent count rate measurement in a worker process
+#the datasets are attached from the shared copies made by the parent process (see SharedDatasetServer)
+def CountRatePerformanceWorker(dataHandles, activityList, seed, simulationWindow, coincidenceWindow, multiWindow, energyResolution, Emin, Emax, timeResolution, continuousTimes, delay, PairMode, Nsectors):
+
+    dataList = [ sds.AttachDataset(handle, DetectedOnly=True) for handle in dataHandles ]
+    generator = cg.GenerateCoincidences( BATCH_SIZE, activityList, dataList, np.random.default_rng(seed), coincidenceWindow, simulationWindow, multiWindow, energyResolution, Emin, Emax, timeResolution, continuousTimes, delay )
+    result = CountRatePerformance(generator, simulationWindow, PairMode, Nsectors, activityList[0])
+
+    for handle in dataHandles :
+        sds.DetachDataset(handle)
+    return result
+
+#rates and NECR from the filled histograms
+def CountRateResults(histograms, simulationWindow, activity):
+
+    sinogram, sinogramShifted, profile, sinogramDelayed, profileDelayed = histograms
+    nbinsx = sinogram.GetNbinsX()
+    nbinsy = sinogram.GetNbinsY()
+
     # canv = TCanvas("canv", "canv", 800, 600)
     # sinogram.Draw("colz")
     # print("Sinogram entries = ", sinogram.GetEntries())
@@ -346,6 +370,13 @@ def main() :
     timeResolution = 0.0
     continuousTimes = True
     multiWindow = False
+    #how the points of the count rate curve are simulated:
+    #"Independent" - a separate acquisition at each activity
+    #"Framed" - one acquisition following the decay curve, with a frame at each activity
+    #"Sweep" - one stream at the highest activity, thinned for each of the others
+    curveMethod = "Independent"
+    #independent acquisitions can be run in parallel, with the processes sharing one copy of the datasets
+    processes = 1
 
     NECRs = []
     RTOTs = []
@@ -358,22 +389,68 @@ def main() :
     phantomVolume = phantomRadius * phantomRadius * math.pi * phantomLength / 10.0
 
 
-    activityList, dataList, moduleIDsTable = CountRatePerformanceData(detectorMaterial, nevents, Emin, Emax, detectorLength, phantomLength)
+    parallel = curveMethod == "Independent" and processes > 1
+    activityList, dataList = CountRatePerformanceData(detectorMaterial, nevents, Emin, Emax, detectorLength, phantomLength, energyResolution, pairGeometry=not parallel)
 
-    modIDs = moduleIDsTable.values()
     #needed for minSectorDifference calculation
-    sectorMax = max({sector[1] for sector in modIDs})
-    nsectors = sectorMax + 1 
+    nsectors = sqp.BlocksPerRing()
+
+    #activities every 20 minutes along the decay curve
+    frameTimes = 60.0*np.arange(0, 700, 20)
+    tracerActivity = lambda tsec : pc.TracerActivityAtTime( startingActivity, tsec, "F18" )
+    results = []
 
-    for t in range(0, 700, 20):
-        tsec = 60*t
-        activity = pc.TracerActivityAtTime( startingActivity, tsec, "F18" )
-        activityList[0] = activity
+    if parallel :
+        #each acquisition has its own random seed, drawn in order so the results are reproducible
+        pointActivities = [ tracerActivity( tsec ) for tsec in frameTimes ]
+        seeds = RNG.integers( np.iinfo(np.int64).max, size=len(frameTimes) )
 
-        generator = cg.GenerateCoincidences( BATCH_SIZE, activityList, dataList, RNG, coincidenceWindow, simulationWindow, multiWindow, energyResolution, Emin, Emax, timeResolution, continuousTimes, delay ) 
+        #the workers are started fresh (spawn) and attach to the datasets by name, rather than loading them again
+        with sds.SharedDatasetServer() as server :
+            dataHandles = [ server.Share( "dataset"+str(i), data ) for i, data in enumerate(dataList) ]
+            tasks = [ (dataHandles, [activity] + activityList[1:], seed, simulationWindow, coincidenceWindow, multiWindow, energyResolution, Emin, Emax, timeResolution, continuousTimes, delay, PairMode, nsectors) for activity, seed in zip(pointActivities, seeds) ]
+            with mp.get_context("spawn").Pool(processes=processes) as pool :
+                results = list( zip( pointActivities, pool.starmap(CountRatePerformanceWorker, tasks) ) )
 
-        RTOTatTime, RsrAtTime, RtAtTime, RrAtTime, RsAtTime, NECRAtTime = CountRatePerformance(generator, simulationWindow, PairMode, moduleIDsTable, nsectors, activity)
+    elif curveMethod == "Independent" :
+        for tsec in frameTimes :
+            activity = tracerActivity( tsec )
+            activityList[0] = activity
+
+            generator = cg.GenerateCoincidences( BATCH_SIZE, activityList, dataList, RNG, coincidenceWindow, simulationWindow, multiWindow, energyResolution, Emin, Emax, timeResolution, continuousTimes, delay )
+
+            results.append( (activity, CountRatePerformance(generator, simulationWindow, PairMode, nsectors, activity)) )
+
+    elif curveMethod == "Framed" :
+        #a frame of simulationWindow at each time, each followed by a gap where its windows are dropped
+        #the gap is longer than a window and its delayed window, so no frame has windows running on into the next
+        frameGap = 10.0*(coincidenceWindow + delay) #ns
+        activityList[0] = cg.FramedRateFunction( tracerActivity, frameTimes, simulationWindow*1E-9, frameGap*1E-9 )
+
+        generator = cg.GenerateCoincidences( BATCH_SIZE, activityList, dataList, RNG, coincidenceWindow, (simulationWindow + frameGap)*len(frameTimes), multiWindow, energyResolution, Emin, Emax, timeResolution, continuousTimes, delay )
+
+        for frame, frameGenerator in cg.SplitFrames( generator, simulationWindow, frameGap ):
+            activity = tracerActivity( frameTimes[frame] )
+            results.append( (activity, CountRatePerformance(frameGenerator, simulationWindow, PairMode, nsectors, activity)) )
+
+    elif curveMethod == "Sweep" :
+        #the crystal activity is the same for all points
+        tracerActivities = tracerActivity( frameTimes )
+        histograms = [ CountRateHistograms("_"+str(point)) for point in range(len(frameTimes)) ]
+
+        generator = cg.GenerateActivitySweep( BATCH_SIZE, tracerActivities, activityList, dataList, RNG, coincidenceWindow, simulationWindow, multiWindow, energyResolution, Emin, Emax, timeResolution, continuousTimes, delay )
+
+        for point, (promptCoincidences, delayedCoincidences) in generator :
+            FillCountRateHistograms(histograms[point], promptCoincidences, delayedCoincidences, PairMode, nsectors)
+
+        for point in range(len(frameTimes)) :
+            results.append( (tracerActivities[point], CountRateResults(histograms[point], simulationWindow, tracerActivities[point])) )
+
+    else :
+        print("Unrecognised count rate curve method: ", curveMethod)
+        return
 
+    for activity, (RTOTatTime, RsrAtTime, RtAtTime, RrAtTime, RsAtTime, NECRAtTime) in results :
         NECRs.append(NECRAtTime*cps2Mcps)
         RTOTs.append(RTOTatTime*cps2Mcps)
         Rss.append(RsAtTime*cps2Mcps)
@@ -5,6 +5,12 @@ import PhysicsConstants as PC
 def DetectorRadius():
   return 400 # 82cm radius - 1cm crystal half-depth. Maybe 82 should be inner radius and need to adjust simulation?
 
+def BlocksPerRing():
+  return 38
+
+def CrystalsPerBlock():
+  return 200
+
 def CrystalVolume():
   return 0.32 * 0.32 * 2.0
 
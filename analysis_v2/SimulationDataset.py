@@ -1,23 +1,218 @@
 # File format defined in EnergyCounter.cpp:
 # EventID ModuleID[xN] Energy Time R Phi Z
+# or the same quantities as fixed-size binary records (see BINARY_HIT_DTYPE)
 
 # Only define positions for main quantities
-DATASET_EVENT, DATASET_ENERGY, DATASET_TIME, DATASET_R, DATASET_PHI, DATASET_Z, DATASET_PHOTON_LENGTH = 0, 1, 2, 3, 4, 5, 6
+DATASET_EVENT, DATASET_ENERGY, DATASET_TIME, DATASET_R, DATASET_PHI, DATASET_Z, DATASET_HIT_FIELDS = 0, 1, 2, 3, 4, 5, 6
+
+# Module IDs follow the main quantities in each photon, padded with -1 if the file has fewer fields
+# Crystal geometries give ring, block and crystal-in-block, other geometries just a single volume ID
+DATASET_MODULE_FIELDS = 3
+DATASET_RING, DATASET_BLOCK, DATASET_CRYSTAL = 6, 7, 8
+
+# Then the origin of the photon: which PairGeometry cache (-1 if none), and the hit row within that dataset
+DATASET_SOURCE, DATASET_HIT_INDEX = 9, 10
+
+# Optional derived quantities, calculated once per hit when loading (see DerivedColumns)
+# Without them, X and Y are NaN and the crystal index is -1
+DATASET_DERIVED_FIELDS = 3
+DATASET_X, DATASET_Y, DATASET_CRYSTAL_INDEX, DATASET_PHOTON_LENGTH = 11, 12, 13, 14
+
+# Compact readers leave out the origin and derived columns when they would only hold placeholders,
+#  so their photons stop after the module IDs (code using those columns must check the photon length)
+DATASET_COMPACT_PHOTON_LENGTH = DATASET_SOURCE
 
 
 import math
 import subprocess
 import os
+import io
+import multiprocessing
+import weakref
+import shutil
+import gzip
+import lzma
 import numpy as np
+import SiemensQuadraProperties as sqp
+
+
+# Hit files may be compressed, with one of these suffixes added to the usual name
+COMPRESSED_SUFFIXES = [ ".gz", ".zst", ".xz" ]
+
+# Command-line decompressors for each suffix, in order of preference
+# These run in a separate process, so decompression happens alongside parsing (and xz can use several threads)
+DECOMPRESS_COMMANDS = { ".gz": [ [ "pigz", "-dc" ], [ "gzip", "-dc" ] ],
+                        ".zst": [ [ "zstd", "-dcq" ] ],
+                        ".xz": [ [ "xz", "-dc", "-T0" ] ] }
+
+
+# Find a hit file, or a compressed version of it
+# Returns the path that exists, or None
+def FindHitFile( InputPath ):
+  if os.path.exists( InputPath ):
+    return InputPath
+  for suffix in COMPRESSED_SUFFIXES:
+    if os.path.exists( InputPath + suffix ):
+      return InputPath + suffix
+  return None
+
+
+def IsCompressed( InputPath ):
+  return os.path.splitext( InputPath )[1] in COMPRESSED_SUFFIXES
+
+
+# Open a hit file for buffered reading (binary mode), decompressing on the fly if necessary
+def OpenHitFile( InputPath ):
+
+  suffix = os.path.splitext( InputPath )[1]
+  if suffix not in COMPRESSED_SUFFIXES:
+    return open( InputPath, "rb" )
+
+  # Prefer an external decompressor
+  for command in DECOMPRESS_COMMANDS[ suffix ]:
+    if shutil.which( command[0] ) is not None:
+      return io.BufferedReader( DecompressPipe( command, InputPath ) )
+
+  # Otherwise decompress in this process
+  if suffix == ".gz":
+    return gzip.open( InputPath, "rb" )
+  elif suffix == ".xz":
+    return lzma.open( InputPath, "rb" )
+  else:
+    try:
+      import zstandard
+    except ImportError:
+      raise RuntimeError( "Reading " + InputPath + " needs either the zstd command or the zstandard python module" )
+    return zstandard.open( InputPath, "rb" )
+
+
+# Read-only file object for the output of a decompression command
+class DecompressPipe( io.RawIOBase ):
+
+  def __init__( self, Command, InputPath ):
+    self.inputPath = InputPath
+    self.finished = False
+    self.process = subprocess.Popen( Command + [ InputPath ], stdout=subprocess.PIPE )
+
+  def readable( self ):
+    return True
+
+  def readinto( self, Buffer ):
+    byteCount = self.process.stdout.readinto( Buffer )
+    if byteCount == 0:
+      self.finished = True
+    return byteCount
+
+  def close( self ):
+    if self.closed:
+      return
+    self.process.stdout.close()
+    returnCode = self.process.wait()
+    super().close()
+
+    # If reading stopped early the decompressor just sees a broken pipe, which isn't an error
+    if self.finished and returnCode != 0:
+      raise RuntimeError( "Decompression of " + self.inputPath + " failed with return code " + str( returnCode ) )
+
+
+# Binary hit files (EnergyCounter with --binaryOutput): a short header, then one fixed-size record per hit
+# The layout matches BinaryHitRecord in EnergyCounter.h, and is little-endian
+BINARY_HIT_MAGIC = b"SPETHITS"
+BINARY_HIT_VERSION = 1
+BINARY_HIT_HEADER = np.dtype( [ ( "magic", "S8" ), ( "version", "<i4" ), ( "recordSize", "<i4" ) ] )
+BINARY_HIT_DTYPE = np.dtype( [ ( "event", "<i8" ), ( "moduleIDs", "<i4", ( DATASET_MODULE_FIELDS, ) ), ( "moduleFields", "<i4" ),
+                               ( "energy", "<f8" ), ( "time", "<f8" ), ( "r", "<f8" ), ( "phi", "<f8" ), ( "z", "<f8" ) ] )
+
+
+# Checked from the first few bytes, which are decompressed in this process (see ReadHitFileStart)
+def IsBinaryHitFile( InputPath ):
+  return ReadHitFileStart( InputPath, len( BINARY_HIT_MAGIC ) ) == BINARY_HIT_MAGIC
+
+
+# The first ByteCount bytes of a hit file, decompressed if necessary
+# Only a little needs decompressing, so this avoids starting an external decompressor (see OpenHitFile) where possible
+def ReadHitFileStart( InputPath, ByteCount ):
+  suffix = os.path.splitext( InputPath )[1]
+  if suffix not in COMPRESSED_SUFFIXES:
+    inputFile = open( InputPath, "rb" )
+  elif suffix == ".gz":
+    inputFile = gzip.open( InputPath, "rb" )
+  elif suffix == ".xz":
+    inputFile = lzma.open( InputPath, "rb" )
+  else:
+    try:
+      import zstandard
+      inputFile = zstandard.open( InputPath, "rb" )
+    except ImportError:
+      inputFile = OpenHitFile( InputPath ) # the zstd command
+  with inputFile:
+    return inputFile.read( ByteCount )
+
+
+def CheckBinaryHitHeader( HeaderBytes, InputPath ):
+  if len( HeaderBytes ) < BINARY_HIT_HEADER.itemsize:
+    raise RuntimeError( "Binary hit file " + InputPath + " has no header" )
+  header = np.frombuffer( HeaderBytes, dtype=BINARY_HIT_HEADER, count=1 )[0]
+  if header[ "magic" ] != BINARY_HIT_MAGIC or header[ "version" ] != BINARY_HIT_VERSION or header[ "recordSize" ] != BINARY_HIT_DTYPE.itemsize:
+    raise RuntimeError( "Unsupported binary hit file " + InputPath + ": version " + str( header[ "version" ] ) + ", record size " + str( header[ "recordSize" ] ) )
+
+
+# Read-only view of the records in an (uncompressed) binary hit file, mapped rather than read into memory
+def ReadBinaryHits( InputPath ):
+  with open( InputPath, "rb" ) as inputFile:
+    CheckBinaryHitHeader( inputFile.read( BINARY_HIT_HEADER.itemsize ), InputPath )
+
+  # A partial record at the end means the simulation stopped while writing
+  recordBytes = os.path.getsize( InputPath ) - BINARY_HIT_HEADER.itemsize
+  recordCount = recordBytes // BINARY_HIT_DTYPE.itemsize
+  if recordBytes % BINARY_HIT_DTYPE.itemsize:
+    print( "Ignoring incomplete record at the end of " + InputPath )
+  if recordCount == 0:
+    return np.empty( 0, dtype=BINARY_HIT_DTYPE )
+  return np.memmap( InputPath, dtype=BINARY_HIT_DTYPE, mode="r", offset=BINARY_HIT_HEADER.itemsize, shape=( recordCount, ) )
+
+
+# Records from a binary hit file in blocks of BlockHits, which may split events
+def BinaryHitRecords( InputPath, BlockHits ):
+
+  if not IsCompressed( InputPath ):
+    records = ReadBinaryHits( InputPath )
+    for start in range( 0, len( records ), BlockHits ):
+      yield records[ start : start + BlockHits ]
+    return
+
+  # Compressed files have to be streamed
+  with OpenHitFile( InputPath ) as inputFile:
+    CheckBinaryHitHeader( inputFile.read( BINARY_HIT_HEADER.itemsize ), InputPath )
+    while True:
+      rawRecords = inputFile.read( BlockHits * BINARY_HIT_DTYPE.itemsize )
+      recordCount = len( rawRecords ) // BINARY_HIT_DTYPE.itemsize
+      if len( rawRecords ) % BINARY_HIT_DTYPE.itemsize:
+        print( "Ignoring incomplete record at the end of " + InputPath )
+      if recordCount == 0:
+        break
+      yield np.frombuffer( rawRecords, dtype=BINARY_HIT_DTYPE, count=recordCount )
+
+
+# Convert binary records to the hit and module ID columns given by ParseHitColumns
+def BinaryHitColumns( Records ):
+  hitData = np.empty( [ len( Records ), DATASET_HIT_FIELDS ] )
+  hitData[ :, DATASET_EVENT ] = Records[ "event" ]
+  hitData[ :, DATASET_ENERGY ] = Records[ "energy" ]
+  hitData[ :, DATASET_TIME ] = Records[ "time" ]
+  hitData[ :, DATASET_R ] = Records[ "r" ]
+  hitData[ :, DATASET_PHI ] = Records[ "phi" ]
+  hitData[ :, DATASET_Z ] = Records[ "z" ]
+  moduleData = np.array( Records[ "moduleIDs" ], dtype=np.int32 )
+  return hitData, moduleData
 
 
 class CsvFileReader:
 
   def __init__( self, InputPath ):
-    self.inputFile = open( InputPath )
+    self.inputFile = io.TextIOWrapper( OpenHitFile( InputPath ) )
     self.nextLine = self.inputFile.readline()
     self.currentEvent = []
-    self.moduleMap = {}
 
   def __del__( self ):
     self.inputFile.close()
@@ -32,7 +227,7 @@ class CsvFileReader:
     splitLine = self.nextLine.split(" ")
 
     # There's a variable amount of potential module info
-    moduleIDFields = len( splitLine ) - DATASET_PHOTON_LENGTH
+    moduleIDFields = len( splitLine ) - DATASET_HIT_FIELDS
 
     # Assemble hit info
     wholeHit = [ int( splitLine[DATASET_EVENT] ) ]
@@ -40,14 +235,11 @@ class CsvFileReader:
       wholeHit.append( float( splitLine[i] ) )
 
     # Assemble module ID info
-    moduleIDs = []
-    for i in range( 1, moduleIDFields + 1 ):
-      moduleIDs.append( int( splitLine[i] ) )
-
-    # Save module ID map
-    # Note that it's fine to use a tuple () as a dict key, but not a list []
-    hitGlobalPos = ( wholeHit[ DATASET_R ], wholeHit[ DATASET_PHI ], wholeHit[ DATASET_Z ] )
-    self.moduleMap[ hitGlobalPos ] = moduleIDs
+    for i in range( 1, DATASET_MODULE_FIELDS + 1 ):
+      if i <= moduleIDFields:
+        wholeHit.append( int( splitLine[i] ) )
+      else:
+        wholeHit.append( -1 )
 
     self.nextLine = self.inputFile.readline()
     return wholeHit
@@ -72,109 +264,875 @@ class CsvFileReader:
         return newEvent
 
 
+# Bulk alternative to CsvFileReader: read a whole hit file at once into numpy columns
+# Returns two arrays with one row per hit:
+#  - the main quantities, in the usual DATASET_* positions
+#  - the module IDs, in DATASET_MODULE_FIELDS integer columns
+# With UseCache, the parsed columns are saved next to the input file and re-used next time
+def ReadHitColumns( InputPath, UseCache=True ):
+  hitArrays = HitArrayBuilder( ReadHitMetadata( InputPath ) )
+  for hitData, moduleData in ReadHitBlocks( InputPath, UseCache=UseCache ):
+    hitArrays.Add( hitData, moduleData )
+  return hitArrays.Finish()
+
+
+# Streaming version of ReadHitColumns, for files that are too large to hold twice in memory
+# Yields blocks of roughly BlockHits hits, but an event is never split across blocks
+# With Processes > 1, the text is parsed in a pool of worker processes (see ParseHitBlocksParallel)
+# The first complete parse also writes a metadata sidecar (see ReadHitMetadata), unless UseCache is False
+def ReadHitBlocks( InputPath, BlockHits=1000000, UseCache=True, Processes=1 ):
+
+  # Binary files and exported datasets (see ArrowDatasetIO) are read directly, so there's no need for a cache
+  # Only text files are cached, so the file itself needn't be checked if there is an up-to-date cache
+  import ArrowDatasetIO
+  arrowFile = ArrowDatasetIO.IsArrowFile( InputPath )
+  if UseCache and not arrowFile:
+    cachedBlocks = ReadHitCache( InputPath )
+    if cachedBlocks is not None:
+      yield from cachedBlocks
+      return
+  binaryFile = arrowFile or IsBinaryHitFile( InputPath )
+
+  # The table parser only works if every line has the same number of fields
+  metadata = ReadHitMetadata( InputPath )
+  tryTable = metadata is None or metadata[ "moduleFieldsMin" ] == metadata[ "moduleFieldsMax" ]
+
+  cacheWriter = None
+  if UseCache and not binaryFile:
+    cacheWriter = HitCacheWriter( InputPath )
+
+  # A compressed file can only be read from the start, so can't be split between processes
+  if Processes > 1 and IsCompressed( InputPath ) and not binaryFile:
+    print( "Parsing compressed file " + InputPath + " in a single process" )
+    Processes = 1
+
+  if arrowFile:
+    parsedBlocks = WholeEventBlocks( ArrowDatasetIO.ImportHitBlocks( InputPath, BlockHits ) )
+  elif binaryFile:
+    parsedBlocks = WholeEventBlocks( BinaryHitColumns( records ) for records in BinaryHitRecords( InputPath, BlockHits ) )
+  elif Processes > 1:
+    parsedBlocks = ParseHitBlocksParallel( InputPath, BlockHits, Processes, tryTable )
+  else:
+    parsedBlocks = ParseHitBlocks( InputPath, BlockHits, tryTable )
+
+  statistics = HitStatistics()
+  for hitData, moduleData in parsedBlocks:
+    if cacheWriter is not None:
+      cacheWriter.Write( hitData, moduleData )
+    statistics.Add( hitData, moduleData )
+    yield hitData, moduleData
+
+  if cacheWriter is not None:
+    cacheWriter.Close()
+  if UseCache:
+    WriteHitMetadata( InputPath, statistics.Metadata( InputPath ) )
+
+
+def ParseHitBlocks( InputPath, BlockHits, TryTable=True ):
+  yield from WholeEventBlocks( ParseHitLines( InputPath, BlockHits, TryTable ) )
+
+
+def ParseHitLines( InputPath, BlockHits, TryTable=True ):
+
+  # Rough size of one line of text, only used to decide how much to read at once
+  blockBytes = BlockHits * 64
+
+  with OpenHitFile( InputPath ) as inputFile:
+    while True:
+
+      # Read approximately the block size, then the rest of the last line
+      # (one buffer for the whole block, rather than an object for every line)
+      rawText = inputFile.read( blockBytes )
+      if len( rawText ) == 0:
+        break
+      rawText += inputFile.readline()
+      yield ParseHitColumns( rawText, TryTable )
+
+
+# Re-divide blocks of hits so that no event is split between blocks
+def WholeEventBlocks( Blocks ):
+
+  carryHits = None
+  carryModules = None
+  for hitData, moduleData in Blocks:
+    if len( hitData ) == 0:
+      continue
+
+    # Prepend the unfinished event from the previous block
+    if carryHits is not None:
+      hitData = np.concatenate( ( carryHits, hitData ) )
+      moduleData = np.concatenate( ( carryModules, moduleData ) )
+
+    # Hold back the last event in the block, since it may continue in the next one
+    lastEventStart = np.searchsorted( hitData[ :, DATASET_EVENT ], hitData[ -1, DATASET_EVENT ] )
+    carryHits = hitData[ lastEventStart: ]
+    carryModules = moduleData[ lastEventStart: ]
+    if lastEventStart > 0:
+      yield hitData[ :lastEventStart ], moduleData[ :lastEventStart ]
+
+  # Last event in the file
+  if carryHits is not None:
+    yield carryHits, carryModules
+
+
+# Split the file into byte ranges that each start at the first line of an event,
+#  then parse the ranges in separate processes and yield the results in file order
+# The blocks are the same hits as from ParseHitBlocks, just divided in different places
+# Note that this can't be used from inside the worker of another pool (daemonic processes can't have children)
+def ParseHitBlocksParallel( InputPath, BlockHits, Processes, TryTable=True ):
+
+  # Enough ranges to keep every process busy, but no bigger than a normal block
+  fileSize = os.path.getsize( InputPath )
+  rangeBytes = min( BlockHits * 64, fileSize // Processes + 1 )
+
+  rangeStarts = [ 0 ]
+  with open( InputPath, "rb" ) as inputFile:
+    position = rangeBytes
+    while position < fileSize:
+      boundary = NextEventBoundary( inputFile, position )
+      if boundary >= fileSize:
+        break
+      rangeStarts.append( boundary )
+      position = boundary + rangeBytes
+  rangeStops = rangeStarts[ 1: ] + [ fileSize ]
+
+  ranges = [ ( InputPath, start, stop, TryTable ) for start, stop in zip( rangeStarts, rangeStops ) ]
+  with multiprocessing.Pool( Processes ) as pool:
+    for hitData, moduleData in pool.imap( ParseHitRange, ranges ):
+      if len( hitData ) > 0:
+        yield hitData, moduleData
+
+
+# Find the start of the first line at or after Position that begins a new event
+def NextEventBoundary( InputFile, Position ):
+
+  # Move to the start of the next whole line
+  InputFile.seek( Position - 1 )
+  InputFile.readline()
+
+  # Skip the rest of the event that line belongs to
+  eventID = None
+  while True:
+    lineStart = InputFile.tell()
+    line = InputFile.readline()
+    if len( line ) == 0:
+      return lineStart
+    lineEventID = line.split( maxsplit=1 )[ :1 ]
+    if eventID is None:
+      eventID = lineEventID
+    elif lineEventID != eventID:
+      return lineStart
+
+
+def ParseHitRange( Range ):
+  inputPath, start, stop, tryTable = Range
+  with open( inputPath, "rb" ) as inputFile:
+    inputFile.seek( start )
+    return ParseHitColumns( inputFile.read( stop - start ), tryTable )
+
+
+# Calculate the DATASET_X, DATASET_Y and DATASET_CRYSTAL_INDEX columns for each hit
+# The crystal index is the Geant4 copy number, which is only available for crystal geometries
+# CrystalGeometry gives ( blocks per ring, crystals per block ) for a detector whose module IDs are ring, block and crystal
+#  (see CrystalGeometryOfDetector); without it the crystal index is -1
+def DerivedHitColumns( HitData, ModuleData, CrystalGeometry=None ):
+  derivedData = np.empty( [ len( HitData ), DATASET_DERIVED_FIELDS ] )
+  derivedData[ :, 0 ] = HitData[ :, DATASET_R ] * np.cos( HitData[ :, DATASET_PHI ] )
+  derivedData[ :, 1 ] = HitData[ :, DATASET_R ] * np.sin( HitData[ :, DATASET_PHI ] )
+
+  if CrystalGeometry is None:
+    derivedData[ :, 2 ] = -1
+    return derivedData
+  blocksPerRing, crystalsPerBlock = CrystalGeometry
+  ring = ModuleData[ :, DATASET_RING - DATASET_HIT_FIELDS ].astype( np.int64 )
+  block = ModuleData[ :, DATASET_BLOCK - DATASET_HIT_FIELDS ].astype( np.int64 )
+  crystal = ModuleData[ :, DATASET_CRYSTAL - DATASET_HIT_FIELDS ].astype( np.int64 )
+  crystalIndex = ( ring * blocksPerRing + block ) * crystalsPerBlock + crystal
+  derivedData[ :, 2 ] = np.where( crystal < 0, -1, crystalIndex )
+  return derivedData
+
+
+# Layout of the module IDs for a detector name (as given to GenerateSample), for DerivedHitColumns
+# Only the Siemens geometries give ring, block and crystal IDs, so other detectors return None
+def CrystalGeometryOfDetector( Detector ):
+  if Detector.startswith( "Siemens" ):
+    return ( sqp.BlocksPerRing(), sqp.CrystalsPerBlock() )
+  return None
+
+
+# Collect blocks of hits into single arrays
+# If the file metadata is known, the arrays are allocated once at full size and the blocks copied in,
+#  rather than kept until the end and joined (which needs twice the memory)
+class HitArrayBuilder:
+
+  def __init__( self, Metadata=None ):
+    self.hitBlocks = []
+    self.moduleBlocks = []
+    self.hitData = None
+    self.moduleData = None
+    self.hitCount = 0
+    if Metadata is not None:
+      self.hitData = np.empty( [ Metadata[ "hitCount" ], DATASET_HIT_FIELDS ] )
+      self.moduleData = np.empty( [ Metadata[ "hitCount" ], DATASET_MODULE_FIELDS ], dtype=np.int32 )
+
+  def Add( self, HitData, ModuleData ):
+
+    # Shouldn't happen, but fall back to joining blocks if the metadata was wrong
+    if self.hitData is not None and self.hitCount + len( HitData ) > len( self.hitData ):
+      print( "WARNING: more hits than expected from metadata" )
+      self.hitBlocks = [ self.hitData[ :self.hitCount ] ]
+      self.moduleBlocks = [ self.moduleData[ :self.hitCount ] ]
+      self.hitData = None
+      self.moduleData = None
+
+    if self.hitData is None:
+      self.hitBlocks.append( HitData )
+      self.moduleBlocks.append( ModuleData )
+    else:
+      self.hitData[ self.hitCount : self.hitCount + len( HitData ) ] = HitData
+      self.moduleData[ self.hitCount : self.hitCount + len( HitData ) ] = ModuleData
+    self.hitCount += len( HitData )
+
+  def Finish( self ):
+    if self.hitData is None:
+      return JoinHitBlocks( self.hitBlocks, self.moduleBlocks )
+
+    # Release any space left over, e.g. from clustering
+    if self.hitCount < len( self.hitData ):
+      self.hitData.resize( [ self.hitCount, DATASET_HIT_FIELDS ], refcheck=False )
+      self.moduleData.resize( [ self.hitCount, DATASET_MODULE_FIELDS ], refcheck=False )
+    return self.hitData, self.moduleData
+
+
+def JoinHitBlocks( HitBlocks, ModuleBlocks ):
+  if len( HitBlocks ) == 0:
+    return np.zeros( [ 0, DATASET_HIT_FIELDS ] ), np.zeros( [ 0, DATASET_MODULE_FIELDS ], dtype=np.int32 )
+  return np.concatenate( HitBlocks ), np.concatenate( ModuleBlocks )
+
+
+# Convert text (whole lines from a hit file) into hit and module ID columns
+# Set TryTable to False if the lines are known to have different numbers of fields
+def ParseHitColumns( RawText, TryTable=True ):
+
+  if len( RawText ) == 0 or RawText.isspace():
+    return JoinHitBlocks( [], [] )
+
+  # Fast path: every line has the same number of module ID fields, so the C parser in loadtxt can build the table
+  if TryTable:
+    try:
+      return HitTableColumns( np.loadtxt( io.BytesIO( RawText ), ndmin=2 ) )
+    except ValueError:
+      pass
+
+  # Otherwise find the number of fields on each line by counting separators
+  # EnergyCounter writes a single space between fields, and a newline after the last one
+  rawBytes = np.frombuffer( RawText, dtype=np.uint8 )
+  lineEnds = np.flatnonzero( rawBytes == ord( "\n" ) )
+  if len( lineEnds ) == 0 or lineEnds[-1] != len( rawBytes ) - 1:
+    lineEnds = np.append( lineEnds, len( rawBytes ) - 1 ) # no newline at end of file
+  spaces = np.flatnonzero( rawBytes == ord( " " ) )
+  lineFields = np.diff( np.searchsorted( spaces, lineEnds ), prepend=0 ) + 1
+  lineBytes = np.diff( lineEnds, prepend=-1 )
+
+  # Blank lines are skipped (as loadtxt would), and so are lines too short to be a hit (e.g. the simulation stopped while writing)
+  lineFields[ lineBytes <= 1 ] = 0
+  isHit = lineFields >= DATASET_HIT_FIELDS
+  if np.any( lineFields[ ~isHit ] > 0 ):
+    print( "Ignoring " + str( np.count_nonzero( lineFields[ ~isHit ] ) ) + " incomplete lines" )
+
+  # Then parse the lines with each number of fields as a table of their own, and put the rows back in file order
+  hitData = np.empty( [ len( lineFields ), DATASET_HIT_FIELDS ] )
+  moduleData = np.empty( [ len( lineFields ), DATASET_MODULE_FIELDS ], dtype=np.int32 )
+  for fieldCount in np.unique( lineFields[ isHit ] ):
+    hasCount = lineFields == fieldCount
+    tableText = rawBytes[ np.repeat( hasCount, lineBytes ) ].tobytes()
+    hitData[ hasCount ], moduleData[ hasCount ] = HitTableColumns( np.loadtxt( io.BytesIO( tableText ), ndmin=2 ) )
+  if not np.all( isHit ):
+    return hitData[ isHit ], moduleData[ isHit ]
+  return hitData, moduleData
+
+
+# Hit and module ID columns from a table of hit file lines that all have the same number of fields
+def HitTableColumns( Table ):
+  moduleIDFields = Table.shape[1] - DATASET_HIT_FIELDS
+  hitData = np.empty( [ len( Table ), DATASET_HIT_FIELDS ] )
+  hitData[ :, DATASET_EVENT ] = Table[ :, 0 ]
+  hitData[ :, DATASET_EVENT+1: ] = Table[ :, 1 + moduleIDFields: ]
+
+  # Module IDs are kept as fixed-width integer columns, padded with -1
+  moduleData = np.full( [ len( Table ), DATASET_MODULE_FIELDS ], -1, dtype=np.int32 )
+  keptFields = min( moduleIDFields, DATASET_MODULE_FIELDS )
+  moduleData[ :, :keptFields ] = Table[ :, 1 : 1 + keptFields ]
+  return hitData, moduleData
+
+
+# The input file is ordered, so each event is a contiguous range of hits
+# Returns the start and stop index of each event
+def EventRanges( EventColumn ):
+  eventStarts = np.flatnonzero( np.diff( EventColumn, prepend=EventColumn[:1] - 1 ) )
+  eventStops = np.append( eventStarts[1:], len( EventColumn ) )
+  return eventStarts, eventStops
+
+
+# Text sidecar describing a hit file, written by the simulation or by the first parse
+# Each line is a name and an integer value:
+#  - version: HIT_METADATA_VERSION
+#  - fileSize: size of the hit file in bytes, to check that the sidecar still matches it
+#  - moduleFieldsMin, moduleFieldsMax: range of the number of module ID fields per line
+#  - hitCount, eventCount: number of lines, and of distinct events (i.e. decays with at least one hit)
+#  - eventHitsMax: largest number of hits in one event
+HIT_METADATA_VERSION = 1
+HIT_METADATA_FIELDS = [ "version", "fileSize", "moduleFieldsMin", "moduleFieldsMax", "hitCount", "eventCount", "eventHitsMax" ]
+
+def HitMetadataPath( InputPath ):
+  return InputPath + ".meta"
+
+
+# Returns a dictionary of the metadata, or None if there is no up-to-date (readable) sidecar
+def ReadHitMetadata( InputPath ):
+
+  metadataPath = HitMetadataPath( InputPath )
+  metadata = {}
+  try:
+    if os.path.getmtime( metadataPath ) < os.path.getmtime( InputPath ):
+      return None
+    with open( metadataPath ) as metadataFile:
+      for line in metadataFile:
+        splitLine = line.split()
+        if len( splitLine ) == 2:
+          metadata[ splitLine[0] ] = int( splitLine[1] )
+  except FileNotFoundError:
+    return None
+  except ( OSError, ValueError ) as error:
+    print( "Ignoring unreadable metadata " + metadataPath + ": " + str( error ) )
+    return None
+
+  for field in HIT_METADATA_FIELDS:
+    if field not in metadata:
+      print( "Ignoring incomplete metadata " + metadataPath )
+      return None
+  if metadata[ "version" ] != HIT_METADATA_VERSION or metadata[ "fileSize" ] != os.path.getsize( InputPath ):
+    print( "Ignoring out-of-date metadata " + metadataPath )
+    return None
+  return metadata
+
+
+# The sidecar is optional, so if it can't be written (e.g. a read-only directory) the load just carries on without it
+def WriteHitMetadata( InputPath, Metadata ):
+  metadataPath = HitMetadataPath( InputPath )
+  temporaryPath = metadataPath + ".tmp" + str( os.getpid() )
+  try:
+    with open( temporaryPath, "w" ) as metadataFile:
+      for field in HIT_METADATA_FIELDS:
+        metadataFile.write( field + " " + str( Metadata[ field ] ) + "\n" )
+    os.replace( temporaryPath, metadataPath )
+  except OSError as error:
+    print( "Unable to write metadata " + metadataPath + ": " + str( error ) )
+    if os.path.isfile( temporaryPath ):
+      os.remove( temporaryPath )
+
+
+# Accumulate the metadata for a hit file from its parsed blocks
+class HitStatistics:
+
+  def __init__( self ):
+    self.moduleFieldsMin = DATASET_MODULE_FIELDS
+    self.moduleFieldsMax = 0
+    self.hitCount = 0
+    self.eventCount = 0
+    self.eventHitsMax = 0
+
+  def Add( self, HitData, ModuleData ):
+    moduleFields = np.count_nonzero( ModuleData >= 0, axis=1 )
+    self.moduleFieldsMin = min( self.moduleFieldsMin, int( np.min( moduleFields, initial=DATASET_MODULE_FIELDS ) ) )
+    self.moduleFieldsMax = max( self.moduleFieldsMax, int( np.max( moduleFields, initial=0 ) ) )
+    eventStarts, eventStops = EventRanges( HitData[ :, DATASET_EVENT ] )
+    self.hitCount += len( HitData )
+    self.eventCount += len( eventStarts )
+    self.eventHitsMax = max( self.eventHitsMax, int( np.max( eventStops - eventStarts, initial=0 ) ) )
+
+  def Metadata( self, InputPath ):
+    return { "version": HIT_METADATA_VERSION,
+             "fileSize": os.path.getsize( InputPath ),
+             "moduleFieldsMin": min( self.moduleFieldsMin, self.moduleFieldsMax ),
+             "moduleFieldsMax": self.moduleFieldsMax,
+             "hitCount": self.hitCount,
+             "eventCount": self.eventCount,
+             "eventHitsMax": self.eventHitsMax }
+
+
+# Binary sidecar for a parsed hit file
+# The cache is a sequence of numpy arrays in one file: first a signature, then pairs of hit and module ID blocks
+# The size and modification time of the source file are stored in the signature,
+#  so that a cache is ignored if the simulation has been re-run since it was written
+HIT_CACHE_VERSION = 2
+
+def HitCachePath( InputPath ):
+  return InputPath + ".cache"
+
+
+def HitFileSignature( InputPath, Version=HIT_CACHE_VERSION ):
+  fileStats = os.stat( InputPath )
+  return np.array( [ Version, fileStats.st_size, fileStats.st_mtime_ns ], dtype=np.int64 )
+
+
+# Returns a generator of the cached blocks, or None if there is no valid cache
+def ReadHitCache( InputPath ):
+
+  cachePath = HitCachePath( InputPath )
+  if not os.path.exists( cachePath ):
+    return None
+
+  cacheFile = open( cachePath, "rb" )
+  try:
+    signature = np.load( cacheFile )
+  except ( OSError, ValueError ) as error:
+    print( "Ignoring unreadable cache " + cachePath + ": " + str( error ) )
+    cacheFile.close()
+    return None
+  if not np.array_equal( signature, HitFileSignature( InputPath ) ):
+    print( "Ignoring out-of-date cache " + cachePath )
+    cacheFile.close()
+    return None
+
+  return CachedHitBlocks( cacheFile, os.path.getsize( cachePath ) )
+
+
+def CachedHitBlocks( CacheFile, CacheSize ):
+  with CacheFile:
+    while CacheFile.tell() < CacheSize:
+      hitData = np.load( CacheFile )
+      moduleData = np.load( CacheFile )
+      yield hitData, moduleData
+
+
+class HitCacheWriter:
+
+  # Write to a temporary name and then move into place when finished,
+  #  since other processes may be reading the same dataset
+  def __init__( self, InputPath ):
+    self.cachePath = HitCachePath( InputPath )
+    self.temporaryPath = self.cachePath + ".tmp" + str( os.getpid() )
+    self.cacheFile = None
+    try:
+      self.cacheFile = open( self.temporaryPath, "wb" )
+      np.save( self.cacheFile, HitFileSignature( InputPath ) )
+    except OSError as error:
+      self.Abandon( error )
+
+  def __del__( self ):
+    # Never finished, e.g. the reader stopped early
+    if self.cacheFile is not None:
+      self.Abandon()
+
+  def Write( self, HitData, ModuleData ):
+    if self.cacheFile is None:
+      return
+    try:
+      np.save( self.cacheFile, HitData )
+      np.save( self.cacheFile, ModuleData )
+    except OSError as error:
+      self.Abandon( error )
+
+  def Close( self ):
+    if self.cacheFile is None:
+      return
+    try:
+      self.cacheFile.close()
+      self.cacheFile = None
+      os.replace( self.temporaryPath, self.cachePath )
+    except OSError as error:
+      self.Abandon( error )
+
+  def Abandon( self, Error=None ):
+    if Error is not None:
+      print( "Unable to write cache " + self.cachePath + ": " + str( Error ) )
+    if self.cacheFile is not None:
+      self.cacheFile.close()
+      self.cacheFile = None
+    if os.path.exists( self.temporaryPath ):
+      os.remove( self.temporaryPath )
+
+
+# Index of the events in a hit file, so that chosen events can be read without parsing the rest of the file
+# Stored next to the hit file with a signature (as for the cache), and the arrays:
+#  - eventIDs: the events that have hits, in file order
+#  - offsets: where each event starts, with one extra entry for the end of the file
+#    (byte offsets for text files, record numbers for binary files)
+#  - eventHits: number of hits in each event
+# Only uncompressed files can be indexed, since compressed files can't be read from an arbitrary point
+HIT_INDEX_VERSION = 1
+
+def HitIndexPath( InputPath ):
+  return InputPath + ".index.npz"
+
+
+# Returns the index arrays, building the index if there isn't an up-to-date one already
+def ReadHitIndex( InputPath, BlockHits=1000000 ):
+
+  if IsCompressed( InputPath ):
+    raise ValueError( "Random access needs an uncompressed hit file, not " + InputPath )
+
+  indexPath = HitIndexPath( InputPath )
+  if os.path.exists( indexPath ):
+    try:
+      with np.load( indexPath ) as index:
+        if np.array_equal( index[ "signature" ], HitFileSignature( InputPath, HIT_INDEX_VERSION ) ):
+          return index[ "eventIDs" ], index[ "offsets" ], index[ "eventHits" ]
+      print( "Ignoring out-of-date index " + indexPath )
+    except ( OSError, ValueError, KeyError ) as error:
+      print( "Ignoring unreadable index " + indexPath + ": " + str( error ) )
+
+  print( "Indexing " + InputPath )
+  eventIDs, offsets, eventHits = BuildHitIndex( InputPath, BlockHits )
+
+  # Write to a temporary name and then move into place, since other processes may be reading the same file
+  temporaryPath = indexPath + ".tmp" + str( os.getpid() )
+  try:
+    with open( temporaryPath, "wb" ) as indexFile:
+      np.savez( indexFile, signature=HitFileSignature( InputPath, HIT_INDEX_VERSION ), eventIDs=eventIDs, offsets=offsets, eventHits=eventHits )
+    os.replace( temporaryPath, indexPath )
+  except OSError as error:
+    print( "Unable to write index " + indexPath + ": " + str( error ) )
+    if os.path.exists( temporaryPath ):
+      os.remove( temporaryPath )
+
+  return eventIDs, offsets, eventHits
+
+
+def BuildHitIndex( InputPath, BlockHits ):
+
+  binaryFile = IsBinaryHitFile( InputPath )
+  if binaryFile:
+    records = ReadBinaryHits( InputPath )
+    endOffset = len( records )
+  else:
+    endOffset = os.path.getsize( InputPath )
+
+  # Event ID and position of each hit, one block at a time
+  # Binary records give the event ID directly, and text lines start with it
+  def HitPositions():
+    if binaryFile:
+      for start in range( 0, len( records ), BlockHits ):
+        yield np.array( records[ "event" ][ start : start + BlockHits ] ), np.arange( start, min( start + BlockHits, len( records ) ) )
+    else:
+      position = 0
+      with open( InputPath, "rb" ) as inputFile:
+        while True:
+          lines = inputFile.readlines( BlockHits * 64 )
+          if len( lines ) == 0:
+            break
+          lineLengths = np.fromiter( map( len, lines ), dtype=np.int64, count=len( lines ) )
+          lineStarts = position + np.cumsum( lineLengths ) - lineLengths
+          position += int( np.sum( lineLengths ) )
+          hasHit = np.array( [ len( line.strip() ) > 0 for line in lines ], dtype=bool )
+          lineEvents = np.array( [ line.split( None, 1 )[0] for line in lines if line.strip() ] ).astype( np.int64 )
+          yield lineEvents, lineStarts[ hasHit ]
+
+  # Keep the first hit of each event
+  eventIDs = []
+  offsets = []
+  eventStartHits = []
+  lastEvent = -1
+  hitCount = 0
+  for hitEvents, positions in HitPositions():
+    if len( hitEvents ) == 0:
+      continue
+    eventStarts = np.flatnonzero( hitEvents != np.concatenate( ( [ lastEvent ], hitEvents[ :-1 ] ) ) )
+    eventIDs.append( hitEvents[ eventStarts ] )
+    offsets.append( positions[ eventStarts ] )
+    eventStartHits.append( hitCount + eventStarts )
+    lastEvent = hitEvents[-1]
+    hitCount += len( hitEvents )
+
+  eventIDs = np.concatenate( eventIDs + [ np.zeros( 0, dtype=np.int64 ) ] )
+  offsets = np.concatenate( offsets + [ np.array( [ endOffset ], dtype=np.int64 ) ] )
+  eventStartHits = np.concatenate( eventStartHits + [ np.array( [ hitCount ], dtype=np.int64 ) ] )
+  return eventIDs, offsets, np.diff( eventStartHits )
+
+
+# Read the hits of the chosen events, given as rows of the index
+# Returns hit and module ID columns (as for ParseHitColumns) in file order, whatever the order of the rows
+# BinaryFile saves checking the file type (see IsBinaryHitFile) when reading many times from the same file
+def ReadHitEvents( InputPath, Index, IndexRows, BinaryFile=None ):
+  eventIDs, offsets, eventHits = Index
+  IndexRows = np.unique( IndexRows )
+  if len( IndexRows ) == 0:
+    return JoinHitBlocks( [], [] )
+  if BinaryFile is None:
+    BinaryFile = IsBinaryHitFile( InputPath )
+
+  # Binary records can be gathered straight from the memory map
+  if BinaryFile:
+    records = ReadBinaryHits( InputPath )
+    hitCounts = eventHits[ IndexRows ]
+    hitRows = np.repeat( offsets[ IndexRows ] - ( np.cumsum( hitCounts ) - hitCounts ), hitCounts ) + np.arange( np.sum( hitCounts ) )
+    return BinaryHitColumns( records[ hitRows ] )
+
+  # Text is read in runs of neighbouring events, then parsed in one go
+  runStarts = np.flatnonzero( np.diff( IndexRows, prepend=-2 ) != 1 )
+  runStops = np.append( runStarts[1:], len( IndexRows ) )
+  rawText = []
+  with open( InputPath, "rb" ) as inputFile:
+    for runStart, runStop in zip( runStarts, runStops ):
+      start = offsets[ IndexRows[ runStart ] ]
+      inputFile.seek( start )
+      rawText.append( inputFile.read( offsets[ IndexRows[ runStop - 1 ] + 1 ] - start ) )
+  return ParseHitColumns( b"".join( rawText ) )
+
+
 class SimulationDataset:
 
-  def __init__( self, InputPath, TotalDecays, EnergyMin=None, EnergyMax=None, ClusterLimitMM=None, RNG=None ):
-    self.inputData = {}
+  # The input file is read in blocks of whole events (see ReadHitBlocks), and each block is clustered as it arrives,
+  #  so peak memory is the final (compact) hit arrays plus a single block
+  # With LoadHits=False nothing is read, and the dataset just describes how hits should be processed
+  #  (see IndexedDatasetReader, or NumpyDatasetReader with an existing memory-mapped copy of the hits)
+  def __init__( self, InputPath, TotalDecays, EnergyMin=None, EnergyMax=None, ClusterLimitMM=None, RNG=None, UseCache=True, BlockHits=1000000, Processes=1, CachePairGeometry=False, DerivedColumns=False, \
+                EnergyResolution=None, EnergySigmaWindow=5.0, LoadHits=True, CrystalGeometry=None ):
+
+    # The file may be compressed, even if the uncompressed name was given
+    if FindHitFile( InputPath ) is not None:
+      InputPath = FindHitFile( InputPath )
+
+    self.inputPath = InputPath
+    self.clusterLimitMM = ClusterLimitMM
     self.energyMin = EnergyMin
     self.energyMax = EnergyMax
+    self.energyResolution = EnergyResolution
+    self.energySigmaWindow = EnergySigmaWindow
     self.totalDecays = TotalDecays
     self.hitCount = 0
     self.eventHitsMax = 0
+    self.hitData = None
+    self.moduleData = None
+    self.eventOffsets = None # not known until a reader indexes the hits
+    self.pairGeometry = None
+    self.derivedData = None
+    self.derivedColumns = DerivedColumns
+    self.crystalGeometry = CrystalGeometry
     self.RNG = RNG
     if self.RNG == None:
       self.RNG = np.random.default_rng()
 
+    # Hits exported after clustering (see ArrowDatasetIO) keep their clustering limit, and aren't clustered again
+    import ArrowDatasetIO
+    clusterHits = ClusterLimitMM is not None
+    exportedLimitMM = ArrowDatasetIO.ExportedClusterLimit( InputPath )
+    if exportedLimitMM is not None:
+      if clusterHits and ClusterLimitMM != exportedLimitMM:
+        print( "ERROR: " + InputPath + " was clustered at " + str( exportedLimitMM ) + "mm before export, so it won't be clustered at " + str( ClusterLimitMM ) + "mm" )
+      self.clusterLimitMM = exportedLimitMM
+      clusterHits = False
+
     if TotalDecays < 1:
       print( "ERROR: Requesting an empty dataset" )
       return
+    if not LoadHits:
+      return
 
-    currentEvent = -1
+    # Parse input
+    # The hit count from the file metadata (if there is any) is an upper limit, since clustering and cuts only remove hits
+    hitArrays = HitArrayBuilder( ReadHitMetadata( InputPath ) )
     eventCount = 0
+    hitsBeforeCut = 0
+    energyLow, energyHigh = self.EnergyPrefilterWindow()
+    for hitData, moduleData in ReadHitBlocks( InputPath, BlockHits, UseCache, Processes ):
 
-    # Parse input
-    inputFile = CsvFileReader( InputPath )
-    while inputFile.Open():
+      if clusterHits:
+        hitData, moduleData = self.ClusterHits( hitData, moduleData, ClusterLimitMM )
 
-      wholeHit = inputFile.ReadHit()
-      eventID = wholeHit[ DATASET_EVENT ]
+      hitsBeforeCut += len( hitData )
+      hitData, moduleData = self.PrefilterHits( hitData, moduleData )
 
-      # Multiple lines (hits) can go into a single event
-      if eventID in self.inputData:
-        self.AddHit( eventID, wholeHit, ClusterLimitMM, inputFile.moduleMap )
-      else:
-        # Input file should be ordered and thus old event complete
-        if currentEvent in self.inputData:
-          self.eventHitsMax = max( self.eventHitsMax, len( self.inputData[currentEvent] ) )
+      eventStarts, eventStops = EventRanges( hitData[ :, DATASET_EVENT ] )
+      eventCount += len( eventStarts )
+      self.eventHitsMax = max( self.eventHitsMax, int( np.max( eventStops - eventStarts, initial=0 ) ) )
 
-        # Start a new event
-        self.inputData[ eventID ] = [ wholeHit ]
-        currentEvent = eventID
-        eventCount += 1
-        self.hitCount += 1
+      hitArrays.Add( hitData, moduleData )
 
-    # Save the module map info
-    self.moduleMap = inputFile.moduleMap
+    # Keep the hits as arrays, ordered by event
+    self.hitData, self.moduleData = hitArrays.Finish()
+    self.hitCount = len( self.hitData )
 
-    print( str(eventCount) + " events loaded (" + str( self.totalDecays ) + " simulated) with average " + str( self.hitCount / self.totalDecays ) + " hits/event" )
+    if energyLow is not None or energyHigh is not None:
+      print( "Energy prefilter kept " + str( self.hitCount ) + " of " + str( hitsBeforeCut ) + " hits" )
 
+    # Cartesian position and crystal index, so that they don't need to be found for every sampled photon
+    if DerivedColumns:
+      self.derivedData = DerivedHitColumns( self.hitData, self.moduleData, CrystalGeometry )
 
-  def AddHit( self, ExistingEventID, NewHit, ClusterLimitMM, ModuleMap ):
+    # Photon pairs from the same event will be seen many times, so work out their geometry now
+    if CachePairGeometry:
+      self.pairGeometry = PairGeometry( self.hitData )
 
-    if ClusterLimitMM is None:
-      self.inputData[ ExistingEventID ].append( NewHit )
-      self.hitCount += 1
+    print( str(eventCount) + " events loaded (" + str( self.totalDecays ) + " simulated) with average " + str( self.hitCount / self.totalDecays ) + " hits/event" )
 
-    else:
-      oldEvent = self.inputData[ ExistingEventID ]
-      newE = NewHit[DATASET_ENERGY]
-      newZ = NewHit[DATASET_Z]
-      newPhi = NewHit[DATASET_PHI]
-      newR = NewHit[DATASET_R]
-      keepHit = True
-
-      # Attempt to add hit to each hit to the new event
-      for oldHitIndex, oldHit in enumerate( oldEvent ):
-        oldE = oldHit[DATASET_ENERGY]
-        oldZ = oldHit[DATASET_Z]
-        oldPhi = oldHit[DATASET_PHI]
-        oldR = oldHit[DATASET_R]
-        deltaZ = newZ-oldZ
-        deltaPhiR = (newPhi*newR)-(oldPhi*oldR)
-        delta = math.sqrt( deltaZ*deltaZ + deltaPhiR*deltaPhiR )
-
-        # Merge hits within threshold
-        if delta < ClusterLimitMM:
-          mergedE = newE + oldE
-          mergedZ = ( newE*newZ + oldE*oldZ ) / mergedE
-          mergedPhi = ( newE*newPhi + oldE*oldPhi ) / mergedE
-          mergedR = ( newE*newR + oldE*oldR ) / mergedE
-          mergedT = ( newE*NewHit[DATASET_TIME] + oldE*oldHit[DATASET_TIME] ) / mergedE
-          self.inputData[ ExistingEventID ][ oldHitIndex ] = [ oldHit[DATASET_EVENT], mergedE, mergedT, mergedR, mergedPhi, mergedZ ]
-
-          # Update the module map for the merged hit
-          # For now just a simple majority method: use the module with most energy
-          mergedMOD = None
-          if ( oldE >= newE ):
-            oldHitGlobalPos = ( oldR, oldPhi, oldZ )
-            mergedMOD = ModuleMap[ oldHitGlobalPos ]
-          else:
-            newHitGlobalPos = ( newR, newPhi, newZ )
-            mergedMOD = ModuleMap[ newHitGlobalPos ]
-          mergedHitGlobalPos = ( mergedR, mergedPhi, mergedZ )
-          ModuleMap[ mergedHitGlobalPos ] = mergedMOD
-
-          keepHit = False
-          break
-
-      if keepHit:
-        self.inputData[ ExistingEventID ].append( NewHit )
-        self.hitCount += 1
+
+  # Energy range of hits to keep at load, matching the cut in MergedPhotonStream (EnergyMin < E < EnergyMax)
+  # Without energy resolution this is the cut itself, otherwise it is widened by EnergySigmaWindow standard deviations
+  # Returns None for either bound if it doesn't apply (including when EnergyResolution is None, i.e. no prefilter)
+  def EnergyPrefilterWindow( self ):
+    if self.energyResolution is None:
+      return None, None
+
+    energyLow = None
+    if self.energyMin is not None and self.energyMin > 0.0:
+      energyLow = self.energyMin / ( 1.0 + self.energySigmaWindow * self.energyResolution )
+
+    energyHigh = None
+    highScale = 1.0 - self.energySigmaWindow * self.energyResolution
+    if self.energyMax is not None and self.energyMax > 0.0 and highScale > 0.0:
+      energyHigh = self.energyMax / highScale
+
+    return energyLow, energyHigh
+
+
+  # Drop hits that could never pass the energy cut
+  # Decays with no hits left are still counted, just like decays that weren't detected
+  def PrefilterHits( self, HitData, ModuleData ):
+    energyLow, energyHigh = self.EnergyPrefilterWindow()
+    if energyLow is not None:
+      passCut = HitData[ :, DATASET_ENERGY ] > energyLow
+      HitData, ModuleData = HitData[ passCut ], ModuleData[ passCut ]
+    if energyHigh is not None:
+      passCut = HitData[ :, DATASET_ENERGY ] < energyHigh
+      HitData, ModuleData = HitData[ passCut ], ModuleData[ passCut ]
+    return HitData, ModuleData
+
+
+  # Merge nearby hits within each event in a block
+  # Hits are added to their event one at a time, in file order: each new hit is merged into the first
+  #  (possibly already merged) cluster within ClusterLimitMM, or else starts a new cluster
+  # Every event is processed at once, so the only Python loop is over the position of the hit within its event
+  def ClusterHits( self, HitData, ModuleData, ClusterLimitMM ):
+
+    eventStarts, eventStops = EventRanges( HitData[ :, DATASET_EVENT ] )
+    eventHits = eventStops - eventStarts
+
+    # Clusters for each event are stored in the rows of its own hits, which are never needed again once read
+    clusterData = HitData.copy()
+    clusterModules = ModuleData.copy()
+    clusterCounts = np.ones( len( eventStarts ), dtype=np.int64 )
+
+    for hitIndex in range( 1, int( np.max( eventHits, initial=0 ) ) ):
+
+      # Events that have a hit at this position
+      events = np.flatnonzero( eventHits > hitIndex )
+      newRows = eventStarts[ events ] + hitIndex
+      newHits = HitData[ newRows ]
+
+      # Distance to each existing cluster in the event
+      oldRows = eventStarts[ events, np.newaxis ] + np.arange( hitIndex )
+      oldHits = clusterData[ oldRows ]
+      deltaZ = newHits[ :, np.newaxis, DATASET_Z ] - oldHits[ :, :, DATASET_Z ]
+      deltaPhiR = ( newHits[ :, np.newaxis, DATASET_PHI ] * newHits[ :, np.newaxis, DATASET_R ] ) - ( oldHits[ :, :, DATASET_PHI ] * oldHits[ :, :, DATASET_R ] )
+      delta = np.sqrt( deltaZ*deltaZ + deltaPhiR*deltaPhiR )
+      inRange = ( delta < ClusterLimitMM ) & ( np.arange( hitIndex ) < clusterCounts[ events, np.newaxis ] )
+
+      # Merge into the first cluster within threshold
+      merge = np.any( inRange, axis=1 )
+      targetRows = oldRows[ merge, np.argmax( inRange[ merge ], axis=1 ) ]
+      newE = newHits[ merge, DATASET_ENERGY ]
+      oldE = clusterData[ targetRows, DATASET_ENERGY ]
+      mergedE = newE + oldE
+      for field in [ DATASET_Z, DATASET_PHI, DATASET_R, DATASET_TIME ]:
+        clusterData[ targetRows, field ] = ( newE*newHits[ merge, field ] + oldE*clusterData[ targetRows, field ] ) / mergedE
+      clusterData[ targetRows, DATASET_ENERGY ] = mergedE
+
+      # Module IDs for the merged hit
+      # For now just a simple majority method: use the module with most energy
+      newDominant = oldE < newE
+      clusterModules[ targetRows[ newDominant ] ] = ModuleData[ newRows[ merge ][ newDominant ] ]
+
+      # Otherwise start a new cluster
+      keep = ~merge
+      keepEvents = events[ keep ]
+      keepRows = eventStarts[ keepEvents ] + clusterCounts[ keepEvents ]
+      clusterData[ keepRows ] = newHits[ keep ]
+      clusterModules[ keepRows ] = ModuleData[ newRows[ keep ] ]
+      clusterCounts[ keepEvents ] += 1
+
+    # Keep only the rows holding clusters
+    rowInEvent = np.arange( len( HitData ) ) - np.repeat( eventStarts, eventHits )
+    isCluster = rowInEvent < np.repeat( clusterCounts, eventHits )
+    return clusterData[ isCluster ], clusterModules[ isCluster ]
 
 
   def size( self ):
     return self.totalDecays
 
+  # Name for files derived from this dataset, which depend on the clustering as well as the input
+  def DerivedPath( self, Suffix ):
+    clusterTag = ""
+    if self.clusterLimitMM is not None:
+      clusterTag = ".cluster" + str( self.clusterLimitMM ) + "mm"
+    energyTag = ""
+    energyLow, energyHigh = self.EnergyPrefilterWindow()
+    if energyLow is not None or energyHigh is not None:
+      energyTag = ".energy" + str( energyLow ) + "-" + str( energyHigh ) + "keV"
+    return self.inputPath + clusterTag + energyTag + Suffix
+
+
+# Geometry of every ordered pair of hits within the same event, calculated once when a dataset is loaded
+# Photons sampled from the dataset carry the cache source number and their hit row, so that
+#  FindHitRadius and SinogramCoords only need to calculate anything for pairs from different events
+class PairGeometry:
+
+  # Every cache that has been made, indexed by source number
+  # Only weak references are kept, so a cache is freed with its dataset
+  sources = []
+
+  def __init__( self, HitData ):
+
+    # For an event with N hits, each hit has a row of N pairs (including with itself)
+    # The pair for hit rows a and b is then at pairBase[a] + b
+    eventStarts, eventStops = EventRanges( HitData[ :, DATASET_EVENT ] )
+    eventHits = eventStops - eventStarts
+    self.hitEventStart = np.repeat( eventStarts, eventHits )
+    self.hitEventStop = np.repeat( eventStops, eventHits )
+    hitPairs = self.hitEventStop - self.hitEventStart
+    pairRowStarts = np.cumsum( hitPairs ) - hitPairs
+    self.pairBase = pairRowStarts - self.hitEventStart
+
+    firstRows = np.repeat( np.arange( len( HitData ) ), hitPairs )
+    secondRows = self.hitEventStart[ firstRows ] + np.arange( len( firstRows ) ) - pairRowStarts[ firstRows ]
+    r1 = HitData[ firstRows, DATASET_R ]
+    r2 = HitData[ secondRows, DATASET_R ]
+    phi1 = HitData[ firstRows, DATASET_PHI ]
+    phi2 = HitData[ secondRows, DATASET_PHI ]
+
+    # Radius of closest approach, per unit detector radius (see FindHitRadius)
+    deltaPhi = phi1 - phi2
+    while np.any( deltaPhi > math.pi ):
+      deltaPhi[ deltaPhi > math.pi ] -= 2.0 * math.pi
+    while np.any( deltaPhi < -math.pi ):
+      deltaPhi[ deltaPhi < -math.pi ] += 2.0 * math.pi
+    self.hitRadius = np.cos( deltaPhi/2.0 )
+    self.hitRadius[ deltaPhi < 0.0 ] *= -1.0
+
+    # Sinogram coordinates (see SinogramCoords)
+    x1 = r1 * np.cos( phi1 )
+    y1 = r1 * np.sin( phi1 )
+    x2 = r2 * np.cos( phi2 )
+    y2 = r2 * np.sin( phi2 )
+    self.sinogramTheta = np.arctan2( x1 - x2, y1 - y2 )
+    denom = np.sqrt( ( y1 - y2 ) * ( y1 - y2 ) + ( x2 - x1 ) * ( x2 - x1 ) )
+    self.sinogramS = np.zeros( len( firstRows ) )
+    np.divide( x1 * ( y1 - y2 ) + y1 * ( x2 - x1 ), denom, out=self.sinogramS, where=( denom != 0.0 ) )
+    flip = self.sinogramTheta < 0.0
+    self.sinogramTheta[ flip ] += np.pi
+    self.sinogramS[ flip ] *= -1.0
+
+    self.source = len( PairGeometry.sources )
+    PairGeometry.sources.append( weakref.ref( self ) )
+
+
+  # Index of the pair of hit rows in the cache, or None if they are from different events
+  def PairIndex( self, HitRow1, HitRow2 ):
+    if self.hitEventStart[ HitRow1 ] <= HitRow2 < self.hitEventStop[ HitRow1 ]:
+      return self.pairBase[ HitRow1 ] + HitRow2
+    return None
+
 
 #
 # End of the class, now just defining general methods
@@ -184,11 +1142,35 @@ def SameEventID( Event ):
   return Event[0][DATASET_EVENT] == Event[1][DATASET_EVENT]
 
 
+# Find the cache holding the geometry for a pair of photons, if they both come from one event in the same dataset
+# Returns the cache and the index of the pair within it, or None, None
+def CachedPair( Event ):
+
+  if len( Event[0] ) <= DATASET_SOURCE or len( Event[1] ) <= DATASET_SOURCE:
+    return None, None
+  source = Event[0][DATASET_SOURCE]
+  if source < 0 or source != Event[1][DATASET_SOURCE]:
+    return None, None
+
+  geometry = PairGeometry.sources[ int( source ) ]()
+  if geometry is None:
+    return None, None
+
+  pairIndex = geometry.PairIndex( int( Event[0][DATASET_HIT_INDEX] ), int( Event[1][DATASET_HIT_INDEX] ) )
+  if pairIndex is None:
+    return None, None
+  return geometry, pairIndex
+
+
 def FindHitRadius( Event, DetectorRadius ):
 
   if len( Event ) != 2:
     return -1.0
 
+  geometry, pairIndex = CachedPair( Event )
+  if geometry is not None:
+    return DetectorRadius * geometry.hitRadius[ pairIndex ]
+
   # Calculate delta phi
   phi1 = Event[0][DATASET_PHI]
   phi2 = Event[1][DATASET_PHI]
@@ -219,6 +1201,39 @@ def TwoHitEvent( Event, DetectorRadius, ZMin=0.0, ZMax=0.0, RMax=120.0 ):
   rMin = FindHitRadius( Event, DetectorRadius )
   return math.fabs( rMin ) <= RMax
 
+# Transverse position of a photon, from the derived columns if they were made
+def PhotonXY( Photon ):
+  if len( Photon ) <= DATASET_X or np.isnan( Photon[DATASET_X] ):
+    return Photon[DATASET_R]*np.cos(Photon[DATASET_PHI]), Photon[DATASET_R]*np.sin(Photon[DATASET_PHI])
+  return Photon[DATASET_X], Photon[DATASET_Y]
+
+
+# Sinogram coordinates (s, theta) of the line of response between two photons
+# Same calculation as CalcSinogramCoords in analysis/SinogramTools.py, but using the pair cache where possible
+def SinogramCoords( Event ):
+
+  geometry, pairIndex = CachedPair( Event )
+  if geometry is not None:
+    return geometry.sinogramS[ pairIndex ], geometry.sinogramTheta[ pairIndex ]
+
+  x1, y1 = PhotonXY( Event[0] )
+  x2, y2 = PhotonXY( Event[1] )
+
+  sinogramTheta = np.arctan2(x1 - x2, y1 - y2)
+
+  denom = (y1 - y2) * (y1 - y2) + (x2 - x1) * (x2 - x1)
+  sinogramS = 0.
+  if denom != 0. :
+    denom = np.sqrt(denom)
+    sinogramS = (x1 * (y1 - y2) + y1 * (x2 - x1))/ denom
+
+  if sinogramTheta < 0.0 :
+    sinogramTheta = sinogramTheta + np.pi
+    sinogramS = -sinogramS
+
+  return sinogramS, sinogramTheta
+
+
 # Outdated approach
 # Note that this definition specifically applies to central, linear phantoms only
 def BackToBackEvent( Event, DetectorRadius, ZMin=0.0, ZMax=0.0 ):
@@ -226,7 +1241,7 @@ def BackToBackEvent( Event, DetectorRadius, ZMin=0.0, ZMax=0.0 ):
 
 
 # Launch the Geant4 simulation
-def GenerateSample( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDecays, DetectorMaterial, Seed=1234, Path="", SourceOffset=0, NAluminiumSleeves=0 ):
+def GenerateSample( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDecays, DetectorMaterial, Seed=1234, Path="", SourceOffset=0, NAluminiumSleeves=0, BinaryOutput=False ):
 
   # Allow creation at arbitrary path
   outputFileName = ""
@@ -252,12 +1267,17 @@ def GenerateSample( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDec
   if 'Linear' in Source:
     outputFileName += "-y" + str(SourceOffset) + "mm."
 
-  outputFileName += str(Seed) + ".csv"
+  outputFileName += str(Seed)
+  if BinaryOutput:
+    outputFileName += ".bin"
+  else:
+    outputFileName += ".csv"
 
-  # Check if file already present (in which case assume it's re-usable)
-  if os.path.exists( outputFileName ):
+  # Check if file already present (in which case assume it's re-usable), possibly compressed
+  existingFileName = FindHitFile( outputFileName )
+  if existingFileName is not None:
     print( "Re-using previous simulation" )
-    return outputFileName
+    return existingFileName
   else:
     print( "Creating dataset " + outputFileName )
     command =  "../build/SimplePetScanner"
@@ -273,6 +1293,8 @@ def GenerateSample( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDec
     command += " --sourceOffsetMM " + str(SourceOffset)
     if DetectorMaterial != "":
       command += " --detectorMaterial " + DetectorMaterial
+    if BinaryOutput:
+      command += " --binaryOutput"
     print("Running command = ", command)
     process = subprocess.Popen( command, shell=True )
     process.wait()
@@ -286,9 +1308,13 @@ def GenerateSample( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDec
 
 
 # Create a dataset class from new or existing simulated input
-def CreateDataset( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDecays, EnergyMin, EnergyMax, DetectorMaterial, Seed=1234, Path="", ClusterLimitMM=None, SourceOffset=0, NAluminiumSleeves=0, UseNumpy=False ):
+# Pass the EnergyResolution that will be used for coincidence generation to drop hits outside the energy window at load
+# BinaryOutput asks the simulation for binary hit records (.bin), which load much faster than text
+# Indexed reads only the sampled events from the (uncompressed) hit file, instead of loading it all (see IndexedDatasetReader)
+# DetectedOnly makes the reader sample only decays that left hits, for use with GenerateCoincidences (see DetectedDecayRates)
+def CreateDataset( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDecays, EnergyMin, EnergyMax, DetectorMaterial, Seed=1234, Path="", ClusterLimitMM=None, SourceOffset=0, NAluminiumSleeves=0, UseNumpy=False, UseCache=True, MemoryMap=False, Processes=1, CachePairGeometry=False, DerivedColumns=False, EnergyResolution=None, EnergySigmaWindow=5.0, Compact=False, BinaryOutput=False, Indexed=False, DetectedOnly=False ):
 
-  outputFileName = GenerateSample( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDecays, DetectorMaterial, Seed, Path, SourceOffset, NAluminiumSleeves )
+  outputFileName = GenerateSample( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDecays, DetectorMaterial, Seed, Path, SourceOffset, NAluminiumSleeves, BinaryOutput )
   if outputFileName == "":
       return None
 
@@ -301,10 +1327,32 @@ def CreateDataset( DetectorLengthMM, Detector, SourceLengthMM, Source, TotalDeca
     else:
       print( "Using a high-granularity \"Crystal\" detector geometry with clusterisation at " + str(ClusterLimitMM) + "mm" )
 
-  inputData = SimulationDataset( outputFileName, TotalDecays, EnergyMin, EnergyMax, ClusterLimitMM )
+  # The crystal index is only derived for detectors with a known crystal layout
+  crystalGeometry = CrystalGeometryOfDetector( Detector )
+
+  if Indexed:
+    import IndexedDatasetReader
+    inputData = SimulationDataset( outputFileName, TotalDecays, EnergyMin, EnergyMax, ClusterLimitMM, DerivedColumns=DerivedColumns, \
+                                   EnergyResolution=EnergyResolution, EnergySigmaWindow=EnergySigmaWindow, LoadHits=False, CrystalGeometry=crystalGeometry )
+    return IndexedDatasetReader.IndexedDatasetReader( inputData, DetectedOnly )
+
+  # Re-use the memory-mapped copy of the hits if there is one, without reading the file at all
+  # (the pair geometry cache is made from the loaded hits, so it still needs them)
+  if UseNumpy and MemoryMap and not CachePairGeometry:
+    import NumpyDatasetReader
+    inputData = SimulationDataset( outputFileName, TotalDecays, EnergyMin, EnergyMax, ClusterLimitMM, DerivedColumns=DerivedColumns, \
+                                   EnergyResolution=EnergyResolution, EnergySigmaWindow=EnergySigmaWindow, LoadHits=False, CrystalGeometry=crystalGeometry )
+    if NumpyDatasetReader.LoadMemoryMaps( inputData, Compact ) is not None:
+      print( "Re-using memory-mapped hits for " + inputData.inputPath )
+      return NumpyDatasetReader.NumpyDatasetReader( inputData, MemoryMap, Compact, DetectedOnly )
+
+  inputData = SimulationDataset( outputFileName, TotalDecays, EnergyMin, EnergyMax, ClusterLimitMM, UseCache=UseCache, Processes=Processes, CachePairGeometry=CachePairGeometry, DerivedColumns=DerivedColumns, \
+                                 EnergyResolution=EnergyResolution, EnergySigmaWindow=EnergySigmaWindow, CrystalGeometry=crystalGeometry )
   if UseNumpy:
     import NumpyDatasetReader
-    return NumpyDatasetReader.NumpyDatasetReader( inputData )
+    return NumpyDatasetReader.NumpyDatasetReader( inputData, MemoryMap, Compact, DetectedOnly )
   else:
+    if Compact:
+      print( "Compact storage is only available with UseNumpy" )
     import LegacyDatasetReader
-    return LegacyDatasetReader.LegacyDatasetReader( inputData )
+    return LegacyDatasetReader.LegacyDatasetReader( inputData, DetectedOnly )
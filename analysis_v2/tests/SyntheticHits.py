@@ -0,0 +1,78 @@
+# Small synthetic hit files, in the formats written by EnergyCounter, so the loaders and readers can be checked
+#  without running a simulation
+# Each decay leaves up to four hits, grouped on two opposite sides of the detector (so some will cluster),
+#  and about a quarter of the decays leave no hits at all (so their event IDs are missing from the file)
+
+import gzip
+import numpy as np
+from SimulationDataset import DATASET_EVENT, DATASET_ENERGY, DATASET_TIME, DATASET_R, DATASET_PHI, DATASET_Z, DATASET_HIT_FIELDS, DATASET_MODULE_FIELDS, \
+                              BINARY_HIT_MAGIC, BINARY_HIT_VERSION, BINARY_HIT_HEADER, BINARY_HIT_DTYPE
+
+DECAY_COUNT = 2000
+
+
+# Returns the hit and module ID columns (as for ParseHitColumns), and the number of module IDs written for each hit
+# With Ragged, some hits only have one module ID (as with a geometry ID lookup), and the rest are -1
+def SyntheticHits( DecayCount=DECAY_COUNT, Seed=1, Ragged=False ):
+  RNG = np.random.default_rng( Seed )
+
+  eventHits = RNG.choice( 5, size=DecayCount, p=[ 0.25, 0.2, 0.3, 0.15, 0.1 ] )
+  hitCount = int( np.sum( eventHits ) )
+  hitEvents = np.repeat( np.arange( DecayCount ), eventHits )
+
+  hitData = np.empty( [ hitCount, DATASET_HIT_FIELDS ] )
+  hitData[ :, DATASET_EVENT ] = hitEvents
+  hitData[ :, DATASET_ENERGY ] = RNG.uniform( 20.0, 520.0, hitCount )
+  hitData[ :, DATASET_TIME ] = RNG.uniform( 0.0, 3.0, hitCount )
+  hitData[ :, DATASET_R ] = RNG.uniform( 390.0, 420.0, hitCount )
+  phi = RNG.uniform( -np.pi, np.pi, DecayCount )[ hitEvents ] + ( np.pi * RNG.integers( 0, 2, hitCount ) ) + RNG.normal( 0.0, 0.03, hitCount )
+  hitData[ :, DATASET_PHI ] = np.angle( np.exp( 1j * phi ) )
+  hitData[ :, DATASET_Z ] = RNG.uniform( -400.0, 400.0, DecayCount )[ hitEvents ] + RNG.normal( 0.0, 15.0, hitCount )
+
+  moduleData = RNG.integers( 0, 100, [ hitCount, DATASET_MODULE_FIELDS ] ).astype( np.int32 )
+  moduleFields = np.full( hitCount, DATASET_MODULE_FIELDS )
+  if Ragged:
+    moduleFields[ RNG.random( hitCount ) < 0.2 ] = 1
+    moduleData[ moduleFields == 1, 1: ] = -1
+
+  return hitData, moduleData, moduleFields
+
+
+# Text hit file: "EventID ModuleID[xN] Energy Time R Phi Z" on each line
+# Values are written at full precision, so that they parse back exactly (and so match a binary file)
+# Paths ending in .gz are compressed
+def WriteTextHits( OutputPath, HitData, ModuleData, ModuleFields ):
+  lines = []
+  for hit, modules, fieldCount in zip( HitData, ModuleData, ModuleFields ):
+    fields = [ str( int( hit[ DATASET_EVENT ] ) ) ] + [ str( moduleID ) for moduleID in modules[ :fieldCount ] ]
+    fields += [ repr( float( value ) ) for value in hit[ DATASET_EVENT+1: ] ]
+    lines.append( " ".join( fields ) + "\n" )
+  rawText = "".join( lines ).encode()
+
+  openFile = gzip.open if OutputPath.endswith( ".gz" ) else open
+  with openFile( OutputPath, "wb" ) as outputFile:
+    outputFile.write( rawText )
+  return OutputPath
+
+
+# Binary hit file: a header, then fixed-size records (see BINARY_HIT_DTYPE)
+def WriteBinaryHits( OutputPath, HitData, ModuleData, ModuleFields ):
+  header = np.zeros( 1, dtype=BINARY_HIT_HEADER )
+  header[ "magic" ] = BINARY_HIT_MAGIC
+  header[ "version" ] = BINARY_HIT_VERSION
+  header[ "recordSize" ] = BINARY_HIT_DTYPE.itemsize
+
+  records = np.zeros( len( HitData ), dtype=BINARY_HIT_DTYPE )
+  records[ "event" ] = HitData[ :, DATASET_EVENT ]
+  records[ "moduleIDs" ] = ModuleData
+  records[ "moduleFields" ] = ModuleFields
+  records[ "energy" ] = HitData[ :, DATASET_ENERGY ]
+  records[ "time" ] = HitData[ :, DATASET_TIME ]
+  records[ "r" ] = HitData[ :, DATASET_R ]
+  records[ "phi" ] = HitData[ :, DATASET_PHI ]
+  records[ "z" ] = HitData[ :, DATASET_Z ]
+
+  with open( OutputPath, "wb" ) as outputFile:
+    outputFile.write( header.tobytes() )
+    outputFile.write( records.tobytes() )
+  return OutputPath
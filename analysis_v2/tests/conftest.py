@@ -0,0 +1,23 @@
+# The analysis modules are imported by name, as they are from the notebooks and scripts in analysis_v2
+import os
+import sys
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+import pytest
+from SyntheticHits import SyntheticHits, WriteTextHits
+
+
+@pytest.fixture( scope="session" )
+def syntheticHits():
+  return SyntheticHits()
+
+
+@pytest.fixture( scope="session" )
+def raggedHits():
+  return SyntheticHits( Seed=2, Ragged=True )
+
+
+# A text hit file of syntheticHits, in its own directory (so that cache files from other tests aren't re-used)
+@pytest.fixture
+def hitFile( tmp_path, syntheticHits ):
+  return WriteTextHits( str( tmp_path / "hits.csv" ), *syntheticHits )
@@ -0,0 +1,124 @@
+import numpy as np
+import SimulationDataset as sd
+from NumpyDatasetReader import NumpyDatasetReader
+from CoincidenceGeneration import MergedTimeSeries, TimeSeriesMultiChannel, GenerateCoincidences, GenerateActivitySweep, FramedRateFunction, SplitFrames
+from SyntheticHits import DECAY_COUNT
+
+# Counts are compared with their expected value to within this many standard deviations
+SIGMA_LIMIT = 5.0
+
+
+def AssertPoissonCount( Count, Expected ):
+  assert abs( Count - Expected ) <= SIGMA_LIMIT * np.sqrt( Expected ), str( Count ) + " events, expected " + str( Expected )
+
+
+# Two independent counts of the same process
+def AssertSameRate( Count, OtherCount ):
+  assert abs( Count - OtherCount ) <= SIGMA_LIMIT * np.sqrt( Count + OtherCount ), str( Count ) + " events, compared with " + str( OtherCount )
+
+
+# A tracer channel and an intrinsic (background) channel, sampled from the synthetic hits
+def DecayReaders( HitFile ):
+  return [ NumpyDatasetReader( sd.SimulationDataset( HitFile, DECAY_COUNT, UseCache=False ) ) for channel in range( 2 ) ]
+
+
+# Intervals between Poisson events are exponential: the mean is 1/rate, and the variance is the mean squared
+def AssertExponentialGaps( Times, Rate ):
+  gaps = np.diff( Times )
+  assert np.all( gaps >= 0.0 )
+  assert abs( np.mean( gaps ) * Rate - 1.0 ) < SIGMA_LIMIT / np.sqrt( len( gaps ) )
+  assert abs( np.var( gaps ) * Rate * Rate - 1.0 ) < SIGMA_LIMIT * np.sqrt( 8.0 / len( gaps ) )
+
+
+def test_MergedTimeSeriesRates():
+  rates = [ 2e3, 5e3, 0.0 ]
+  timePeriod = 10.0
+  times, channels = MergedTimeSeries( timePeriod, rates, np.random.default_rng( 11 ) )
+
+  assert np.all( ( times >= 0.0 ) & ( times < timePeriod ) )
+  AssertExponentialGaps( times, sum( rates ) )
+  for channel, rate in enumerate( rates ):
+    AssertPoissonCount( np.count_nonzero( channels == channel ), rate * timePeriod )
+    if rate > 0.0:
+      AssertExponentialGaps( times[ channels == channel ], rate )
+
+
+# A rate given as a function of time is followed from PeriodStart
+def test_MergedTimeSeriesTimeVaryingRate():
+  def Rate( Time ):
+    return 1e4 * np.exp( -Time )
+  times, channels = MergedTimeSeries( 2.0, [ Rate, 1e3 ], np.random.default_rng( 12 ), PeriodStart=1.0 )
+
+  tracerTimes = times[ channels == 0 ]
+  AssertPoissonCount( np.count_nonzero( tracerTimes < 1.0 ), 1e4 * ( np.exp( -1.0 ) - np.exp( -2.0 ) ) )
+  AssertPoissonCount( np.count_nonzero( tracerTimes >= 1.0 ), 1e4 * ( np.exp( -2.0 ) - np.exp( -3.0 ) ) )
+  AssertPoissonCount( np.count_nonzero( channels == 1 ), 2e3 )
+
+
+# The event carried between batches keeps each channel a single Poisson stream across the batch edges
+def test_TimeSeriesMultiChannelAcrossBatches():
+  rates = np.array( [ 1e3, 4e3 ] )
+  RNG = np.random.default_rng( 13 )
+  startTimes = np.zeros( len( rates ) )
+
+  channelTimes = [ [] for rate in rates ]
+  totalTime = 0.0
+  for batch in range( 40 ):
+    timeSeries, batchTimePeriod = TimeSeriesMultiChannel( 2000, rates, RNG, startTimes )
+    for times, allTimes in zip( timeSeries, channelTimes ):
+      allTimes.append( times + totalTime )
+    totalTime += batchTimePeriod
+
+  for times, rate in zip( channelTimes, rates ):
+    times = np.concatenate( times )
+    AssertPoissonCount( len( times ), rate * totalTime )
+    AssertExponentialGaps( times, rate )
+
+
+# Every point of the sweep, down to the background alone, gives windows at the rate of a separate run at its activity
+def test_ActivitySweepMatchesIndependentRuns( hitFile ):
+  readers = DecayReaders( hitFile )
+  activities = np.array( [ 4e5, 2e5, 5e4, 0.0 ] )
+  decayRates = [ 0.0, 2e4 ]
+  windowSettings = ( 4.0, 6e7, False, 0.1, 400.0, 650.0, 0.2 ) # window, simulation window, multi-window, resolutions and cuts
+
+  sweepCounts = np.zeros( len( activities ), dtype=int )
+  for point, window in GenerateActivitySweep( 1000, activities, decayRates, readers, np.random.default_rng( 21 ), *windowSettings ):
+    sweepCounts[ point ] += 1
+
+  for point, activity in enumerate( activities ):
+    independentCount = sum( 1 for window in GenerateCoincidences( 1000, [ activity, decayRates[1] ], readers, np.random.default_rng( 22 + point ), *windowSettings ) )
+    AssertSameRate( sweepCounts[ point ], independentCount )
+  assert np.all( np.diff( sweepCounts ) < 0 )
+
+
+# Frames of a decaying tracer from one run each give windows at the rate of a separate run at that frame's activity,
+#  and with a gap between frames no window (prompt or delayed) reaches the next frame
+def test_FramesStayInsideTheirPeriod( hitFile ):
+  readers = DecayReaders( hitFile )
+  def TracerActivity( Time ):
+    return 4e5 * np.power( 0.5, Time )
+  frameTimes = np.arange( 4.0 )
+  frameLength = 5e6
+  coincidenceWindow = 4.0
+  delay = 20.0
+  frameGap = 10.0 * ( coincidenceWindow + delay )
+  framePeriod = frameLength + frameGap
+  windowSettings = ( False, 0.1, 400.0, 650.0, 0.2, True, delay ) # multi-window, resolutions and cuts, continuous times
+
+  framedRates = [ FramedRateFunction( TracerActivity, frameTimes, frameLength * 1e-9, frameGap * 1e-9 ), 2e4 ]
+  coincidences = GenerateCoincidences( 1000, framedRates, readers, np.random.default_rng( 31 ), coincidenceWindow, framePeriod * len( frameTimes ), *windowSettings )
+  frames = []
+  for frame, windows in SplitFrames( coincidences, frameLength, frameGap ):
+    frameCount = 0
+    for prompt, delayed in windows:
+      assert frame * framePeriod <= prompt[ 0, sd.DATASET_TIME ] < frame * framePeriod + frameLength
+      assert np.max( prompt[ :, sd.DATASET_TIME ] ) < ( frame + 1 ) * framePeriod
+      assert np.max( delayed[ :, sd.DATASET_TIME ] ) < ( frame + 1 ) * framePeriod
+      frameCount += 1
+    frames.append( ( frame, frameCount ) )
+
+  assert [ frame for frame, frameCount in frames ] == list( range( len( frameTimes ) ) )
+  for frame, frameCount in frames:
+    independent = GenerateCoincidences( 1000, [ TracerActivity( frameTimes[ frame ] ), 2e4 ], readers, np.random.default_rng( 32 + frame ), coincidenceWindow, frameLength, *windowSettings )
+    AssertSameRate( frameCount, sum( 1 for window in independent ) )
@@ -0,0 +1,162 @@
+import os
+import multiprocessing as mp
+import numpy as np
+import SimulationDataset as sd
+import SharedDatasetServer as sds
+from NumpyDatasetReader import NumpyDatasetReader
+from IndexedDatasetReader import IndexedDatasetReader
+from LegacyDatasetReader import LegacyDatasetReader
+from CoincidenceGeneration import MergedPhotonStream, GenerateCoincidences
+from SyntheticHits import DECAY_COUNT, WriteTextHits, WriteBinaryHits
+
+
+def LoadDataset( InputPath, **kwargs ):
+  return sd.SimulationDataset( InputPath, DECAY_COUNT, UseCache=False, **kwargs )
+
+
+# Photons from a few batches of decays, sampled with their own RNG so that readers can be compared
+def SampleBatches( Reader, Seed=5, BatchCount=3, BatchSize=700, Buffers=None ):
+  RNG = np.random.default_rng( Seed )
+  batches = []
+  for batch in range( BatchCount ):
+    times = np.sort( RNG.random( BatchSize ) ) * 1e-3
+    batches.append( np.array( Reader.SampleEventsAtTimes( times, RNG, Buffers ) ) )
+  return batches
+
+
+def AssertSameBatches( Batches, OtherBatches, Columns=slice( None ) ):
+  assert len( Batches ) == len( OtherBatches )
+  for photons, otherPhotons in zip( Batches, OtherBatches ):
+    np.testing.assert_array_equal( photons[ :, Columns ], otherPhotons[ :, Columns ] )
+
+
+# The first reader writes the memory-mapped copy, and the next maps it without the dataset loading any hits
+def test_MemoryMappedReaderMatchesLoaded( hitFile ):
+  expected = SampleBatches( NumpyDatasetReader( LoadDataset( hitFile ) ) )
+
+  writer = NumpyDatasetReader( LoadDataset( hitFile ), MemoryMap=True )
+  assert isinstance( writer.hitData, np.memmap )
+  AssertSameBatches( SampleBatches( writer ), expected )
+
+  reader = NumpyDatasetReader( LoadDataset( hitFile, LoadHits=False ), MemoryMap=True )
+  assert isinstance( reader.hitData, np.memmap )
+  AssertSameBatches( SampleBatches( reader ), expected )
+
+
+def test_CreateDatasetReusesMemoryMap( tmp_path, syntheticHits, capsys ):
+  WriteTextHits( str( tmp_path / ( "hits.n" + str( DECAY_COUNT ) + ".TestBlock.100mm.Point.10mm.1234.csv" ) ), *syntheticHits )
+  createArguments = ( 100, "TestBlock", 10, "Point", DECAY_COUNT, 0.0, 0.0, "" )
+
+  first = sd.CreateDataset( *createArguments, Path=str( tmp_path ), UseNumpy=True, MemoryMap=True )
+  assert "Re-using memory-mapped hits" not in capsys.readouterr().out
+  second = sd.CreateDataset( *createArguments, Path=str( tmp_path ), UseNumpy=True, MemoryMap=True )
+  assert "Re-using memory-mapped hits" in capsys.readouterr().out
+  assert second.inputDataset.hitCount == 0 # nothing was loaded
+  AssertSameBatches( SampleBatches( second ), SampleBatches( first ) )
+
+
+# Compact readers store float32 hits and give photons without the origin and derived columns,
+#  unless the dataset fills the derived columns
+def test_CompactPhotonsMatchFullPhotons( hitFile ):
+  full = SampleBatches( NumpyDatasetReader( LoadDataset( hitFile ) ) )
+  compactReader = NumpyDatasetReader( LoadDataset( hitFile ), Compact=True )
+  assert compactReader.hitData.dtype == np.float32
+  compact = SampleBatches( compactReader )
+
+  for photons, compactPhotons in zip( full, compact ):
+    assert compactPhotons.shape == ( len( photons ), sd.DATASET_COMPACT_PHOTON_LENGTH )
+    np.testing.assert_array_equal( compactPhotons[ :, sd.DATASET_EVENT ], photons[ :, sd.DATASET_EVENT ] )
+    np.testing.assert_array_equal( compactPhotons[ :, sd.DATASET_HIT_FIELDS: ], photons[ :, sd.DATASET_HIT_FIELDS : sd.DATASET_COMPACT_PHOTON_LENGTH ] )
+    np.testing.assert_allclose( compactPhotons[ :, sd.DATASET_ENERGY : sd.DATASET_HIT_FIELDS ], photons[ :, sd.DATASET_ENERGY : sd.DATASET_HIT_FIELDS ], rtol=1e-6, atol=1e-6 )
+
+  derivedReader = NumpyDatasetReader( LoadDataset( hitFile, DerivedColumns=True ), Compact=True )
+  assert SampleBatches( derivedReader )[0].shape[1] == sd.DATASET_PHOTON_LENGTH
+
+
+def test_CompactMemoryMapMatchesCompact( hitFile ):
+  expected = SampleBatches( NumpyDatasetReader( LoadDataset( hitFile ), Compact=True ) )
+  NumpyDatasetReader( LoadDataset( hitFile ), MemoryMap=True ) # the full-width copy is kept separately
+  NumpyDatasetReader( LoadDataset( hitFile ), MemoryMap=True, Compact=True )
+  reader = NumpyDatasetReader( LoadDataset( hitFile, LoadHits=False ), MemoryMap=True, Compact=True )
+  assert reader.hitData.dtype == np.float32
+  AssertSameBatches( SampleBatches( reader ), expected )
+
+
+# Mixing compact and full-width readers in one stream drops the extra columns
+def test_MergedStreamOfCompactAndFullReaders( hitFile ):
+  readers = [ NumpyDatasetReader( LoadDataset( hitFile ) ), NumpyDatasetReader( LoadDataset( hitFile ), Compact=True ) ]
+  RNG = np.random.default_rng( 5 )
+  photons = MergedPhotonStream( [ np.sort( RNG.random( 500 ) ) * 1e-3 for reader in readers ], readers, RNG )
+  assert photons.shape[1] == sd.DATASET_COMPACT_PHOTON_LENGTH
+  assert np.all( np.diff( photons[ :, sd.DATASET_TIME ] ) >= 0.0 )
+
+
+def SampleSharedDataset( Handle ):
+  reader = sds.AttachDataset( Handle )
+  try:
+    return SampleBatches( reader )
+  finally:
+    sds.DetachDataset( Handle )
+
+
+# Readers attached to shared memory, in this process or in workers, sample just like the reader that was shared
+def test_SharedDatasetMatchesReader( hitFile ):
+  for compact in [ False, True ]:
+    expected = SampleBatches( NumpyDatasetReader( LoadDataset( hitFile ), Compact=compact ) )
+    with sds.SharedDatasetServer() as server:
+      handle = server.Share( "hits", NumpyDatasetReader( LoadDataset( hitFile ), Compact=compact ) )
+      AssertSameBatches( SampleSharedDataset( handle ), expected )
+      assert handle.key not in sds.attachedDatasets
+
+      with mp.get_context( "spawn" ).Pool( processes=2 ) as pool:
+        for batches in pool.map( SampleSharedDataset, [ handle, handle ] ):
+          AssertSameBatches( batches, expected )
+
+
+# Reading just the sampled events gives the same photons as loading the whole file,
+#  apart from the origin columns (there is no pair cache, or hit row, without the loaded hits)
+# With DetectedOnly the indexed reader also samples events that the energy prefilter empties (it can't tell in advance),
+#  which only changes its detectedFraction, so that case is compared without a prefilter
+def test_IndexedReaderMatchesNumpyReader( tmp_path, syntheticHits, raggedHits ):
+  sameColumns = np.r_[ :sd.DATASET_SOURCE, sd.DATASET_X : sd.DATASET_PHOTON_LENGTH ]
+  inputPaths = [ WriteTextHits( str( tmp_path / "hits.csv" ), *syntheticHits ), WriteBinaryHits( str( tmp_path / "ragged.bin" ), *raggedHits ) ]
+  for inputPath in inputPaths:
+    for detectedOnly in [ False, True ]:
+      settings = dict( ClusterLimitMM=20, DerivedColumns=True )
+      if not detectedOnly:
+        settings.update( EnergyMin=100.0, EnergyMax=600.0, EnergyResolution=0.1 )
+      expected = SampleBatches( NumpyDatasetReader( LoadDataset( inputPath, **settings ), DetectedOnly=detectedOnly ) )
+      indexed = IndexedDatasetReader( LoadDataset( inputPath, LoadHits=False, **settings ), detectedOnly )
+      AssertSameBatches( SampleBatches( indexed ), expected, sameColumns )
+      assert np.all( SampleBatches( indexed )[0][ :, sd.DATASET_HIT_INDEX ] == -1 )
+    assert os.path.exists( sd.HitIndexPath( inputPath ) )
+
+
+# Sampling into the caller's buffers gives the same photons, and re-uses the same memory once it is big enough
+def test_BufferedSamplingMatchesUnbuffered( hitFile ):
+  makeReaders = [ lambda: NumpyDatasetReader( LoadDataset( hitFile ) ),
+                  lambda: NumpyDatasetReader( LoadDataset( hitFile ), Compact=True ),
+                  lambda: IndexedDatasetReader( LoadDataset( hitFile, LoadHits=False ) ),
+                  lambda: LegacyDatasetReader( LoadDataset( hitFile ) ) ]
+  for makeReader in makeReaders:
+    buffers = {}
+    AssertSameBatches( SampleBatches( makeReader(), Buffers=buffers ), SampleBatches( makeReader() ) )
+
+    reader = makeReader()
+    RNG = np.random.default_rng( 5 )
+    first = reader.SampleEventsAtTimes( np.sort( RNG.random( 700 ) ) * 1e-3, RNG, buffers )
+    second = reader.SampleEventsAtTimes( np.sort( RNG.random( 300 ) ) * 1e-3, RNG, buffers )
+    assert np.shares_memory( first, second )
+
+
+# Photons are sampled into the same buffers every batch, but windows that have been yielded are never overwritten
+def test_CoincidenceWindowsSurviveLaterBatches( hitFile ):
+  def Windows( Copy ):
+    readers = [ NumpyDatasetReader( LoadDataset( hitFile ) ), NumpyDatasetReader( LoadDataset( hitFile ), Compact=True ) ]
+    coincidences = GenerateCoincidences( 500, [ 2e5, 1e5 ], readers, np.random.default_rng( 7 ), 4.0, 2e7, False, 0.1, 400.0, 650.0, 0.2 )
+    return [ np.array( window ) if Copy else window for window in coincidences ]
+
+  copied = Windows( True )
+  kept = Windows( False )
+  assert len( copied ) > 100
+  AssertSameBatches( kept, copied )
@@ -0,0 +1,131 @@
+import os
+import numpy as np
+import pytest
+import SimulationDataset as sd
+from SimulationDataset import DATASET_EVENT, DATASET_ENERGY
+from SyntheticHits import DECAY_COUNT, WriteTextHits, WriteBinaryHits
+
+
+def LoadDataset( InputPath, UseCache=False, **kwargs ):
+  return sd.SimulationDataset( InputPath, DECAY_COUNT, UseCache=UseCache, **kwargs )
+
+
+def AssertSameHits( Dataset, HitData, ModuleData ):
+  np.testing.assert_array_equal( Dataset.hitData, HitData )
+  np.testing.assert_array_equal( Dataset.moduleData, ModuleData )
+  assert Dataset.hitCount == len( HitData )
+
+
+def test_LoadedHitsMatchFile( hitFile, syntheticHits ):
+  hitData, moduleData, _ = syntheticHits
+  dataset = LoadDataset( hitFile )
+  AssertSameHits( dataset, hitData, moduleData )
+  assert dataset.eventHitsMax == int( np.max( np.bincount( hitData[ :, DATASET_EVENT ].astype( int ) ) ) )
+
+
+def test_RaggedModuleIDsArePadded( tmp_path, raggedHits ):
+  hitData, moduleData, _ = raggedHits
+  AssertSameHits( LoadDataset( WriteTextHits( str( tmp_path / "hits.csv" ), *raggedHits ) ), hitData, moduleData )
+
+
+# Blocks never split an event, so small blocks give the same hits
+def test_SmallBlocksMatchWholeFile( hitFile, syntheticHits ):
+  hitData, moduleData, _ = syntheticHits
+  hitBlocks = [ hitBlock for hitBlock, _ in sd.ReadHitBlocks( hitFile, BlockHits=100, UseCache=False ) ]
+  assert len( hitBlocks ) > 1
+  for hitBlock, nextBlock in zip( hitBlocks[ :-1 ], hitBlocks[ 1: ] ):
+    assert hitBlock[ -1, DATASET_EVENT ] < nextBlock[ 0, DATASET_EVENT ]
+  AssertSameHits( LoadDataset( hitFile, BlockHits=100 ), hitData, moduleData )
+
+
+def test_ParallelParseMatchesSerial( tmp_path, syntheticHits, raggedHits ):
+  for name, hits in [ ( "hits.csv", syntheticHits ), ( "ragged.csv", raggedHits ) ]:
+    inputPath = WriteTextHits( str( tmp_path / name ), *hits )
+    serial = LoadDataset( inputPath, BlockHits=200 )
+    parallel = LoadDataset( inputPath, BlockHits=200, Processes=2 )
+    AssertSameHits( parallel, serial.hitData, serial.moduleData )
+    AssertSameHits( parallel, hits[0], hits[1] )
+
+
+# The first load writes the cache, and the second reads it rather than the file
+def test_CachedLoadMatchesFile( hitFile, syntheticHits ):
+  hitData, moduleData, _ = syntheticHits
+  AssertSameHits( LoadDataset( hitFile, UseCache=True ), hitData, moduleData )
+  assert os.path.exists( sd.HitCachePath( hitFile ) )
+  assert sd.ReadHitCache( hitFile ) is not None
+  AssertSameHits( LoadDataset( hitFile, UseCache=True ), hitData, moduleData )
+
+
+# Giving the uncompressed name finds the compressed file
+def test_CompressedFileMatchesPlain( tmp_path, syntheticHits ):
+  hitData, moduleData, _ = syntheticHits
+  WriteTextHits( str( tmp_path / "hits.csv.gz" ), *syntheticHits )
+  dataset = LoadDataset( str( tmp_path / "hits.csv" ), UseCache=True, Processes=2 )
+  assert dataset.inputPath.endswith( ".gz" )
+  AssertSameHits( dataset, hitData, moduleData )
+  AssertSameHits( LoadDataset( str( tmp_path / "hits.csv" ), UseCache=True ), hitData, moduleData )
+
+
+# With a very large limit each event becomes a single hit holding all its energy, and with no limit nothing merges
+def test_ClusteringMergesEvents( hitFile, syntheticHits ):
+  hitData, moduleData, _ = syntheticHits
+  events = hitData[ :, DATASET_EVENT ].astype( int )
+
+  merged = LoadDataset( hitFile, ClusterLimitMM=1e6 )
+  np.testing.assert_array_equal( merged.hitData[ :, DATASET_EVENT ], np.unique( events ) )
+  np.testing.assert_allclose( merged.hitData[ :, DATASET_ENERGY ], np.bincount( events, hitData[ :, DATASET_ENERGY ] )[ np.unique( events ) ] )
+
+  AssertSameHits( LoadDataset( hitFile, ClusterLimitMM=0 ), hitData, moduleData )
+
+  clustered = LoadDataset( hitFile, ClusterLimitMM=20 )
+  assert len( merged.hitData ) < clustered.hitCount < len( hitData )
+  np.testing.assert_allclose( np.sum( clustered.hitData[ :, DATASET_ENERGY ] ), np.sum( hitData[ :, DATASET_ENERGY ] ) )
+
+
+# Binary records hold the same values as the text, and are read directly rather than cached
+def test_BinaryFileMatchesText( tmp_path, syntheticHits, raggedHits ):
+  for name, hits in [ ( "hits", syntheticHits ), ( "ragged", raggedHits ) ]:
+    textPath = WriteTextHits( str( tmp_path / ( name + ".csv" ) ), *hits )
+    binaryPath = WriteBinaryHits( str( tmp_path / ( name + ".bin" ) ), *hits )
+    assert sd.IsBinaryHitFile( binaryPath ) and not sd.IsBinaryHitFile( textPath )
+
+    text = LoadDataset( textPath )
+    binary = LoadDataset( binaryPath, UseCache=True, BlockHits=100, Processes=2 )
+    AssertSameHits( binary, text.hitData, text.moduleData )
+    assert not os.path.exists( sd.HitCachePath( binaryPath ) )
+
+    clusteredText = LoadDataset( textPath, ClusterLimitMM=20 )
+    AssertSameHits( LoadDataset( binaryPath, ClusterLimitMM=20 ), clusteredText.hitData, clusteredText.moduleData )
+
+
+# Exported hits load back as they were, keeping the clustering they were exported with
+def test_ArrowExportRoundTrip( tmp_path, hitFile ):
+  pytest.importorskip( "pyarrow" )
+  import ArrowDatasetIO
+
+  clustered = LoadDataset( hitFile, ClusterLimitMM=20 )
+  for suffix in ArrowDatasetIO.ARROW_SUFFIXES[ :1 ] + ArrowDatasetIO.PARQUET_SUFFIXES:
+    exportPath = str( tmp_path / ( "hits" + suffix ) )
+    ArrowDatasetIO.ExportDataset( clustered, exportPath, BlockHits=500 )
+    imported = LoadDataset( exportPath, BlockHits=100 )
+    assert imported.clusterLimitMM == 20
+    AssertSameHits( imported, clustered.hitData, clustered.moduleData )
+
+
+# Photons keep all their columns, and compact photons read back with the missing columns filled in
+def test_ArrowPhotonRoundTrip( tmp_path, hitFile ):
+  pytest.importorskip( "pyarrow" )
+  import ArrowDatasetIO
+  from NumpyDatasetReader import NumpyDatasetReader
+
+  RNG = np.random.default_rng( 5 )
+  times = np.sort( RNG.random( 500 ) ) * 1e-3
+  photons = NumpyDatasetReader( LoadDataset( hitFile, DerivedColumns=True ) ).SampleEventsAtTimes( times, RNG )
+  ArrowDatasetIO.ExportPhotons( photons, str( tmp_path / "photons.arrow" ) )
+  np.testing.assert_array_equal( ArrowDatasetIO.ImportPhotons( str( tmp_path / "photons.arrow" ) ), photons )
+
+  compactPhotons = NumpyDatasetReader( LoadDataset( hitFile ), Compact=True ).SampleEventsAtTimes( times, RNG )
+  ArrowDatasetIO.ExportPhotons( compactPhotons, str( tmp_path / "compact.parquet" ) )
+  imported = ArrowDatasetIO.ImportPhotons( str( tmp_path / "compact.parquet" ) )
+  np.testing.assert_array_equal( imported[ :, :sd.DATASET_COMPACT_PHOTON_LENGTH ], compactPhotons )
+  assert np.all( imported[ :, sd.DATASET_SOURCE ] == -1 ) and np.all( imported[ :, sd.DATASET_CRYSTAL_INDEX ] == -1 )
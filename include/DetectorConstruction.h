@@ -12,7 +12,7 @@
 class DetectorConstruction : public G4VUserDetectorConstruction
 {
   public:
-    DetectorConstruction( DecayTimeFinderAction * decayTimeFinder, std::string detector, G4double detectorLength, G4double phantomLength, std::string outputFileName, std::string material, G4int nAluminiumSleeves, G4double sourceOffsetMM );
+    DetectorConstruction( DecayTimeFinderAction * decayTimeFinder, std::string detector, G4double detectorLength, G4double phantomLength, std::string outputFileName, std::string material, G4int nAluminiumSleeves, G4double sourceOffsetMM, bool binaryOutput = false );
     ~DetectorConstruction() override;
 
     G4VPhysicalVolume* Construct() override;
@@ -28,6 +28,7 @@ class DetectorConstruction : public G4VUserDetectorConstruction
     EnergyCounter * m_energyCounter;
     std::string m_detector;
     std::string m_outputFileName;
+    bool m_binaryOutput;
     std::string m_material;
     G4double m_detectorLength;
     G4double m_phantomLength;
@@ -8,11 +8,27 @@
 #include <map>
 #include <vector>
 #include <fstream>
+#include <limits>
+#include <cstdint>
+
+// Fixed-size record for binary output, one per hit (see analysis_v2/SimulationDataset.py, BINARY_HIT_DTYPE)
+// The file starts with a header: 8 character magic string, then the format version and record size as 32 bit integers
+struct BinaryHitRecord
+{
+  int64_t eventID;
+  int32_t moduleIDs[ 3 ]; // padded with -1 if there are fewer
+  int32_t moduleFields;
+  double energy; // keV
+  double time; // ns
+  double r; // mm
+  double phi;
+  double z; // mm
+};
 
 class EnergyCounter : public G4VSensitiveDetector
 {
   public:
-    EnergyCounter( const G4String& name, DecayTimeFinderAction * decayTimeFinder, std::string outputFileName );
+    EnergyCounter( const G4String& name, DecayTimeFinderAction * decayTimeFinder, std::string outputFileName, bool binaryOutput = false );
     ~EnergyCounter() override;
 
     void Initialize( G4HCofThisEvent* hitCollection ) override;
@@ -22,6 +38,9 @@ class EnergyCounter : public G4VSensitiveDetector
     void SetGeometryIDs( const std::vector< std::vector< int > > GeometryIDs ){ m_geometryIDs = GeometryIDs; };
 
   private:
+    void WriteMetadata();
+    void WriteBinaryHit( G4int eventID, G4int volumeID, G4double energy, bool useGeometryIDs );
+
     std::map< G4int, G4double > m_totalEnergyMap;
     std::map< G4int, G4double > m_integratedEnergyMap;
     std::map< G4int, G4double > m_averageTimeMap;
@@ -31,7 +50,16 @@ class EnergyCounter : public G4VSensitiveDetector
     std::vector< std::vector< int > > m_geometryIDs;
     DecayTimeFinderAction * m_decayTimeFinder;
     std::ofstream m_outputFile;
+    std::string m_outputFileName;
+    bool m_binaryOutput;
     G4double m_maxEnergyValue = 0.0;
+
+    // Statistics for the metadata file
+    long m_hitCount = 0;
+    long m_eventCount = 0;
+    size_t m_eventHitsMax = 0;
+    size_t m_moduleFieldsMin = std::numeric_limits< size_t >::max();
+    size_t m_moduleFieldsMax = 0;
 };
 
 #endif
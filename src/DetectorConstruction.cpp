@@ -18,11 +18,12 @@ G4ThreadLocal
 G4GlobalMagFieldMessenger* DetectorConstruction::m_magneticFieldMessenger = 0;
 
 DetectorConstruction::DetectorConstruction( DecayTimeFinderAction * decayTimeFinder, std::string detector, G4double detectorLength, G4double phantomLength,
-                                            std::string outputFileName, std::string material, G4int nAluminiumSleeves, G4double sourceOffsetMM )
+                                            std::string outputFileName, std::string material, G4int nAluminiumSleeves, G4double sourceOffsetMM, bool binaryOutput )
   : G4VUserDetectorConstruction()
   , m_decayTimeFinder( decayTimeFinder )
   , m_detector( detector )
   , m_outputFileName( outputFileName )
+  , m_binaryOutput( binaryOutput )
   , m_material( material )
   , m_detectorLength( detectorLength )
   , m_phantomLength( phantomLength )
@@ -128,7 +129,7 @@ G4VPhysicalVolume* DetectorConstruction::Construct()
   }
 
   // DETECTOR: separate class
-  m_energyCounter = new EnergyCounter( "Detector", m_decayTimeFinder, m_outputFileName );
+  m_energyCounter = new EnergyCounter( "Detector", m_decayTimeFinder, m_outputFileName, m_binaryOutput );
   if ( m_detector.substr( 0, 7 ) == "Siemens" )
   {
     SiemensQuadraDetector::Construct( "Detector", worldLV, m_detector.substr( 7 ), m_energyCounter, &m_detectorData, m_detectorLength, m_material );
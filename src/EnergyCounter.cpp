@@ -3,10 +3,14 @@
 #include "G4RunManager.hh"
 #include "G4SystemOfUnits.hh"
 
-EnergyCounter::EnergyCounter( const G4String& name, DecayTimeFinderAction * decayTimeFinder, std::string outputFileName )
+#include <algorithm>
+
+EnergyCounter::EnergyCounter( const G4String& name, DecayTimeFinderAction * decayTimeFinder, std::string outputFileName, bool binaryOutput )
   : G4VSensitiveDetector( name ) // Run the constructor of the parent class
   , m_decayTimeFinder( decayTimeFinder )
-  , m_outputFile( outputFileName )
+  , m_outputFile( outputFileName, binaryOutput ? std::ios::out | std::ios::binary : std::ios::out )
+  , m_outputFileName( outputFileName )
+  , m_binaryOutput( binaryOutput )
 {
   if (outputFileName.empty()){
     std::cerr << "Output file name cannot be empty" << std::endl;
@@ -16,10 +20,40 @@ EnergyCounter::EnergyCounter( const G4String& name, DecayTimeFinderAction * deca
     std::cerr << "Failed to open file: " << outputFileName << std::endl;
     exit(1);
   }
+
+  // Binary file header
+  if ( m_binaryOutput )
+  {
+    int32_t const version = 1;
+    int32_t const recordSize = sizeof( BinaryHitRecord );
+    m_outputFile.write( "SPETHITS", 8 );
+    m_outputFile.write( reinterpret_cast< const char* >( &version ), sizeof( version ) );
+    m_outputFile.write( reinterpret_cast< const char* >( &recordSize ), sizeof( recordSize ) );
+  }
 }
 
 EnergyCounter::~EnergyCounter()
 {
+  m_outputFile.close();
+  WriteMetadata();
+}
+
+// Describe the output file in a sidecar, so that it doesn't need to be scanned before loading
+// Format is defined in analysis_v2/SimulationDataset.py (ReadHitMetadata)
+void EnergyCounter::WriteMetadata()
+{
+  std::ifstream outputFile( m_outputFileName, std::ios::binary | std::ios::ate );
+  if ( !outputFile.good() ) return;
+  long const fileSize = outputFile.tellg();
+
+  std::ofstream metadataFile( m_outputFileName + ".meta" );
+  metadataFile << "version 1" << std::endl;
+  metadataFile << "fileSize " << fileSize << std::endl;
+  metadataFile << "moduleFieldsMin " << ( m_hitCount ? m_moduleFieldsMin : 0 ) << std::endl;
+  metadataFile << "moduleFieldsMax " << m_moduleFieldsMax << std::endl;
+  metadataFile << "hitCount " << m_hitCount << std::endl;
+  metadataFile << "eventCount " << m_eventCount << std::endl;
+  metadataFile << "eventHitsMax " << m_eventHitsMax << std::endl;
 }
 
 // At the start of the event, zero the energy counter
@@ -79,30 +113,81 @@ void EnergyCounter::EndOfEvent( G4HCofThisEvent* )
   }
   bool useGeometryIDs = ( maxID < m_geometryIDs.size() );
 
+  // Keep statistics for the metadata
+  if ( m_totalEnergyMap.size() )
+  {
+    ++m_eventCount;
+    m_hitCount += m_totalEnergyMap.size();
+    m_eventHitsMax = std::max( m_eventHitsMax, m_totalEnergyMap.size() );
+  }
+
   // Only output information for hits (since detector occupancy low)
+  G4int const eventID = G4RunManager::GetRunManager()->GetCurrentEvent()->GetEventID();
   for ( const auto& entry : m_totalEnergyMap )
   {
-    m_outputFile << G4RunManager::GetRunManager()->GetCurrentEvent()->GetEventID() << " ";
+    if ( m_binaryOutput )
+    {
+      WriteBinaryHit( eventID, entry.first, entry.second, useGeometryIDs );
+      continue;
+    }
+
+    m_outputFile << eventID << " ";
 
     // If there is a geometry ID lookup (e.g. for STIR/GATE compatibility) then use it
+    size_t moduleFields = 1;
     if ( useGeometryIDs )
     {
       // Can be multiple ID values, e.g. crystal, block, ring, etc.
       for ( const auto& idValue : m_geometryIDs[ entry.first ] ) m_outputFile << idValue << " ";
+      moduleFields = m_geometryIDs[ entry.first ].size();
     }
     else
     {
       m_outputFile << entry.first << " ";
     }
+    if ( moduleFields < m_moduleFieldsMin ) m_moduleFieldsMin = moduleFields;
+    if ( moduleFields > m_moduleFieldsMax ) m_moduleFieldsMax = moduleFields;
 
     // Divide by the unit when outputting
     // see http://geant4.web.cern.ch/sites/geant4.web.cern.ch/files/geant4/collaboration/working_groups/electromagnetic/gallery/units/SystemOfUnits.html
+    // End lines with a plain newline: std::endl would flush the file after every hit
     m_outputFile << entry.second / keV << " ";
     m_outputFile << m_averageTimeMap[ entry.first ] / ( entry.second * ns ) << " ";
     m_outputFile << m_averageRMap[ entry.first ] / ( entry.second * mm ) << " ";
     m_outputFile << m_averagePhiMap[ entry.first ] / entry.second << " ";
-    m_outputFile << m_averageZMap[ entry.first ] / ( entry.second * mm ) << std::endl;
+    m_outputFile << m_averageZMap[ entry.first ] / ( entry.second * mm ) << "\n";
+  }
+}
+
+// Write one hit as a fixed-size record, keeping full double precision
+void EnergyCounter::WriteBinaryHit( G4int eventID, G4int volumeID, G4double energy, bool useGeometryIDs )
+{
+  BinaryHitRecord record;
+  record.eventID = eventID;
+  std::fill( record.moduleIDs, record.moduleIDs + 3, -1 );
+
+  // If there is a geometry ID lookup (e.g. for STIR/GATE compatibility) then use it
+  size_t moduleFields = 1;
+  if ( useGeometryIDs )
+  {
+    std::vector< int > const& idValues = m_geometryIDs[ volumeID ];
+    moduleFields = std::min( idValues.size(), size_t( 3 ) );
+    std::copy( idValues.begin(), idValues.begin() + moduleFields, record.moduleIDs );
+  }
+  else
+  {
+    record.moduleIDs[ 0 ] = volumeID;
   }
+  record.moduleFields = moduleFields;
+  if ( moduleFields < m_moduleFieldsMin ) m_moduleFieldsMin = moduleFields;
+  if ( moduleFields > m_moduleFieldsMax ) m_moduleFieldsMax = moduleFields;
+
+  record.energy = energy / keV;
+  record.time = m_averageTimeMap[ volumeID ] / ( energy * ns );
+  record.r = m_averageRMap[ volumeID ] / ( energy * mm );
+  record.phi = m_averagePhiMap[ volumeID ] / energy;
+  record.z = m_averageZMap[ volumeID ] / ( energy * mm );
+  m_outputFile.write( reinterpret_cast< const char* >( &record ), sizeof( record ) );
 }
 
 G4float EnergyCounter::GetEFraction( const G4int copyNo ) const
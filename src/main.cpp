@@ -28,6 +28,7 @@ void printHelp()
             << "  --sourceOffsetMM      Shift the linear source by n mm" << std::endl
             << "  --phantomLengthMM     Set the phantom length in mm" << std::endl
             << "  --outputFileName      Override the default output file name" << std::endl
+            << "  --binaryOutput        Write hits as fixed-size binary records rather than text" << std::endl
             << "  --decayOutputFileName Create output containing the radioactive decay info" << std::endl
             << "  --randomSeed          Override the default random seed" << std::endl
             << "  --nAluminiumSleeves   Create sensitivity phantom with n sleeves" << std::endl
@@ -45,6 +46,7 @@ int main( int argc, char* argv[] )
   std::string detectorName = "";
   std::string sourceName = "";
   std::string outputFileName = "hits.csv";
+  G4bool binaryOutput = false;
   std::string decayOutputFileName = "";
   std::string stirHeader = "";
   G4double detectorLength = -1.0;
@@ -58,7 +60,7 @@ int main( int argc, char* argv[] )
 
     // Find argument parameter
     std::string nextArgument = "";
-    if ( argi + 1 < argc )
+    if ( argi + 1 < argc && argument != "--binaryOutput" )
     {
       nextArgument = argv[ argi + 1 ];
       if ( nextArgument[0] == '-' ) nextArgument = "";
@@ -74,6 +76,7 @@ int main( int argc, char* argv[] )
 
     // Examine arguments
     if ( argument == "--gui" ) useGUI = true;
+    else if ( argument == "--binaryOutput" ) binaryOutput = true;
     else if (argument == "--help") 
     { 
       printHelp();
@@ -220,7 +223,7 @@ int main( int argc, char* argv[] )
   runManager->SetUserInitialization( actions );
 
   // Set up detector
-  DetectorConstruction * detector = new DetectorConstruction( decayTimeFinder, detectorName, detectorLength, phantomLength, outputFileName, detectorMaterial, nAluminiumSleeves, sourceOffsetMM );
+  DetectorConstruction * detector = new DetectorConstruction( decayTimeFinder, detectorName, detectorLength, phantomLength, outputFileName, detectorMaterial, nAluminiumSleeves, sourceOffsetMM, binaryOutput );
   runManager->SetUserInitialization( detector );
 
   // Set up the macros